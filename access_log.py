@@ -0,0 +1,115 @@
+import os
+import asyncio
+import logging
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+from sqlalchemy import insert
+from models import db, AccessLog
+
+logger = logging.getLogger(__name__)
+
+
+class AccessLogWriter:
+    """Buffers AccessLog rows and writes them with bulk inserts.
+
+    Rows are flushed when batch_size of them are waiting or flush_interval seconds
+    after the first one arrived, whichever comes first. The buffer is bounded:
+    when it is full, log() waits up to put_timeout seconds and then drops the
+    row, so analytics can never stall the handlers for long.
+    """
+
+    def __init__(self, database, batch_size: int = None, flush_interval: float = None,
+                 max_pending: int = None, put_timeout: float = None):
+        self.database = database
+        self.batch_size = batch_size or int(os.getenv('ACCESS_LOG_BATCH_SIZE', 500))
+        self.flush_interval = flush_interval or float(os.getenv('ACCESS_LOG_FLUSH_INTERVAL', 2))
+        self.max_pending = max_pending or int(os.getenv('ACCESS_LOG_MAX_PENDING', 10000))
+        self.put_timeout = put_timeout or float(os.getenv('ACCESS_LOG_PUT_TIMEOUT', 0.5))
+        self.queue: Optional[asyncio.Queue] = None
+        self.task: Optional[asyncio.Task] = None
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.flushes = 0
+
+    def start(self):
+        """Start the background flusher on the running event loop"""
+        self.queue = asyncio.Queue(maxsize=self.max_pending)
+        self.task = asyncio.create_task(self._run(), name="access-log-writer")
+
+    async def stop(self):
+        """Stop the flusher after it has written out everything still buffered"""
+        if self.task:
+            # The sentinel queues behind every pending row, so all of them get flushed
+            await self.queue.put(None)
+            await self.task
+            self.task = None
+            self.queue = None
+
+    async def log(self, user_id: int, action: str, file_id: int = None,
+                  ip_address: str = None, user_agent: str = None):
+        """Queue one access log row"""
+        if user_id is None or self.queue is None:
+            return
+        row = {
+            'user_id': user_id,
+            'file_id': file_id,
+            'action': action,
+            'timestamp': datetime.utcnow(),
+            'ip_address': ip_address,
+            'user_agent': user_agent
+        }
+        try:
+            await asyncio.wait_for(self.queue.put(row), timeout=self.put_timeout)
+        except asyncio.TimeoutError:
+            self.dropped += 1
+            logger.warning(f"Access log buffer full, dropped '{action}' event")
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            row = await self.queue.get()
+            if row is None:
+                break
+            rows = [row]
+            deadline = loop.time() + self.flush_interval
+            while len(rows) < self.batch_size:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    row = await asyncio.wait_for(self.queue.get(), timeout=remaining)
+                except asyncio.TimeoutError:
+                    break
+                if row is None:
+                    stopping = True
+                    break
+                rows.append(row)
+            await self._flush(rows)
+
+    async def _flush(self, rows: List[Dict[str, Any]]):
+        if not rows:
+            return
+        try:
+            await self.database.run(self._insert_rows, rows)
+            self.written += len(rows)
+            self.flushes += 1
+        except Exception as e:
+            self.failed += len(rows)
+            logger.error(f"Error writing {len(rows)} access log rows: {e}")
+
+    @staticmethod
+    def _insert_rows(rows: List[Dict[str, Any]]):
+        db.session.execute(insert(AccessLog), rows)
+        db.session.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        """Buffer level and write counters for monitoring"""
+        return {
+            'pending': self.queue.qsize() if self.queue else 0,
+            'written': self.written,
+            'dropped': self.dropped,
+            'failed': self.failed,
+            'flushes': self.flushes
+        }
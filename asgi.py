@@ -0,0 +1,71 @@
+"""
+ASGI entry point: Telegram webhook and the Flask routes on one event loop.
+
+    uvicorn asgi:app --host 0.0.0.0 --port $PORT
+
+Telegram posts updates to WEBHOOK_PATH, where they are checked against the
+secret token and queued for the bot; everything else (/, /verify-token,
+/ads-verification) is served by the Flask app. The bot is started and stopped
+with the server's lifespan, so no polling loop or keep-alive thread is needed.
+Run a single worker: the bot's queues and caches live in this process.
+"""
+import os
+import hmac
+import hashlib
+import logging
+from contextlib import asynccontextmanager
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.routing import Mount, Route
+from main import app as flask_app, BOT_CAN_START, BOT_TOKEN, create_bot
+
+logger = logging.getLogger(__name__)
+
+# Public base URL of this service (Render provides RENDER_EXTERNAL_URL)
+WEBHOOK_BASE_URL = (os.getenv('WEBHOOK_URL') or os.getenv('RENDER_EXTERNAL_URL') or '').rstrip('/')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram/webhook')
+# Telegram echoes this in X-Telegram-Bot-Api-Secret-Token; derived from the bot token if not set
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or hashlib.sha256(BOT_TOKEN.encode()).hexdigest()
+
+bot = create_bot() if BOT_CAN_START else None
+
+
+async def telegram_webhook(request: Request) -> Response:
+    """Accept one update from Telegram and queue it for the bot"""
+    received = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    if not hmac.compare_digest(received, WEBHOOK_SECRET):
+        return Response(status_code=403)
+    if bot is None:
+        return Response(status_code=503)
+    try:
+        data = await request.json()
+    except ValueError:
+        return Response(status_code=400)
+    await bot.enqueue_webhook_update(data)
+    return Response(status_code=200)
+
+
+@asynccontextmanager
+async def lifespan(_app: Starlette):
+    if bot is None:
+        logger.warning("Bot cannot start - missing environment variables, serving web routes only")
+    elif not WEBHOOK_BASE_URL:
+        logger.error("WEBHOOK_URL is not set, bot not started")
+    else:
+        await bot.start_webhook(f"{WEBHOOK_BASE_URL}{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET)
+    try:
+        yield
+    finally:
+        if bot is not None and bot.application.running:
+            await bot.stop_webhook()
+
+
+app = Starlette(
+    routes=[
+        Route(WEBHOOK_PATH, telegram_webhook, methods=['POST']),
+        Mount('/', app=WSGIMiddleware(flask_app)),
+    ],
+    lifespan=lifespan
+)
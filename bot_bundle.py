@@ -1,20 +1,36 @@
 import os
 import asyncio
 import logging
-from datetime import datetime, timedelta
-from typing import Optional, Dict, List
+from datetime import datetime
+from typing import Optional, List, Union
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
-from models import db, User, UserToken, MediaFile, FileBundle, AccessLog
+from telegram.ext import Application, ApplicationHandlerStop, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, TypeHandler, filters
+from models import db, User, UserToken, MediaFile, FileBundle
 from utils import *
 from linkshortify import LinkShortifyAPI
+from database import AsyncDatabase, dialect_insert
+from cache import (token_cache, user_cache, manifest_cache, missing_bundle_cache, MISSING,
+                   CachedUser, CachedToken, snapshot_user, snapshot_token)
+from delivery import plan_delivery_batches, build_input_media, DeliveryQueue, DeliveryJob, BundleManifest, ManifestFile
+from rate_limiter import OutboundScheduler
+from link_pool import AdsLinkPool
+from tokens import POOL_USER_ID, activate_user_token, bind_pending_token, redeem_pooled_token, link_already_used, mark_link_used
+from access_log import AccessLogWriter
+from staging_store import create_staging_store, CollectionFullError
+from upload_batcher import UploadBatcher, PendingUpload
+from bundle_finalizer import BundleFinalizer
+from token_sweeper import TokenSweeper
+from coordination import create_lease, create_deduplicator
+from metrics import REGISTRY, CallbackMetric, observe_handler
+from profiling import UpdateProfiler
 
 # Configure logging
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 class TelegramBotBundle:
-    def __init__(self, token: str, bot_username: str, linkshortify_api_key: str, storage_channel_id: str, admin_id: str = None):
+    def __init__(self, token: str, bot_username: str, linkshortify_api_key: str, storage_channel_id: str,
+                 admin_id: str = None, flask_app=None):
         self.token = token
         # Remove @ symbol if present at the beginning
         self.bot_username = bot_username.lstrip('@') if bot_username else bot_username
@@ -22,41 +38,172 @@ class TelegramBotBundle:
         self.admin_id = admin_id
         self.linkshortify = LinkShortifyAPI(linkshortify_api_key)
         
+        # Pre-shortened ads links so token refresh doesn't wait on LinkShortify
+        self.link_pool = AdsLinkPool(self.linkshortify, self.bot_username)
+        self.link_claim_ttl = float(os.getenv('LINK_POOL_CLAIM_TTL', 3600))
+        
+        # Every outbound send goes through one flood-control aware scheduler
+        self.outbound = OutboundScheduler()
+        
+        # Database access runs on a bounded thread pool so handlers never block the event loop
+        self.db = AsyncDatabase(flask_app)
+        
+        # Analytics events are buffered and written in bulk
+        self.access_log = AccessLogWriter(self.db)
+        
+        # Bundle deliveries run in the background so deep-link handlers return immediately
+        self.delivery_queue = DeliveryQueue(self.process_delivery_job)
+        
         # User file collections - stores files temporarily until user confirms bundle
-        self.user_file_collections: Dict[int, List[dict]] = {}
+        self.staging = create_staging_store()
+        
+        # Uploads are forwarded, staged and acknowledged in batches (albums / debounce windows)
+        self.upload_batcher = UploadBatcher(self.ingest_uploads)
         
-        self.application = Application.builder().token(token).build()
+        # /done writes bundles in idempotent chunks; admins with a finalize in progress
+        self.finalizer = BundleFinalizer(self.db, self.staging)
+        self.finalizing = set()
+        self.progress_interval = float(os.getenv('FINALIZE_PROGRESS_INTERVAL', 2))
+        
+        # Expired tokens are deactivated and old ones purged on the job queue
+        self.token_sweeper = TokenSweeper(self.db)
+        
+        # Replicas share a polling lease; update_ids are remembered in memory while polling
+        # under the lease and in shared storage in webhook mode (see start_webhook)
+        self.lease = create_lease(self.db)
+        self.deduplicator = create_deduplicator(self.db, shared=False)
+        self.leader_required = False
+        self.lease_renewed_at = 0.0
+        
+        # Slow-update logging and admin-triggered cProfile/tracemalloc captures
+        self.profiler = UpdateProfiler()
+        
+        builder = (
+            Application.builder()
+            .token(token)
+            .concurrent_updates(int(os.getenv('BOT_CONCURRENT_UPDATES', 16)))
+            .post_init(self.post_init)
+            .post_stop(self.post_stop)
+            .post_shutdown(self.post_shutdown)
+        )
+        # A self-hosted Bot API server, or the fake one used by load_benchmark.py
+        if os.getenv('TELEGRAM_BASE_URL'):
+            builder = builder.base_url(os.getenv('TELEGRAM_BASE_URL'))
+        self.application = builder.build()
         self.setup_handlers()
+        self.register_metrics()
+        self.token_sweeper.schedule(self.application.job_queue)
+        self.application.job_queue.run_repeating(
+            self.purge_processed_updates, interval=3600, first=600, name='update-dedup-purge'
+        )
+
+    async def post_init(self, application: Application):
+        """Start background services once the application is initialized"""
+        if self.leader_required:
+            # Standby replicas wait here; polling only starts once post_init returns
+            await self.lease.wait_until_acquired()
+            self.lease_renewed_at = asyncio.get_running_loop().time()
+            application.job_queue.run_repeating(
+                self.renew_lease, interval=self.lease.ttl / 3, first=self.lease.ttl / 3, name='leader-lease'
+            )
+        self.delivery_queue.start()
+        self.link_pool.start()
+        self.access_log.start()
+        self.staging.start()
+
+    async def post_stop(self, application: Application):
+        """Flush pending uploads and deliveries while the bot can still send"""
+        await self.upload_batcher.stop()
+        await self.delivery_queue.stop()
+
+    async def post_shutdown(self, application: Application):
+        """Close the remaining background services before the process exits"""
+        await self.link_pool.stop()
+        await self.linkshortify.aclose()
+        await self.access_log.stop()
+        await self.staging.close()
+        if self.leader_required:
+            try:
+                await self.lease.release()
+            except Exception as e:
+                logger.error(f"Error releasing leader lease: {e}")
+
+    def register_metrics(self):
+        """Expose backlog and health of the background services on /metrics"""
+        REGISTRY.register(CallbackMetric(
+            'delivery_queue_depth', 'Bundle deliveries waiting for a worker',
+            lambda: {(): self.delivery_queue.depth}))
+        REGISTRY.register(self.delivery_queue.latency)
+        REGISTRY.register(CallbackMetric(
+            'delivery_jobs_total', 'Bundle deliveries by result',
+            lambda: {(result,): self.delivery_queue.stats()[result] for result in ('completed', 'failed', 'rejected')},
+            ['result'], type='counter'))
+        REGISTRY.register(CallbackMetric(
+            'access_log_pending', 'Access log rows buffered for the next bulk insert',
+            lambda: {(): self.access_log.stats()['pending']}))
+        REGISTRY.register(CallbackMetric(
+            'ads_link_pool_size', 'Pre-shortened ads links ready to hand out',
+            lambda: {(): len(self.link_pool.links)}))
+        REGISTRY.register(CallbackMetric(
+            'ads_link_pool_hits_total', 'Token refreshes served a pre-shortened link from the pool',
+            lambda: {(): self.link_pool.hits}, type='counter'))
+        REGISTRY.register(CallbackMetric(
+            'ads_link_pool_misses_total', 'Token refreshes that found the pool empty and shortened inline',
+            lambda: {(): self.link_pool.misses}, type='counter'))
+        REGISTRY.register(CallbackMetric(
+            'linkshortify_circuit_open', '1 while the LinkShortify circuit breaker is open',
+            lambda: {(): int(self.linkshortify.breaker.state != self.linkshortify.breaker.CLOSED)}))
+        REGISTRY.register(CallbackMetric(
+            'update_duplicates_total', 'Updates skipped because their update_id was already processed',
+            lambda: {(): self.deduplicator.duplicates}, type='counter'))
 
     def setup_handlers(self):
         """Setup bot command and message handlers"""
+        # Every handler is timed with a db/telegram/linkshortify breakdown for slow-update logs,
+        # and its database calls share one session for the update
+        def profiled(handler):
+            return self.profiler.wrap(self.db.per_update(handler))
+        
+        # Drop updates another replica (or an earlier delivery) already handled. Not profiled,
+        # so each update passes through the profiler once, in the handler that serves it
+        self.application.add_handler(TypeHandler(Update, self.db.per_update(self.drop_duplicate_update)), group=-1)
+        
         # Command handlers
-        self.application.add_handler(CommandHandler("start", self.start_command))
-        self.application.add_handler(CommandHandler("help", self.help_command))
-        self.application.add_handler(CommandHandler("token", self.token_status_command))
-        self.application.add_handler(CommandHandler("done", self.finalize_bundle_command))
-        self.application.add_handler(CommandHandler("clear", self.clear_collection_command))
+        self.application.add_handler(CommandHandler("start", profiled(self.start_command)))
+        self.application.add_handler(CommandHandler("help", profiled(self.help_command)))
+        self.application.add_handler(CommandHandler("token", profiled(self.token_status_command)))
+        self.application.add_handler(CommandHandler("done", profiled(self.finalize_bundle_command)))
+        self.application.add_handler(CommandHandler("clear", profiled(self.clear_collection_command)))
+        self.application.add_handler(CommandHandler("profile", profiled(self.profile_command)))
         
         # Message handlers - handle all media types  
-        self.application.add_handler(MessageHandler(filters.ATTACHMENT, self.handle_file_upload))
+        self.application.add_handler(MessageHandler(filters.ATTACHMENT, profiled(self.handle_file_upload)))
         
         # Text message handler for non-commands
         self.application.add_handler(MessageHandler(
             filters.TEXT & ~filters.COMMAND,
-            self.handle_text_message
+            profiled(self.handle_text_message)
         ))
         
         # Callback query handler for inline keyboards
-        self.application.add_handler(CallbackQueryHandler(self.handle_callback))
+        self.application.add_handler(CallbackQueryHandler(profiled(self.handle_callback)))
 
+    @observe_handler
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /start command and deep links"""
-        user = self.get_or_create_user(update.effective_user)
+        param = context.args[0] if context.args else None
+        link_type, data = parse_deep_link_parameter(param) if param else (None, None)
+        
+        # Signed verification links are checked before the user is loaded, so forged,
+        # expired or replayed ones never cost a database round trip
+        if link_type == 'token':
+            await self.handle_token_verification(update, context, data)
+            return
+        
+        user, valid_token = await self.resolve_user_token(update.effective_user)
         
         # Check for deep link parameters
-        if context.args and len(context.args) > 0:
-            param = context.args[0]
-            
+        if param:
             # Handle verification success message
             if param == "verified":
                 success_text = (
@@ -70,30 +217,27 @@ class TelegramBotBundle:
                 ]
                 reply_markup = InlineKeyboardMarkup(keyboard)
                 
-                await update.message.reply_text(
-                    success_text,
+                await self.outbound.call(
+                    context.bot.send_message,
+                    chat_id=update.effective_chat.id,
+                    text=success_text,
                     parse_mode='Markdown',
                     reply_markup=reply_markup
                 )
                 return
             
-            link_type, data = parse_deep_link_parameter(param)
-            
-            if link_type == 'token':
-                await self.handle_token_verification(update, context, data, user)
-                return
-            elif link_type == 'bundle':
+            if link_type in ('bundle', 'bundle_key'):
                 # Handle bundle access
-                await self.handle_bundle_access(update, context, data, user)
+                await self.handle_bundle_access(update, context, data, user, compact=link_type == 'bundle_key')
                 return
             else:
                 # Regular media access
-                await self.handle_media_access(update, context, param, user)
+                await self.handle_media_access(
+                    update, context, data, user, compact=link_type == 'media_key'
+                )
                 return
         
         # Check user's token status for start page
-        valid_token = self.get_valid_user_token(user)
-        
         if valid_token:
             # User has valid token - show clean welcome message
             user_name = user.first_name or "User"
@@ -125,29 +269,36 @@ class TelegramBotBundle:
             ]
             reply_markup = InlineKeyboardMarkup(keyboard)
         
-        await context.bot.send_message(
+        await self.outbound.call(
+            context.bot.send_message,
             chat_id=update.effective_chat.id,
             text=welcome_text,
             reply_markup=reply_markup
         )
 
+    @observe_handler
     async def handle_file_upload(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle file uploads and add to user's collection"""
         user_id = update.effective_user.id
         
         # Check if user is admin
         if self.admin_id and str(user_id) != self.admin_id:
-            await context.bot.send_message(
+            await self.outbound.call(
+                context.bot.send_message,
                 chat_id=update.effective_chat.id,
                 text="❌ Sorry, only bot admin can upload files."
             )
             return
         
-        db_user = self.get_or_create_user(update.effective_user)
-        
-        # Initialize user collection if doesn't exist
-        if user_id not in self.user_file_collections:
-            self.user_file_collections[user_id] = []
+        # Refuse early rather than forwarding a file we can't stage
+        staged = await self.staging.count(user_id) + self.upload_batcher.pending_count(user_id)
+        if staged >= self.staging.max_files:
+            await self.outbound.call(
+                context.bot.send_message,
+                chat_id=update.effective_chat.id,
+                text=f"❌ Collection is full ({self.staging.max_files} files). Use /done to create the bundle first."
+            )
+            return
         
         # Extract file information
         file_obj = None
@@ -187,7 +338,8 @@ class TelegramBotBundle:
             file_size = file_obj.file_size
         
         if not file_obj:
-            await context.bot.send_message(
+            await self.outbound.call(
+                context.bot.send_message,
                 chat_id=update.effective_chat.id,
                 text="❌ Unsupported file type."
             )
@@ -195,102 +347,190 @@ class TelegramBotBundle:
         
         try:
             # Forward file to storage channel
-            forwarded_msg = await context.bot.forward_message(
-                chat_id=self.storage_channel_id,
-                from_chat_id=update.message.chat_id,
-                message_id=update.message.message_id
-            )
-            
-            # Add to user's collection
+            # Forwarding, staging and the acknowledgement happen once per album / burst
             file_info = {
-                'file_obj': file_obj,
                 'file_type': file_type,
                 'file_name': sanitize_filename(file_name),
                 'file_size': file_size or 0,
                 'telegram_file_id': file_obj.file_id,
-                'storage_message_id': forwarded_msg.message_id,
-                'description': update.message.caption or ""
+                'caption': update.message.caption or ""
             }
             
-            self.user_file_collections[user_id].append(file_info)
-            
-            collection_count = len(self.user_file_collections[user_id])
-            
-            response_text = (
-                f"✅ File added to your collection!\n\n"
-                f"📁 Name: {file_info['file_name']}\n"
-                f"📊 Size: {format_file_size(file_info['file_size'])}\n"
-                f"📦 Collection: {collection_count} file(s)\n\n"
-                f"Send more files or use /done to create bundle link."
-            )
+            # /done clears the whole collection when it finishes, so a file staged meanwhile
+            # would be lost. Checked right before add(): nothing can start a /done in between.
+            if user_id in self.finalizing:
+                await self.outbound.call(
+                    context.bot.send_message,
+                    chat_id=update.effective_chat.id,
+                    text=f"⏳ Your bundle is still being created. Send {file_name} again once it's done."
+                )
+                return
             
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text=response_text
-            )
+            self.upload_batcher.add(user_id, PendingUpload(
+                chat_id=update.message.chat_id,
+                message_id=update.message.message_id,
+                media_group_id=update.message.media_group_id,
+                file_info=file_info
+            ))
             
         except Exception as e:
             logger.error(f"Error adding file to collection: {e}")
-            await context.bot.send_message(
+            await self.outbound.call(
+                context.bot.send_message,
                 chat_id=update.effective_chat.id,
                 text="❌ Error processing file. Please try again."
             )
 
+    @observe_handler
+    async def ingest_uploads(self, user_id: int, uploads: List[PendingUpload]):
+        """Forward a batch of uploads to the storage channel, stage them and acknowledge once"""
+        bot = self.application.bot
+        chat_id = uploads[-1].chat_id
+        
+        # Bot API wants strictly increasing ids, which is also upload order
+        uploads = sorted(uploads, key=lambda upload: upload.message_id)
+        room = self.staging.max_files - await self.staging.count(user_id)
+        accepted, rejected = uploads[:max(room, 0)], uploads[max(room, 0):]
+        
+        if not accepted:
+            await self.outbound.call(
+                bot.send_message,
+                chat_id=chat_id,
+                text=f"❌ Collection is full ({self.staging.max_files} files). Use /done to create the bundle first."
+            )
+            return
+        
+        try:
+            records = []
+            for start in range(0, len(accepted), 100):
+                chunk = accepted[start:start + 100]
+                forwarded = await self.outbound.call(
+                    bot.forward_messages,
+                    chat_id=self.storage_channel_id,
+                    from_chat_id=chunk[0].chat_id,
+                    message_ids=[upload.message_id for upload in chunk],
+                    cost=len(chunk)
+                )
+                # Messages that can't be forwarded are skipped, so only map ids one-to-one
+                message_ids = [message.message_id for message in forwarded]
+                if len(message_ids) != len(chunk):
+                    logger.warning(f"Forwarded {len(message_ids)} of {len(chunk)} uploads to storage")
+                    message_ids = [None] * len(chunk)
+                for upload, storage_message_id in zip(chunk, message_ids):
+                    records.append(dict(upload.file_info, storage_message_id=storage_message_id))
+            
+            collection_count = await self.staging.add_files(user_id, records)
+        except CollectionFullError as e:
+            await self.outbound.call(
+                bot.send_message,
+                chat_id=chat_id,
+                text=f"❌ Collection is full ({e.max_files} files). Use /done to create the bundle first."
+            )
+            return
+        except Exception as e:
+            logger.error(f"Error adding {len(uploads)} files to collection: {e}")
+            await self.outbound.call(
+                bot.send_message,
+                chat_id=chat_id,
+                text="❌ Error processing files. Please send them again."
+            )
+            return
+        
+        albums = len({upload.media_group_id for upload in accepted if upload.media_group_id})
+        names = [record['file_name'] for record in records]
+        total_size = sum(record['file_size'] for record in records)
+        
+        if len(records) == 1:
+            response_text = (
+                f"✅ File added to your collection!\n\n"
+                f"📁 Name: {names[0]}\n"
+                f"📊 Size: {format_file_size(total_size)}\n"
+            )
+        else:
+            response_text = (
+                f"✅ {len(records)} files added to your collection!"
+                f"{f' ({albums} album(s))' if albums else ''}\n\n"
+                f"📁 Files: {', '.join(names[:3])}{'...' if len(names) > 3 else ''}\n"
+                f"📊 Size: {format_file_size(total_size)}\n"
+            )
+        if rejected:
+            response_text += f"⚠️ {len(rejected)} file(s) skipped, collection limit is {self.staging.max_files}\n"
+        response_text += (
+            f"📦 Collection: {collection_count} file(s)\n\n"
+            f"Send more files or use /done to create bundle link."
+        )
+        
+        await self.outbound.call(bot.send_message, chat_id=chat_id, text=response_text)
+
+    @observe_handler
     async def finalize_bundle_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Create bundle from user's file collection"""
         user_id = update.effective_user.id
-        db_user = self.get_or_create_user(update.effective_user)
+        chat_id = update.effective_chat.id
         
-        if user_id not in self.user_file_collections or not self.user_file_collections[user_id]:
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text="❌ No files in your collection. Send some files first!"
+        if user_id in self.finalizing:
+            await self.outbound.call(
+                context.bot.send_message,
+                chat_id=chat_id,
+                text="⏳ Your bundle is still being created, please wait..."
             )
             return
         
+        self.finalizing.add(user_id)
         try:
-            # Create bundle in database
-            bundle_id = generate_unique_bundle_id()
-            
-            file_bundle = FileBundle(
-                bundle_id=bundle_id,
-                created_by=db_user.id,
-                title=f"Bundle {len(self.user_file_collections[user_id])} files",
-                description=f"Bundle created on {datetime.utcnow().strftime('%Y-%m-%d %H:%M')}"
+            await self._finalize_bundle(context, user_id, chat_id, update.effective_user)
+        finally:
+            self.finalizing.discard(user_id)
+
+    async def _finalize_bundle(self, context: ContextTypes.DEFAULT_TYPE, user_id: int, chat_id: int, tg_user):
+        """Write the staged collection as a bundle, reporting progress for large collections"""
+        # Uploads still inside their debounce window belong to this bundle too
+        await self.upload_batcher.drain(user_id)
+        collection = await self.staging.get_files(user_id)
+        
+        if not collection:
+            await self.outbound.call(
+                context.bot.send_message,
+                chat_id=chat_id,
+                text="❌ No files in your collection. Send some files first!"
             )
+            return
+        
+        progress_message = None
+        try:
+            db_user = await self.resolve_user(tg_user)
             
-            db.session.add(file_bundle)
-            db.session.flush()  # Get bundle.id
-            
-            # Save all files to database with bundle reference
-            total_size = 0
-            file_names = []
-            
-            for file_info in self.user_file_collections[user_id]:
-                unique_file_id = generate_unique_file_id()
-                
-                media_file = MediaFile(
-                    file_id=unique_file_id,
-                    bundle_id=bundle_id,
-                    file_name=file_info['file_name'],
-                    file_type=file_info['file_type'],
-                    file_size=file_info['file_size'],
-                    telegram_file_id=file_info['telegram_file_id'],
-                    uploaded_by=db_user.id,
-                    description=file_info['description']
+            progress = None
+            if len(collection) > self.finalizer.chunk_size:
+                progress_message = await self.outbound.call(
+                    context.bot.send_message,
+                    chat_id=chat_id,
+                    text=f"⏳ Creating bundle... 0/{len(collection)} files saved"
                 )
+                last_edit = asyncio.get_running_loop().time()
                 
-                db.session.add(media_file)
-                total_size += file_info['file_size']
-                file_names.append(file_info['file_name'])
+                async def progress(done: int, total: int):
+                    nonlocal last_edit
+                    now = asyncio.get_running_loop().time()
+                    if done < total and now - last_edit >= self.progress_interval:
+                        last_edit = now
+                        await self.outbound.call(
+                            context.bot.edit_message_text,
+                            chat_id=chat_id,
+                            message_id=progress_message.message_id,
+                            text=f"⏳ Creating bundle... {done}/{total} files saved"
+                        )
             
-            db.session.commit()
+            # Resumable: a retried /done continues the same bundle
+            bundle_key = await self.finalizer.finalize(user_id, db_user.id, collection, progress)
+            total_size = sum(file_info['file_size'] or 0 for file_info in collection)
+            file_names = [file_info['file_name'] for file_info in collection]
             
             # Generate bundle sharing link
-            sharing_link = generate_bundle_link(self.bot_username, bundle_id)
+            sharing_link = generate_bundle_link(self.bot_username, bundle_key)
             
             # Clear user's collection
-            del self.user_file_collections[user_id]
+            await self.staging.clear(user_id)
             
             success_text = (
                 f"🎉 Bundle created successfully!\n\n"
@@ -302,80 +542,123 @@ class TelegramBotBundle:
                 f"Share this link to give access to all files!"
             )
             
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text=success_text
-            )
+            if progress_message:
+                await self.outbound.call(
+                    context.bot.edit_message_text,
+                    chat_id=chat_id,
+                    message_id=progress_message.message_id,
+                    text=success_text
+                )
+            else:
+                await self.outbound.call(
+                    context.bot.send_message,
+                    chat_id=chat_id,
+                    text=success_text
+                )
             
         except Exception as e:
             logger.error(f"Error creating bundle: {e}")
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text="❌ Error creating bundle. Please try again."
+            await self.outbound.call(
+                context.bot.send_message,
+                chat_id=chat_id,
+                text="❌ Error creating bundle. Use /done again to resume it."
             )
 
+    @observe_handler
     async def clear_collection_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Clear user's current file collection"""
         user_id = update.effective_user.id
+        count = await self.staging.clear(user_id)
         
-        if user_id in self.user_file_collections:
-            count = len(self.user_file_collections[user_id])
-            del self.user_file_collections[user_id]
-            
-            await context.bot.send_message(
+        if count:
+            await self.outbound.call(
+                context.bot.send_message,
                 chat_id=update.effective_chat.id,
                 text=f"🗑️ Cleared {count} files from your collection."
             )
         else:
-            await context.bot.send_message(
+            await self.outbound.call(
+                context.bot.send_message,
                 chat_id=update.effective_chat.id,
                 text="❌ No files to clear."
             )
 
+    @observe_handler
     async def handle_bundle_access(self, update: Update, context: ContextTypes.DEFAULT_TYPE,
-                                 encoded_bundle_id: str, db_user: User):
-        """Handle bundle access from deep link"""
+                                 encoded_bundle_id: str, db_user: CachedUser, compact: bool = False):
+        """Handle bundle access from deep link (b_<key> or the older bundle_<base64 id>)"""
+        cache_key = f"b_{encoded_bundle_id}" if compact else encoded_bundle_id
         try:
-            bundle_id = decode_file_id(encoded_bundle_id)
-            if not bundle_id:
-                await context.bot.send_message(
+            # Links already known to be bad never reach the database again
+            if missing_bundle_cache.get(cache_key) is not MISSING:
+                bundle_ref = None
+            elif compact:
+                bundle_ref = decode_compact_id('b', encoded_bundle_id)
+            else:
+                bundle_ref = decode_file_id(encoded_bundle_id)
+            
+            if bundle_ref in (None, ''):
+                missing_bundle_cache.set(cache_key, True)
+                await self.outbound.call(
+                    context.bot.send_message,
                     chat_id=update.effective_chat.id,
                     text="❌ Invalid bundle link."
                 )
                 return
             
             # Find bundle
-            bundle = FileBundle.query.filter_by(bundle_id=bundle_id).first()
+            bundle = await self.load_bundle_manifest(bundle_ref)
             if not bundle:
-                await context.bot.send_message(
+                missing_bundle_cache.set(cache_key, True)
+                await self.outbound.call(
+                    context.bot.send_message,
                     chat_id=update.effective_chat.id,
                     text="❌ Bundle not found."
                 )
                 return
             
             # Check if user has valid token
-            valid_token = self.get_valid_user_token(db_user)
+            valid_token = await self.lookup_valid_token(db_user)
             if valid_token:
-                # User has valid token, send all files
-                await self.send_bundle_files(context, update.effective_chat.id, bundle)
+                # User has valid token, hand the delivery to the background workers
+                queued = self.delivery_queue.enqueue(update.effective_chat.id, (context, bundle))
+                if queued:
+                    await self.log_access(db_user, 'bundle_access')
+                await self.outbound.call(
+                    context.bot.send_message,
+                    chat_id=update.effective_chat.id,
+                    text=(
+                        "📦 Bundle found! Your files are on the way..."
+                        if queued else
+                        "⏳ The bot is busy right now. Please open the link again in a minute."
+                    )
+                )
             else:
                 # User needs to get token through ads
                 await self.send_token_refresh_message(update, context, db_user)
                 
         except Exception as e:
             logger.error(f"Error handling bundle access: {e}")
-            await context.bot.send_message(
+            await self.outbound.call(
+                context.bot.send_message,
                 chat_id=update.effective_chat.id,
                 text="❌ Error accessing bundle."
             )
 
-    async def send_bundle_files(self, context: ContextTypes.DEFAULT_TYPE, chat_id: int, bundle: FileBundle):
+    @observe_handler
+    async def process_delivery_job(self, job: DeliveryJob):
+        """Delivery queue worker entry point"""
+        context, bundle = job.payload
+        await self.send_bundle_files(context, job.chat_id, bundle)
+
+    async def send_bundle_files(self, context: ContextTypes.DEFAULT_TYPE, chat_id: int, bundle: BundleManifest):
         """Send all files from a bundle"""
         try:
-            files = MediaFile.query.filter_by(bundle_id=bundle.bundle_id).all()
+            files = bundle.files
             
             if not files:
-                await context.bot.send_message(
+                await self.outbound.call(
+                    context.bot.send_message,
                     chat_id=chat_id,
                     text="❌ No files found in this bundle."
                 )
@@ -389,76 +672,93 @@ class TelegramBotBundle:
                 f"Sending files..."
             )
             
-            await context.bot.send_message(chat_id=chat_id, text=bundle_info)
+            await self.outbound.call(context.bot.send_message, chat_id=chat_id, text=bundle_info)
             
-            # Send each file
-            for file in files:
+            # Send files as albums of up to 10 where Telegram allows it,
+            # falling back to single sends for voice, animations and leftovers
+            for batch in plan_delivery_batches(files):
                 try:
-                    # Send file from storage channel using its telegram_file_id with protection
-                    if file.file_type == 'photo':
-                        await context.bot.send_photo(
-                            chat_id=chat_id,
-                            photo=file.telegram_file_id,
-                            caption=f"📁 {file.file_name}",
-                            protect_content=True  # Prevents forwarding/copying
-                        )
-                    elif file.file_type == 'video':
-                        await context.bot.send_video(
-                            chat_id=chat_id,
-                            video=file.telegram_file_id,
-                            caption=f"📁 {file.file_name}",
-                            protect_content=True  # Prevents forwarding/copying
-                        )
-                    else:  # document, audio, voice, animation
-                        await context.bot.send_document(
+                    if len(batch) > 1:
+                        await self.outbound.call(
+                            context.bot.send_media_group,
                             chat_id=chat_id,
-                            document=file.telegram_file_id,
-                            caption=f"📁 {file.file_name}",
-                            protect_content=True  # Prevents forwarding/copying
+                            media=[build_input_media(file) for file in batch],
+                            protect_content=True,  # Prevents forwarding/copying
+                            cost=len(batch)
                         )
-                        
-                    # Small delay to avoid rate limits
-                    await asyncio.sleep(0.5)
+                    else:
+                        await self.send_media_from_storage(context, chat_id, batch[0])
                     
                 except Exception as e:
-                    logger.error(f"Error sending file {file.file_name}: {e}")
-                    await context.bot.send_message(
+                    file_names = ', '.join(file.file_name for file in batch)
+                    logger.error(f"Error sending files {file_names}: {e}")
+                    await self.outbound.call(
+                        context.bot.send_message,
                         chat_id=chat_id,
-                        text=f"❌ Error sending {file.file_name}"
+                        text=f"❌ Error sending {file_names}"
                     )
             
-            await context.bot.send_message(
+            await self.outbound.call(
+                context.bot.send_message,
                 chat_id=chat_id,
                 text="✅ All files sent successfully!"
             )
             
         except Exception as e:
             logger.error(f"Error sending bundle files: {e}")
-            await context.bot.send_message(
+            await self.outbound.call(
+                context.bot.send_message,
                 chat_id=chat_id,
                 text="❌ Error sending files."
             )
 
     # Include other methods from original bot.py that are still needed
+    @observe_handler
     async def handle_token_verification(self, update: Update, context: ContextTypes.DEFAULT_TYPE, 
-                                      encoded_data: str, db_user: User):
+                                      encoded_data: str):
         """Handle token verification from deep link"""
         try:
+            # Signed links: forged, expired, foreign or replayed ones never reach the database
             token_data = decode_token_data(encoded_data)
-            if not token_data:
-                await context.bot.send_message(
+            if not token_data or token_data['user_id'] not in (POOL_USER_ID, str(update.effective_user.id)):
+                await self.outbound.call(
+                    context.bot.send_message,
+                    chat_id=update.effective_chat.id,
+                    text="❌ Invalid or expired verification link."
+                )
+                return
+            if link_already_used(token_data):
+                await self.outbound.call(
+                    context.bot.send_message,
                     chat_id=update.effective_chat.id,
-                    text="❌ Invalid verification link."
+                    text="❌ This verification link was already used."
                 )
                 return
             
-            # Since user reached here through ads link, consider verification successful
-            # Create new 24-hour token
-            self.refresh_user_token(db_user, token_data.get('token'))
+            # Only a link that passed the checks above loads (or creates) the user
+            db_user = await self.resolve_user(update.effective_user)
+            if db_user.id is None:
+                raise RuntimeError(f"user {update.effective_user.id} could not be loaded")
+            
+            if token_data['user_id'] == POOL_USER_ID:
+                # Pooled links only work for the user they were bound to when handed out
+                if not await self.db.run(redeem_pooled_token, db_user, token_data['token']):
+                    await self.outbound.call(
+                        context.bot.send_message,
+                        chat_id=update.effective_chat.id,
+                        text="❌ Invalid or expired verification link."
+                    )
+                    return
+            else:
+                # Since user reached here through ads link, consider verification successful
+                # Create new 24-hour token
+                await self.db.run(self.refresh_user_token, db_user, token_data['token'])
+            mark_link_used(token_data)
             
-            self.log_access(db_user, 'ads_verification')
+            await self.log_access(db_user, 'ads_verification')
             
-            await context.bot.send_message(
+            await self.outbound.call(
+                context.bot.send_message,
                 chat_id=update.effective_chat.id,
                 text=(
                     "✅ Ads completed successfully!\n\n"
@@ -470,24 +770,34 @@ class TelegramBotBundle:
                 
         except Exception as e:
             logger.error(f"Error in token verification: {e}")
-            await context.bot.send_message(
+            await self.outbound.call(
+                context.bot.send_message,
                 chat_id=update.effective_chat.id,
                 text="❌ Verification error. Please try again."
             )
 
-    async def send_token_refresh_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE, db_user: User):
+    @observe_handler
+    async def send_token_refresh_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE, db_user: CachedUser):
         """Send token refresh message with ads verification link"""
         try:
-            # Generate new token for ads verification
-            new_token = generate_secure_token()
-            
-            # Create verification deep link
-            verification_link = generate_token_link(self.bot_username, new_token, str(db_user.telegram_id))
-            
-            # Create ads link through LinkShortify API
-            ads_link = self.linkshortify.create_ads_verification_link(verification_link)
+            # Prefer a pre-generated link and bind its token to this user
+            pooled = self.link_pool.claim()
+            if pooled:
+                await self.db.run(bind_pending_token, db_user, pooled.token, self.link_claim_ttl)
+                ads_link = pooled.ads_link
+            else:
+                # Generate new token for ads verification
+                new_token = generate_link_token()
+                
+                # Create verification deep link
+                verification_link = generate_token_link(self.bot_username, new_token, str(db_user.telegram_id))
+                
+                # Create ads link through LinkShortify API
+                ads_link = await self.linkshortify.create_ads_verification_link(verification_link)
             
             if ads_link:
+                await self.log_access(db_user, 'token_refresh')
+                
                 keyboard = [
                     [InlineKeyboardButton("🔄 Click Here To Refresh Token", url=ads_link)]
                 ]
@@ -506,57 +816,68 @@ class TelegramBotBundle:
                     "This is an ads token. If you pass 1 ad, you can use the bot for 24 hour after passing the ad."
                 )
                 
-                await context.bot.send_message(
+                await self.outbound.call(
+                    context.bot.send_message,
                     chat_id=update.effective_chat.id,
                     text=message_text,
                     reply_markup=reply_markup
                 )
             else:
-                await context.bot.send_message(
+                await self.outbound.call(
+                    context.bot.send_message,
                     chat_id=update.effective_chat.id,
                     text="❌ Unable to generate ads link. Please try again later."
                 )
                 
         except Exception as e:
             logger.error(f"Error sending token refresh message: {e}")
-            await context.bot.send_message(
+            await self.outbound.call(
+                context.bot.send_message,
                 chat_id=update.effective_chat.id,
                 text="❌ Error generating verification link."
             )
 
+    @observe_handler
     async def handle_media_access(self, update: Update, context: ContextTypes.DEFAULT_TYPE,
-                                encoded_file_id: str, db_user: User):
-        """Handle individual media access from deep link (backward compatibility)"""
+                                encoded_file_id: str, db_user: CachedUser, compact: bool = False):
+        """Handle individual media access from deep link (f_<key> or the older base64 file id)"""
         try:
-            file_id = decode_file_id(encoded_file_id)
-            if not file_id:
-                await context.bot.send_message(
+            if compact:
+                file_ref = decode_compact_id('f', encoded_file_id)
+            else:
+                file_ref = decode_file_id(encoded_file_id)
+            if file_ref in (None, ''):
+                await self.outbound.call(
+                    context.bot.send_message,
                     chat_id=update.effective_chat.id,
                     text="❌ Invalid file link."
                 )
                 return
             
             # Find file
-            media_file = MediaFile.query.filter_by(file_id=file_id).first()
+            media_file = await self.db.run(self.get_media_file, file_ref)
             if not media_file:
-                await context.bot.send_message(
+                await self.outbound.call(
+                    context.bot.send_message,
                     chat_id=update.effective_chat.id,
                     text="❌ File not found."
                 )
                 return
             
             # Check if user has valid token
-            valid_token = self.get_valid_user_token(db_user)
+            valid_token = await self.lookup_valid_token(db_user)
             if valid_token:
                 # Send the file
                 await self.send_media_from_storage(context, update.effective_chat.id, media_file)
+                await self.log_access(db_user, 'file_access', media_file.id)
             else:
                 # User needs to get token through ads
                 await self.send_token_refresh_message(update, context, db_user)
                 
         except Exception as e:
             logger.error(f"Error handling media access: {e}")
-            await context.bot.send_message(
+            await self.outbound.call(
+                context.bot.send_message,
                 chat_id=update.effective_chat.id,
                 text="❌ Error accessing file."
             )
@@ -565,21 +886,24 @@ class TelegramBotBundle:
         """Send media file from storage channel"""
         try:
             if media_file.file_type == 'photo':
-                await context.bot.send_photo(
+                await self.outbound.call(
+                    context.bot.send_photo,
                     chat_id=chat_id,
                     photo=media_file.telegram_file_id,
                     caption=f"📁 {media_file.file_name}",
                     protect_content=True  # Prevents forwarding/copying
                 )
             elif media_file.file_type == 'video':
-                await context.bot.send_video(
+                await self.outbound.call(
+                    context.bot.send_video,
                     chat_id=chat_id,
                     video=media_file.telegram_file_id,
                     caption=f"📁 {media_file.file_name}",
                     protect_content=True  # Prevents forwarding/copying
                 )
             else:  # document, audio, voice, animation
-                await context.bot.send_document(
+                await self.outbound.call(
+                    context.bot.send_document,
                     chat_id=chat_id,
                     document=media_file.telegram_file_id,
                     caption=f"📁 {media_file.file_name}",
@@ -588,27 +912,32 @@ class TelegramBotBundle:
                 
         except Exception as e:
             logger.error(f"Error sending media: {e}")
-            await context.bot.send_message(
+            await self.outbound.call(
+                context.bot.send_message,
                 chat_id=chat_id,
                 text="❌ Error sending file."
             )
 
+    @observe_handler
     async def handle_text_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle text messages from users"""
         user_id = update.effective_user.id
         
-        if user_id in self.user_file_collections and self.user_file_collections[user_id]:
-            count = len(self.user_file_collections[user_id])
-            await context.bot.send_message(
+        count = await self.staging.count(user_id)
+        if count:
+            await self.outbound.call(
+                context.bot.send_message,
                 chat_id=update.effective_chat.id,
                 text=f"📦 You have {count} files in your collection.\n\nUse /done to create bundle or send more files."
             )
         else:
-            await context.bot.send_message(
+            await self.outbound.call(
+                context.bot.send_message,
                 chat_id=update.effective_chat.id,
                 text="Send me files to create a bundle!\n\nUse /help for instructions."
             )
 
+    @observe_handler
     async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Show help information"""
         help_text = (
@@ -628,15 +957,57 @@ class TelegramBotBundle:
             "• One token gives access to all shared content"
         )
         
-        await context.bot.send_message(
+        await self.outbound.call(
+            context.bot.send_message,
             chat_id=update.effective_chat.id,
             text=help_text
         )
 
+    async def profile_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Admin only: profile the next N updates with cProfile and tracemalloc"""
+        if not self.admin_id or str(update.effective_user.id) != self.admin_id:
+            return
+        chat_id = update.effective_chat.id
+        
+        try:
+            updates = int(context.args[0]) if context.args else 50
+        except ValueError:
+            updates = 0
+        if not 1 <= updates <= 10000:
+            await self.outbound.call(
+                context.bot.send_message,
+                chat_id=chat_id,
+                text="❌ Usage: /profile [number of updates, 1-10000]"
+            )
+            return
+        
+        async def report(path: str):
+            await self.outbound.call(
+                context.bot.send_message,
+                chat_id=chat_id,
+                text=f"📊 Profile of {updates} updates written to {path}"
+            )
+        
+        try:
+            self.profiler.start_capture(updates, on_done=report)
+        except RuntimeError:
+            await self.outbound.call(
+                context.bot.send_message,
+                chat_id=chat_id,
+                text="⏳ A profiling capture is already running."
+            )
+            return
+        
+        await self.outbound.call(
+            context.bot.send_message,
+            chat_id=chat_id,
+            text=f"🔬 Profiling the next {updates} updates..."
+        )
+
+    @observe_handler
     async def token_status_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Show user's token status"""
-        db_user = self.get_or_create_user(update.effective_user)
-        valid_token = self.get_valid_user_token(db_user)
+        db_user, valid_token = await self.resolve_user_token(update.effective_user)
         
         if valid_token:
             time_left = valid_token.expires_at - datetime.utcnow()
@@ -656,28 +1027,37 @@ class TelegramBotBundle:
                 f"⏱️ Tokens are valid for 24 hours"
             )
         
-        await context.bot.send_message(
+        await self.outbound.call(
+            context.bot.send_message,
             chat_id=update.effective_chat.id,
             text=status_text
         )
 
+    @observe_handler
     async def handle_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle inline keyboard callbacks"""
         query = update.callback_query
-        await query.answer()
-        
-        db_user = self.get_or_create_user(query.from_user)
+        await self.outbound.call(context.bot.answer_callback_query, callback_query_id=query.id)
         
+        # Pure menu navigation never touches the database; the user is only
+        # resolved by the branches that need it
         if query.data == "refresh_token":
             # Send proper ads verification message
-            await query.edit_message_text(
+            await self.outbound.call(
+                context.bot.edit_message_text,
+                chat_id=query.message.chat_id,
+                message_id=query.message.message_id,
                 text="🔄 Generating verification link...",
                 reply_markup=None
             )
+            db_user = await self.resolve_user(query.from_user)
             await self.send_token_refresh_message(update, context, db_user)
             
         elif query.data == "how_to_open":
-            await query.edit_message_text(
+            await self.outbound.call(
+                context.bot.edit_message_text,
+                chat_id=query.message.chat_id,
+                message_id=query.message.message_id,
                 text=(
                     "📚 How To Open Links:\n\n"
                     "1. Click on any shared bundle link\n"
@@ -693,7 +1073,7 @@ class TelegramBotBundle:
             )
             
         elif query.data == "token_status":
-            valid_token = self.get_valid_user_token(db_user)
+            db_user, valid_token = await self.resolve_user_token(query.from_user)
             
             if valid_token:
                 time_left = valid_token.expires_at - datetime.utcnow()
@@ -714,7 +1094,10 @@ class TelegramBotBundle:
                     f"⏱️ Tokens are valid for 24 hours"
                 )
             
-            await query.edit_message_text(
+            await self.outbound.call(
+                context.bot.edit_message_text,
+                chat_id=query.message.chat_id,
+                message_id=query.message.message_id,
                 text=status_text,
                 reply_markup=InlineKeyboardMarkup([
                     [InlineKeyboardButton("⬅️ Back", callback_data="back_to_start")]
@@ -722,7 +1105,10 @@ class TelegramBotBundle:
             )
             
         elif query.data == "main_channel":
-            await query.edit_message_text(
+            await self.outbound.call(
+                context.bot.edit_message_text,
+                chat_id=query.message.chat_id,
+                message_id=query.message.message_id,
                 text=(
                     "📢 MAIN CHANNEL\n\n"
                     "This is the main channel information.\n"
@@ -734,7 +1120,10 @@ class TelegramBotBundle:
             )
             
         elif query.data == "about_me":
-            await query.edit_message_text(
+            await self.outbound.call(
+                context.bot.edit_message_text,
+                chat_id=query.message.chat_id,
+                message_id=query.message.message_id,
                 text=(
                     "👤 About Me\n\n"
                     "🤖 I'm a file sharing bot\n"
@@ -750,7 +1139,10 @@ class TelegramBotBundle:
             )
             
         elif query.data == "close_menu":
-            await query.edit_message_text(
+            await self.outbound.call(
+                context.bot.edit_message_text,
+                chat_id=query.message.chat_id,
+                message_id=query.message.message_id,
                 text="Menu closed. Use /start to open again.",
                 reply_markup=None
             )
@@ -759,81 +1151,223 @@ class TelegramBotBundle:
             # Redirect back to start command
             await self.start_command(update, context)
 
-    def get_or_create_user(self, telegram_user) -> User:
-        """Get existing user or create new one"""
-        try:
-            # Rollback any pending transactions first
-            db.session.rollback()
-            
-            user = User.query.filter_by(telegram_id=str(telegram_user.id)).first()
-            
-            if not user:
-                user = User(
-                    telegram_id=str(telegram_user.id),
-                    username=telegram_user.username,
-                    first_name=telegram_user.first_name,
-                    last_name=telegram_user.last_name
-                )
-                db.session.add(user)
-                db.session.commit()
-                
-            return user
-        except Exception as e:
-            logger.error(f"Database error in get_or_create_user: {e}")
-            db.session.rollback()
-            # Return a basic user object for error cases
-            return User(
-                telegram_id=str(telegram_user.id),
-                username=telegram_user.username,
-                first_name=telegram_user.first_name,
-                last_name=telegram_user.last_name
-            )
+    @staticmethod
+    def _cache_token(user: CachedUser, valid_token: Optional[CachedToken]):
+        if valid_token:
+            token_cache.set_until(user.id, valid_token, valid_token.expires_at)
+        else:
+            token_cache.set(user.id, None)
 
-    def get_valid_user_token(self, user: User):
-        """Get user's valid (non-expired) token"""
+    @staticmethod
+    def _fallback_user(telegram_user) -> CachedUser:
+        """Unsaved user (id None) so handlers can still answer while the database is failing"""
+        return CachedUser(None, str(telegram_user.id), telegram_user.username,
+                          telegram_user.first_name, telegram_user.last_name)
+
+    async def resolve_user(self, telegram_user) -> CachedUser:
+        """Resolve the database user, hitting the DB only on an identity cache miss"""
+        user = user_cache.get(telegram_user.id)
+        if user is MISSING:
+            try:
+                user = await self.db.run(self.get_or_create_user, telegram_user)
+            except Exception as e:
+                logger.error(f"Database error resolving user {telegram_user.id}: {e}")
+                return self._fallback_user(telegram_user)
+            user_cache.set(telegram_user.id, user)
+        return user
+
+    async def resolve_user_token(self, telegram_user):
+        """Resolve (user, valid token) with at most one trip to the database pool"""
+        user = user_cache.get(telegram_user.id)
+        if user is not MISSING:
+            return user, await self.lookup_valid_token(user)
         try:
-            db.session.rollback()
-            return UserToken.query.filter_by(
-                user_id=user.id,
-                is_active=True
-            ).filter(
-                UserToken.expires_at > datetime.utcnow()
-            ).first()
+            user, valid_token = await self.db.run(self.get_user_with_token, telegram_user)
         except Exception as e:
-            logger.error(f"Database error in get_valid_user_token: {e}")
-            db.session.rollback()
+            logger.error(f"Database error resolving user {telegram_user.id}: {e}")
+            return self._fallback_user(telegram_user), None
+        # Cached only once the whole call succeeded
+        user_cache.set(telegram_user.id, user)
+        self._cache_token(user, valid_token)
+        return user, valid_token
+
+    async def lookup_valid_token(self, user: CachedUser) -> Optional[CachedToken]:
+        """Get the user's valid token, going to the database pool only on a cache miss"""
+        if user.id is None:
             return None
+        valid_token = token_cache.get(user.id)
+        if valid_token is MISSING:
+            try:
+                valid_token = await self.db.run(self.get_valid_user_token, user)
+            except Exception as e:
+                logger.error(f"Database error looking up token for user {user.id}: {e}")
+                return None
+            self._cache_token(user, valid_token)
+        return valid_token
 
-    def refresh_user_token(self, user: User, token_value: str = None):
-        """Create or refresh user's token"""
-        # Deactivate old tokens
-        old_tokens = UserToken.query.filter_by(user_id=user.id, is_active=True).all()
-        for token in old_tokens:
-            token.is_active = False
-        
-        # Create new token
-        new_token = UserToken(
-            user_id=user.id,
-            token=token_value or generate_secure_token(),
-            expires_at=create_token_expiry()
+    def get_user_with_token(self, telegram_user):
+        """Upsert the user and look up their valid token in the same session"""
+        user = self.get_or_create_user(telegram_user)
+        return user, self.get_valid_user_token(user)
+
+    def get_or_create_user(self, telegram_user) -> CachedUser:
+        """Get existing user or create new one with a single INSERT ... ON CONFLICT"""
+        stmt = dialect_insert(User).values(
+            telegram_id=str(telegram_user.id),
+            username=telegram_user.username,
+            first_name=telegram_user.first_name,
+            last_name=telegram_user.last_name
         )
-        db.session.add(new_token)
-        db.session.commit()
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[User.telegram_id],
+            set_={
+                'username': stmt.excluded.username,
+                'first_name': stmt.excluded.first_name,
+                'last_name': stmt.excluded.last_name
+            }
+        ).returning(User)
         
-        return new_token
+        user = db.session.scalars(stmt).one()
+        db.session.commit()
+        return snapshot_user(user)
 
-    def log_access(self, user: User, action: str, file_id: int = None):
-        """Log user access for analytics"""
-        log_entry = AccessLog(
+    def get_valid_user_token(self, user: CachedUser) -> Optional[CachedToken]:
+        """Get user's valid (non-expired) token"""
+        valid_token = UserToken.query.filter_by(
             user_id=user.id,
-            file_id=file_id,
-            action=action
+            is_active=True
+        ).filter(
+            UserToken.expires_at > datetime.utcnow()
+        ).first()
+        return snapshot_token(valid_token)
+
+    def refresh_user_token(self, user: CachedUser, token_value: str = None):
+        """Create or refresh user's token"""
+        return activate_user_token(user, token_value)
+
+    async def load_bundle_manifest(self, bundle_ref: Union[int, str]) -> Optional[BundleManifest]:
+        """Get a bundle's manifest, loading it from the database only once"""
+        manifest = manifest_cache.get(bundle_ref)
+        if manifest is MISSING:
+            manifest = await self.db.run(self.get_bundle_manifest, bundle_ref)
+            if manifest:
+                manifest_cache.set(bundle_ref, manifest)
+        return manifest
+
+    def get_bundle_manifest(self, bundle_ref: Union[int, str]) -> Optional[BundleManifest]:
+        """Load a bundle and its files with a single joined query, by bundle_key or legacy bundle_id"""
+        if isinstance(bundle_ref, int):
+            condition = FileBundle.bundle_key == bundle_ref
+        else:
+            condition = FileBundle.bundle_id == bundle_ref
+        rows = db.session.query(
+            FileBundle.bundle_id,
+            FileBundle.title,
+            FileBundle.created_at,
+            MediaFile.telegram_file_id,
+            MediaFile.file_type,
+            MediaFile.file_name
+        ).outerjoin(
+            MediaFile, MediaFile.bundle_key == FileBundle.bundle_key
+        ).filter(condition).order_by(MediaFile.id).all()
+        
+        if not rows:
+            return None
+        
+        files = tuple(
+            ManifestFile(row.telegram_file_id, row.file_type, row.file_name)
+            for row in rows if row.telegram_file_id is not None
         )
-        db.session.add(log_entry)
-        db.session.commit()
+        return BundleManifest(rows[0].bundle_id, rows[0].title, rows[0].created_at, files)
+
+    def get_media_file(self, file_ref: Union[int, str]) -> Optional[MediaFile]:
+        """Look up a single media file by its file_key or legacy public file_id"""
+        if isinstance(file_ref, int):
+            return MediaFile.query.filter_by(file_key=file_ref).first()
+        return MediaFile.query.filter_by(file_id=file_ref).first()
+
+    async def log_access(self, user: CachedUser, action: str, file_id: int = None):
+        """Log user access for analytics (buffered, written in bulk)"""
+        await self.access_log.log(user.id, action, file_id)
+
+    async def drop_duplicate_update(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Stop handling an update whose update_id was already processed"""
+        try:
+            first_seen = await self.deduplicator.first_seen(update.update_id)
+        except Exception as e:
+            # Better to risk a duplicate than to drop updates while the store is down
+            logger.error(f"Error checking update {update.update_id} for duplicates: {e}")
+            return
+        if not first_seen:
+            logger.info(f"Skipping duplicate update {update.update_id}")
+            raise ApplicationHandlerStop
+
+    async def purge_processed_updates(self, context: ContextTypes.DEFAULT_TYPE):
+        """Forget processed update_ids past the retention window"""
+        try:
+            removed = await self.deduplicator.purge()
+            if removed:
+                logger.info(f"Purged {removed} processed update ids")
+        except Exception as e:
+            logger.error(f"Error purging processed update ids: {e}")
+
+    async def renew_lease(self, context: ContextTypes.DEFAULT_TYPE):
+        """Keep the polling lease; stop polling as soon as it is lost"""
+        loop = asyncio.get_running_loop()
+        try:
+            if await self.lease.renew():
+                self.lease_renewed_at = loop.time()
+                return
+            logger.error("Leader lease taken over by another replica, stopping polling")
+        except Exception as e:
+            if loop.time() - self.lease_renewed_at < self.lease.ttl:
+                logger.warning(f"Error renewing leader lease, will retry: {e}")
+                return
+            logger.error(f"Leader lease expired while it could not be renewed, stopping polling: {e}")
+        context.application.stop_running()
 
     def run(self):
-        """Start the bot"""
+        """Start the bot with long polling (only while this replica holds the polling lease)"""
         logger.info(f"Starting Telegram bot @{self.bot_username}")
         logger.info(f"Storage Channel ID: {self.storage_channel_id}")
-        self.application.run_polling()
\ No newline at end of file
+        self.leader_required = True
+        try:
+            self.application.run_polling()
+        finally:
+            self.db.shutdown(wait=False)
+
+    async def start_webhook(self, webhook_url: str, secret_token: str = None):
+        """Start the bot on the caller's event loop and point Telegram at webhook_url"""
+        logger.info(f"Starting Telegram bot @{self.bot_username} in webhook mode")
+        # Collections are only shared through Redis; upload batches and /done state stay per replica
+        if not os.getenv('STAGING_REDIS_URL'):
+            if int(os.getenv('WEBHOOK_REPLICAS', 1)) > 1:
+                raise RuntimeError("Several webhook replicas need STAGING_REDIS_URL to share admin upload collections")
+            logger.warning("Upload collections are staged on this replica only, "
+                           "set STAGING_REDIS_URL before running more than one webhook replica")
+        # Any replica behind the load balancer may receive a redelivered update
+        self.deduplicator = create_deduplicator(self.db, shared=True)
+        await self.application.initialize()
+        await self.post_init(self.application)
+        await self.application.start()
+        await self.application.bot.set_webhook(
+            url=webhook_url,
+            secret_token=secret_token,
+            allowed_updates=Update.ALL_TYPES
+        )
+        logger.info(f"Webhook set to {webhook_url}")
+
+    async def stop_webhook(self):
+        """Stop processing updates and drain background services (the webhook itself stays set)"""
+        try:
+            await self.application.stop()
+            await self.post_stop(self.application)
+            await self.application.shutdown()
+            await self.post_shutdown(self.application)
+        finally:
+            self.db.shutdown(wait=False)
+
+    async def enqueue_webhook_update(self, data: dict):
+        """Hand a webhook payload to the application's update queue"""
+        update = Update.de_json(data, self.application.bot)
+        await self.application.update_queue.put(update)
\ No newline at end of file
@@ -0,0 +1,95 @@
+import os
+import uuid
+import logging
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+from database import dialect_insert
+from models import db, FileBundle, MediaFile
+from utils import generate_unique_bundle_id, compact_key
+
+logger = logging.getLogger(__name__)
+
+# Namespace for deterministic media file ids (bundle id + position in the collection)
+FILE_ID_NAMESPACE = uuid.UUID('6f1c3f52-4b8e-4f0a-9d57-2a61d7e0c1b4')
+
+
+def staged_file_id(bundle_id: str, position: int) -> str:
+    """Stable file id for the file at position in a bundle, so re-running a finalize never duplicates rows"""
+    return str(uuid.uuid5(FILE_ID_NAMESPACE, f"{bundle_id}:{position}"))
+
+
+class BundleFinalizer:
+    """Turns a staged collection into a bundle with chunked bulk inserts.
+
+    The bundle id is reserved in the staging store before anything is written
+    and every file id is derived from it, so all inserts are idempotent
+    (ON CONFLICT DO NOTHING). If the process dies halfway, running /done again
+    finishes the same bundle instead of starting a new one. Each chunk is its
+    own short transaction on the database thread pool.
+    """
+
+    def __init__(self, database, staging, chunk_size: int = None):
+        self.database = database
+        self.staging = staging
+        self.chunk_size = chunk_size or int(os.getenv('FINALIZE_CHUNK_SIZE', 500))
+
+    async def finalize(self, admin_id, created_by: int, collection: List[Dict[str, Any]],
+                       progress: Optional[Callable[[int, int], Awaitable]] = None) -> int:
+        """Persist the collection as a bundle and return its bundle key (for the deep link)"""
+        bundle_id = await self.staging.reserve_bundle_id(admin_id, generate_unique_bundle_id())
+        bundle_key = compact_key(bundle_id)
+        await self.database.run(self._upsert_bundle, bundle_id, bundle_key, created_by, len(collection))
+
+        total = len(collection)
+        for start in range(0, total, self.chunk_size):
+            chunk = collection[start:start + self.chunk_size]
+            rows = []
+            for offset, file_info in enumerate(chunk):
+                file_id = staged_file_id(bundle_id, start + offset)
+                rows.append({
+                    'file_id': file_id,
+                    'file_key': compact_key(file_id),
+                    'bundle_id': bundle_id,
+                    'bundle_key': bundle_key,
+                    'file_name': file_info['file_name'],
+                    'file_type': file_info['file_type'],
+                    'file_size': file_info['file_size'],
+                    'telegram_file_id': file_info['telegram_file_id'],
+                    'uploaded_by': created_by,
+                    'description': file_info['caption']
+                })
+            await self.database.run(self._insert_files, rows)
+            if progress:
+                await progress(start + len(chunk), total)
+
+        logger.info(f"Finalized bundle {bundle_id} with {total} files")
+        return bundle_key
+
+    @staticmethod
+    def _upsert_bundle(bundle_id: str, bundle_key: int, created_by: int, file_count: int):
+        now = datetime.utcnow()
+        stmt = dialect_insert(FileBundle).values(
+            bundle_id=bundle_id,
+            bundle_key=bundle_key,
+            created_by=created_by,
+            created_at=now,
+            title=f"Bundle {file_count} files",
+            description=f"Bundle created on {now.strftime('%Y-%m-%d %H:%M')}"
+        )
+        # A resumed finalize may have more files than the first attempt
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[FileBundle.bundle_id],
+            set_={'title': stmt.excluded.title}
+        )
+        db.session.execute(stmt)
+        db.session.commit()
+
+    @staticmethod
+    def _insert_files(rows: List[Dict[str, Any]]):
+        now = datetime.utcnow()
+        for row in rows:
+            row['uploaded_at'] = now
+        stmt = dialect_insert(MediaFile).on_conflict_do_nothing(index_elements=[MediaFile.file_id])
+        # executemany form: SQLAlchemy batches it into multi-row INSERTs within driver parameter limits
+        db.session.execute(stmt, rows)
+        db.session.commit()
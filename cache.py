@@ -0,0 +1,131 @@
+import os
+import time
+import threading
+from collections import OrderedDict, namedtuple
+from datetime import datetime
+from typing import Any, Dict, Hashable, Optional
+
+# Sentinel for "not cached", so None can be cached as a real (negative) answer
+MISSING = object()
+
+# Plain copies of rows kept in the caches instead of ORM instances, so a cached entry
+# never depends on (or is expired by) the session that loaded it
+CachedUser = namedtuple('CachedUser', ['id', 'telegram_id', 'username', 'first_name', 'last_name'])
+CachedToken = namedtuple('CachedToken', ['token', 'expires_at'])
+
+
+def snapshot_user(user) -> CachedUser:
+    return CachedUser(user.id, user.telegram_id, user.username, user.first_name, user.last_name)
+
+
+def snapshot_token(token) -> Optional[CachedToken]:
+    return CachedToken(token.token, token.expires_at) if token is not None else None
+
+
+class TTLCache:
+    """Bounded, thread-safe LRU cache where every entry carries its own deadline.
+
+    Shared by the bot's database worker threads and the Flask request threads,
+    hence the lock around every operation.
+    """
+
+    def __init__(self, maxsize: int = 10000, default_ttl: Optional[float] = None, name: str = "cache"):
+        self.maxsize = maxsize
+        self.default_ttl = default_ttl
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = MISSING) -> Any:
+        """Return the cached value, or default if missing or expired"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, deadline = entry
+                if deadline is None or deadline > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        """Store a value for ttl seconds (default_ttl if omitted, forever if both are None)"""
+        ttl = self.default_ttl if ttl is None else ttl
+        if ttl is not None and ttl <= 0:
+            self.invalidate(key)
+            return
+        deadline = time.monotonic() + ttl if ttl is not None else None
+        with self._lock:
+            self._data[key] = (value, deadline)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def set_until(self, key: Hashable, value: Any, expires_at: datetime):
+        """Store a value until a naive UTC datetime, e.g. a token's expires_at"""
+        self.set(key, value, ttl=(expires_at - datetime.utcnow()).total_seconds())
+
+    def invalidate(self, key: Hashable):
+        """Drop a single entry"""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """Drop every entry"""
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit/miss counters for monitoring"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'name': self.name,
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0
+            }
+
+
+# Active token per users.id. Positive entries live until the token's expires_at,
+# "no token" answers only briefly in case another process refreshed it.
+token_cache = TTLCache(
+    maxsize=int(os.getenv('TOKEN_CACHE_SIZE', 50000)),
+    default_ttl=float(os.getenv('TOKEN_CACHE_NEGATIVE_TTL', 30)),
+    name='user_tokens'
+)
+
+# users rows per Telegram user id, so menu navigation doesn't re-upsert the user
+user_cache = TTLCache(
+    maxsize=int(os.getenv('USER_CACHE_SIZE', 50000)),
+    default_ttl=float(os.getenv('USER_CACHE_TTL', 300)),
+    name='users'
+)
+
+# Bundle manifests by bundle_key (or legacy bundle_id string). Bundles are immutable, so entries only leave by LRU.
+manifest_cache = TTLCache(
+    maxsize=int(os.getenv('BUNDLE_CACHE_SIZE', 2000)),
+    name='bundle_manifests'
+)
+
+# Verification link tokens already redeemed in this process, kept until the link expires
+used_link_cache = TTLCache(
+    maxsize=int(os.getenv('USED_LINK_CACHE_SIZE', 50000)),
+    name='used_links'
+)
+
+# Deep-link parameters that didn't resolve to a bundle, so scanners can't hammer the DB
+missing_bundle_cache = TTLCache(
+    maxsize=int(os.getenv('MISSING_BUNDLE_CACHE_SIZE', 20000)),
+    default_ttl=float(os.getenv('MISSING_BUNDLE_CACHE_TTL', 600)),
+    name='missing_bundles'
+)
@@ -0,0 +1,112 @@
+import os
+import time
+import logging
+from collections import deque
+from typing import Any, Dict
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitBreaker:
+    """Error-rate and latency circuit breaker for an external dependency.
+
+    Outcomes of recent calls are kept in a sliding time window; calls slower than
+    slow_call_threshold count as failures. When the failure rate over at least
+    min_calls calls reaches failure_rate_threshold the breaker opens and callers
+    skip the dependency. After open_duration it goes half-open and lets a few
+    probe calls through: a successful probe closes it, a failed one reopens it.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name: str, failure_rate_threshold: float = None, slow_call_threshold: float = None,
+                 min_calls: int = None, window: float = None, open_duration: float = None,
+                 half_open_probes: int = 1):
+        self.name = name
+        self.failure_rate_threshold = failure_rate_threshold or float(os.getenv('BREAKER_FAILURE_RATE', 0.5))
+        self.slow_call_threshold = slow_call_threshold or float(os.getenv('BREAKER_SLOW_CALL_SECONDS', 3))
+        self.min_calls = min_calls or int(os.getenv('BREAKER_MIN_CALLS', 5))
+        self.window = window or float(os.getenv('BREAKER_WINDOW_SECONDS', 60))
+        self.open_duration = open_duration or float(os.getenv('BREAKER_OPEN_SECONDS', 30))
+        self.half_open_probes = half_open_probes
+        self.state = self.CLOSED
+        self.opened_at = 0.0
+        self.probes_in_flight = 0
+        self.outcomes: "deque[tuple]" = deque()
+        self.times_opened = 0
+        self.short_circuited = 0
+
+    def _transition(self, state: str):
+        if state != self.state:
+            logger.warning(f"Circuit breaker '{self.name}' {self.state} -> {state}")
+            self.state = state
+
+    def _trim(self, now: float):
+        while self.outcomes and self.outcomes[0][0] < now - self.window:
+            self.outcomes.popleft()
+
+    @property
+    def is_open(self) -> bool:
+        """True while calls should skip the dependency (does not consume a probe)"""
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.open_duration:
+            self._transition(self.HALF_OPEN)
+            self.probes_in_flight = 0
+        return self.state == self.OPEN or (
+            self.state == self.HALF_OPEN and self.probes_in_flight >= self.half_open_probes
+        )
+
+    def allow_request(self) -> bool:
+        """Ask permission for one call; in half-open state this reserves a probe"""
+        if self.is_open:
+            self.short_circuited += 1
+            return False
+        if self.state == self.HALF_OPEN:
+            self.probes_in_flight += 1
+        return True
+
+    def record_success(self, latency: float):
+        """Record a completed call; slow calls count as failures"""
+        if latency > self.slow_call_threshold:
+            self.record_failure()
+            return
+        if self.state == self.HALF_OPEN:
+            self._transition(self.CLOSED)
+            self.outcomes.clear()
+        self._record(True)
+
+    def record_failure(self):
+        """Record a failed or timed-out call"""
+        if self.state == self.HALF_OPEN:
+            self._open()
+            return
+        self._record(False)
+        failures = sum(1 for _, ok in self.outcomes if not ok)
+        if (self.state == self.CLOSED and len(self.outcomes) >= self.min_calls
+                and failures / len(self.outcomes) >= self.failure_rate_threshold):
+            self._open()
+
+    def _record(self, ok: bool):
+        now = time.monotonic()
+        self.outcomes.append((now, ok))
+        self._trim(now)
+
+    def _open(self):
+        self._transition(self.OPEN)
+        self.opened_at = time.monotonic()
+        self.probes_in_flight = 0
+        self.times_opened += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """Current state and counters for monitoring"""
+        self._trim(time.monotonic())
+        failures = sum(1 for _, ok in self.outcomes if not ok)
+        return {
+            'name': self.name,
+            'state': self.state,
+            'recent_calls': len(self.outcomes),
+            'recent_failures': failures,
+            'times_opened': self.times_opened,
+            'short_circuited': self.short_circuited
+        }
@@ -0,0 +1,246 @@
+"""
+Coordination between bot replicas.
+
+A leader lease makes sure only one replica long-polls Telegram at a time (the
+others wait and take over when the lease lapses), and the update deduplicator
+makes every update_id get handled once even if Telegram redelivers it or two
+replicas receive it. The lease is backed by the database by default, or by Redis
+when COORDINATION_REDIS_URL is set. Deduplication only needs shared storage when
+several replicas can receive updates (webhook mode) or Redis is configured
+anyway; a single poller holding the lease just remembers recent update_ids in
+memory.
+"""
+import os
+import uuid
+import socket
+import asyncio
+import logging
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from sqlalchemy import or_
+from database import dialect_insert
+from models import db, BotLease, ProcessedUpdate
+
+logger = logging.getLogger(__name__)
+
+
+def replica_id() -> str:
+    """Identity of this process in lease records"""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class LeaderLease:
+    """A named, time-limited lock that one replica holds and keeps renewing"""
+
+    def __init__(self, name: str = 'telegram-poller', ttl: float = None):
+        self.name = name
+        self.ttl = ttl or float(os.getenv('LEADER_LEASE_TTL', 30))
+        self.holder = replica_id()
+
+    async def acquire(self) -> bool:
+        """Take the lease if it is free or already ours; True if we hold it afterwards"""
+        raise NotImplementedError
+
+    async def renew(self) -> bool:
+        """Extend our lease; False if somebody else holds it now"""
+        return await self.acquire()
+
+    async def release(self):
+        """Give the lease up so a standby can take over immediately"""
+        raise NotImplementedError
+
+    async def wait_until_acquired(self, retry_interval: float = None):
+        """Block until this replica is the leader"""
+        retry_interval = retry_interval or self.ttl / 3
+        announced = False
+        while not await self.acquire():
+            if not announced:
+                logger.info(f"Lease '{self.name}' is held by another replica, waiting as standby")
+                announced = True
+            await asyncio.sleep(retry_interval)
+        logger.info(f"Acquired lease '{self.name}' as {self.holder}")
+
+
+class DatabaseLease(LeaderLease):
+    """Lease stored as a row in bot_leases"""
+
+    def __init__(self, database, **kwargs):
+        super().__init__(**kwargs)
+        self.database = database
+
+    def _acquire(self) -> bool:
+        now = datetime.utcnow()
+        stmt = dialect_insert(BotLease).values(
+            name=self.name, holder=self.holder, expires_at=now + timedelta(seconds=self.ttl)
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[BotLease.name],
+            set_={'holder': stmt.excluded.holder, 'expires_at': stmt.excluded.expires_at},
+            where=or_(BotLease.expires_at < now, BotLease.holder == self.holder)
+        )
+        db.session.execute(stmt)
+        db.session.commit()
+        holder = db.session.execute(
+            db.select(BotLease.holder).where(BotLease.name == self.name)
+        ).scalar_one()
+        return holder == self.holder
+
+    def _release(self):
+        db.session.execute(
+            db.delete(BotLease).where(BotLease.name == self.name, BotLease.holder == self.holder)
+        )
+        db.session.commit()
+
+    async def acquire(self) -> bool:
+        return await self.database.run(self._acquire)
+
+    async def release(self):
+        await self.database.run(self._release)
+
+
+class RedisLease(LeaderLease):
+    """Lease stored as a Redis key with a TTL"""
+
+    # Extend the key's TTL only if we still own it
+    RENEW_SCRIPT = """
+    if redis.call('GET', KEYS[1]) == ARGV[1] then
+        return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+    end
+    return 0
+    """
+
+    RELEASE_SCRIPT = """
+    if redis.call('GET', KEYS[1]) == ARGV[1] then
+        return redis.call('DEL', KEYS[1])
+    end
+    return 0
+    """
+
+    def __init__(self, redis, **kwargs):
+        super().__init__(**kwargs)
+        self.redis = redis
+        self.key = f"lease:{self.name}"
+        self._renew = redis.register_script(self.RENEW_SCRIPT)
+        self._release = redis.register_script(self.RELEASE_SCRIPT)
+
+    async def acquire(self) -> bool:
+        if await self.redis.set(self.key, self.holder, nx=True, px=int(self.ttl * 1000)):
+            return True
+        return await self.renew()
+
+    async def renew(self) -> bool:
+        return bool(await self._renew(keys=[self.key], args=[self.holder, int(self.ttl * 1000)]))
+
+    async def release(self):
+        await self._release(keys=[self.key], args=[self.holder])
+
+
+class UpdateDeduplicator:
+    """Remembers processed update_ids for retention seconds"""
+
+    def __init__(self, retention: float = None):
+        self.retention = retention or float(os.getenv('UPDATE_DEDUP_RETENTION', 24 * 3600))
+        self.duplicates = 0
+
+    async def first_seen(self, update_id: int) -> bool:
+        """Record update_id; True the first time it is seen, False for a duplicate"""
+        raise NotImplementedError
+
+    async def purge(self) -> int:
+        """Forget update_ids older than the retention window"""
+        return 0
+
+
+class MemoryDeduplicator(UpdateDeduplicator):
+    """The last `window` update_ids seen by this process"""
+
+    def __init__(self, window: int = None, **kwargs):
+        super().__init__(**kwargs)
+        self.window = window or int(os.getenv('UPDATE_DEDUP_WINDOW', 10000))
+        self.seen: "OrderedDict[int, None]" = OrderedDict()
+
+    async def first_seen(self, update_id: int) -> bool:
+        if update_id in self.seen:
+            self.duplicates += 1
+            return False
+        self.seen[update_id] = None
+        while len(self.seen) > self.window:
+            self.seen.popitem(last=False)
+        return True
+
+
+class DatabaseDeduplicator(UpdateDeduplicator):
+    """Processed update_ids kept in processed_updates"""
+
+    def __init__(self, database, **kwargs):
+        super().__init__(**kwargs)
+        self.database = database
+
+    @staticmethod
+    def _record(update_id: int) -> bool:
+        stmt = dialect_insert(ProcessedUpdate).values(
+            update_id=update_id, processed_at=datetime.utcnow()
+        ).on_conflict_do_nothing(index_elements=[ProcessedUpdate.update_id])
+        inserted = db.session.execute(stmt).rowcount
+        db.session.commit()
+        return inserted == 1
+
+    def _purge(self) -> int:
+        cutoff = datetime.utcnow() - timedelta(seconds=self.retention)
+        removed = db.session.execute(
+            db.delete(ProcessedUpdate).where(ProcessedUpdate.processed_at < cutoff)
+        ).rowcount
+        db.session.commit()
+        return removed
+
+    async def first_seen(self, update_id: int) -> bool:
+        if await self.database.run(self._record, update_id):
+            return True
+        self.duplicates += 1
+        return False
+
+    async def purge(self) -> int:
+        return await self.database.run(self._purge)
+
+
+class RedisDeduplicator(UpdateDeduplicator):
+    """Processed update_ids kept as expiring Redis keys"""
+
+    def __init__(self, redis, **kwargs):
+        super().__init__(**kwargs)
+        self.redis = redis
+
+    async def first_seen(self, update_id: int) -> bool:
+        if await self.redis.set(f"update:{update_id}", 1, nx=True, ex=int(self.retention)):
+            return True
+        self.duplicates += 1
+        return False
+
+
+def _redis_client():
+    url = os.getenv('COORDINATION_REDIS_URL')
+    if not url:
+        return None
+    try:
+        import redis.asyncio as redis_asyncio
+    except ImportError:
+        raise RuntimeError("COORDINATION_REDIS_URL requires the 'redis' package (pip install redis)")
+    return redis_asyncio.from_url(url)
+
+
+def create_lease(database) -> LeaderLease:
+    """Redis-backed lease when COORDINATION_REDIS_URL is set, otherwise database-backed"""
+    redis = _redis_client()
+    if redis is not None:
+        return RedisLease(redis)
+    return DatabaseLease(database)
+
+
+def create_deduplicator(database, shared: bool) -> UpdateDeduplicator:
+    """Redis when configured, the database when replicas share updates (shared), otherwise in-memory"""
+    redis = _redis_client()
+    if redis is not None:
+        return RedisDeduplicator(redis)
+    if shared:
+        return DatabaseDeduplicator(database)
+    return MemoryDeduplicator()
@@ -0,0 +1,163 @@
+import os
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from functools import wraps
+from typing import Any, Callable, Optional
+from sqlalchemy import event
+from sqlalchemy.dialects import postgresql, sqlite
+from models import db
+from profiling import timed
+
+logger = logging.getLogger(__name__)
+
+
+def _env_flag(name: str, default: str) -> bool:
+    return os.getenv(name, default).lower() in ('1', 'true', 'yes', 'on')
+
+
+def engine_options(database_uri: str) -> dict:
+    """SQLALCHEMY_ENGINE_OPTIONS from the DB_POOL_* environment variables"""
+    options = {
+        'pool_pre_ping': _env_flag('DB_POOL_PRE_PING', 'true'),
+        'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', 1800)),
+    }
+    # In-memory SQLite uses a single shared connection, which has no pool to size
+    if database_uri not in ('sqlite://', 'sqlite:///:memory:'):
+        options.update(
+            # Enough for every bot database thread plus the web server's threads
+            pool_size=int(os.getenv('DB_POOL_SIZE', 10)),
+            max_overflow=int(os.getenv('DB_MAX_OVERFLOW', 10)),
+            pool_timeout=float(os.getenv('DB_POOL_TIMEOUT', 30)),
+        )
+    return options
+
+
+def configure_sqlite(engine):
+    """Put SQLite connections in WAL mode with a busy timeout so readers don't block on writers"""
+    if engine.dialect.name != 'sqlite':
+        return
+    journal_mode = os.getenv('SQLITE_JOURNAL_MODE', 'WAL')
+    busy_timeout = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', 5000))
+    synchronous = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')
+
+    @event.listens_for(engine, 'connect')
+    def _set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute(f"PRAGMA journal_mode={journal_mode}")
+            cursor.execute(f"PRAGMA busy_timeout={busy_timeout}")
+            cursor.execute(f"PRAGMA synchronous={synchronous}")
+        finally:
+            cursor.close()
+
+
+def dialect_insert(model):
+    """Return an INSERT construct for the bound dialect that supports ON CONFLICT"""
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        return postgresql.insert(model)
+    if dialect == 'sqlite':
+        return sqlite.insert(model)
+    raise NotImplementedError(f"ON CONFLICT inserts are not supported on {dialect}")
+
+
+class UpdateSession:
+    """One SQLAlchemy session shared by the database calls made while handling an update"""
+
+    def __init__(self):
+        self.session = None
+        # Calls from one update (or tasks it spawned) never use the session concurrently
+        self.lock = asyncio.Lock()
+        self.closed = False
+
+
+_update_session: ContextVar[Optional[UpdateSession]] = ContextVar('update_session', default=None)
+
+
+class AsyncDatabase:
+    """Run blocking Flask-SQLAlchemy work on a bounded thread pool.
+
+    Every call gets its own application context. Inside a handler wrapped with
+    per_update() the calls share one session for the whole update; elsewhere
+    (jobs, background tasks outliving their update) Flask-SQLAlchemy hands each
+    call a fresh session which is removed again when the context is torn down.
+    """
+
+    def __init__(self, app, max_workers: Optional[int] = None):
+        self.app = app
+        self.max_workers = max_workers or int(os.getenv('DB_POOL_WORKERS', 8))
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.max_workers,
+            thread_name_prefix='db'
+        )
+
+    def _call(self, scope: Optional[UpdateSession], fn: Callable, *args, **kwargs) -> Any:
+        """Execute fn inside a short-lived app context, on the update's session if there is one"""
+        with self.app.app_context():
+            if scope is None:
+                try:
+                    return fn(*args, **kwargs)
+                except Exception:
+                    db.session.rollback()
+                    raise
+
+            if scope.session is None:
+                scope.session = db.session.session_factory()
+            session = scope.session
+            db.session.registry.set(session)
+            try:
+                result = fn(*args, **kwargs)
+                # End the transaction so the connection goes back to the pool while the
+                # handler awaits Telegram; loaded rows stay usable (expire_on_commit=False)
+                if session.in_transaction():
+                    session.commit()
+                return result
+            except Exception:
+                # close() rather than rollback() so objects handed out earlier aren't expired
+                session.close()
+                raise
+            finally:
+                # Detach it so the context teardown doesn't close the update's session
+                db.session.registry.clear()
+
+    async def _submit(self, scope: Optional[UpdateSession], fn: Callable, args, kwargs) -> Any:
+        loop = asyncio.get_running_loop()
+        with timed('db'):
+            return await loop.run_in_executor(
+                self.executor,
+                lambda: self._call(scope, fn, *args, **kwargs)
+            )
+
+    async def run(self, fn: Callable, *args, **kwargs) -> Any:
+        """Await a blocking database function without stalling the event loop"""
+        scope = _update_session.get()
+        if scope is not None and not scope.closed:
+            async with scope.lock:
+                if not scope.closed:
+                    return await self._submit(scope, fn, args, kwargs)
+        return await self._submit(None, fn, args, kwargs)
+
+    def per_update(self, handler):
+        """Wrap a handler so its database calls share one session, closed when it returns"""
+
+        @wraps(handler)
+        async def wrapper(update, context):
+            scope = UpdateSession()
+            token = _update_session.set(scope)
+            try:
+                return await handler(update, context)
+            finally:
+                _update_session.reset(token)
+                # Tasks spawned by the handler inherit the scope; from now on they get their own sessions
+                scope.closed = True
+                async with scope.lock:
+                    if scope.session is not None:
+                        await asyncio.get_running_loop().run_in_executor(self.executor, scope.session.close)
+
+        return wrapper
+
+    def shutdown(self, wait: bool = True):
+        """Stop accepting new work and release the worker threads"""
+        self.executor.shutdown(wait=wait)
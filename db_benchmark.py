@@ -0,0 +1,289 @@
+"""
+Database micro-benchmark for the queries the bot issues on its hot paths.
+
+Seeds the models.py schema (plus migrations) with realistic volumes, then times
+the bot's own query functions, each call in a fresh application context just
+like AsyncDatabase does, with the in-process caches cleared so every call
+reaches the database:
+
+    get_or_create_user      upsert of an existing user / of a new user
+    get_valid_user_token    active-token lookup
+    refresh_user_token      deactivate old tokens + activate a new one
+    get_bundle_manifest     bundle + files join, by bundle_key and by legacy bundle_id
+    get_media_file          single file by file_key and by legacy file_id
+    log_access              AccessLogWriter bulk insert (1 row and a 500-row batch)
+
+--scale 1.0 means 1M users, 10M tokens, 100k bundles and 2M media files; the
+default 0.01 seeds in seconds on SQLite. Runs against a fresh SQLite file,
+plus Postgres when --postgres-url (or BENCH_POSTGRES_URL) points at a reachable
+server; that database should be empty, its tables are dropped and recreated.
+
+    python db_benchmark.py --scale 0.1 --output db_benchmark.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import statistics
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from flask import Flask
+from sqlalchemy import create_engine, insert, select, func
+from models import db, User, UserToken, FileBundle, MediaFile
+from migrations import run_migrations
+from database import engine_options, configure_sqlite
+from cache import token_cache, user_cache
+from bundle_finalizer import staged_file_id
+from utils import compact_key
+from access_log import AccessLogWriter
+from explain_queries import hot_queries, explain
+
+FULL_SCALE = {'users': 1_000_000, 'tokens': 10_000_000, 'bundles': 100_000, 'media_files': 2_000_000}
+SEED_CHUNK = 10_000
+TELEGRAM_ID_BASE = 100_000_000
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', type=float, default=0.01, help='fraction of the full data volume to seed')
+    parser.add_argument('--iterations', type=int, default=500, help='timed calls per query')
+    parser.add_argument('--postgres-url', default=os.getenv('BENCH_POSTGRES_URL'),
+                        help='also benchmark this Postgres database (it is wiped)')
+    parser.add_argument('--sqlite-path', help='SQLite file to use (default: a temporary file)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default='db_benchmark.json', help='where to write the JSON results')
+    return parser.parse_args()
+
+
+def volumes(scale: float) -> dict:
+    return {name: max(1, int(count * scale)) for name, count in FULL_SCALE.items()}
+
+
+def make_app(database_url: str) -> Flask:
+    app = Flask('db_benchmark')
+    app.config['SQLALCHEMY_DATABASE_URI'] = database_url
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(database_url)
+    db.init_app(app)
+    with app.app_context():
+        configure_sqlite(db.engine)
+    return app
+
+
+def insert_chunked(table, rows):
+    """Bulk insert an iterator of row dicts in SEED_CHUNK batches"""
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= SEED_CHUNK:
+            db.session.execute(insert(table), chunk)
+            chunk = []
+    if chunk:
+        db.session.execute(insert(table), chunk)
+    db.session.commit()
+
+
+def seed(app: Flask, counts: dict, rng: random.Random):
+    """Recreate the schema and fill it with counts rows per table"""
+    now = datetime.utcnow()
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        run_migrations(db.engine)
+
+        started = time.perf_counter()
+        insert_chunked(User, (
+            {'telegram_id': str(TELEGRAM_ID_BASE + i), 'username': f'user{i}', 'first_name': f'User {i}',
+             'created_at': now - timedelta(days=rng.random() * 365)}
+            for i in range(counts['users'])
+        ))
+
+        # Every user has a history of expired tokens; ~60% also hold a live one
+        per_user = max(1, counts['tokens'] // counts['users'])
+
+        def tokens():
+            for user_id in range(1, counts['users'] + 1):
+                live = rng.random() < 0.6
+                for n in range(per_user):
+                    current = live and n == per_user - 1
+                    expires = now + timedelta(hours=rng.random() * 24) if current else \
+                        now - timedelta(days=rng.random() * 30)
+                    yield {'user_id': user_id, 'token': f'bench-{user_id}-{n}', 'created_at': expires - timedelta(hours=24),
+                           'expires_at': expires, 'is_active': current}
+        insert_chunked(UserToken, tokens())
+
+        insert_chunked(FileBundle, (
+            {'bundle_id': f'bundle_bench_{i}', 'bundle_key': compact_key(f'bundle_bench_{i}'), 'created_by': 1,
+             'title': f'Bundle {i}', 'created_at': now}
+            for i in range(counts['bundles'])
+        ))
+
+        per_bundle = max(1, counts['media_files'] // counts['bundles'])
+        kinds = ('photo', 'video', 'document', 'audio')
+
+        def media_files():
+            for b in range(counts['bundles']):
+                bundle_id = f'bundle_bench_{b}'
+                for n in range(per_bundle):
+                    file_id = staged_file_id(bundle_id, n)
+                    yield {'file_id': file_id, 'file_key': compact_key(file_id), 'bundle_id': bundle_id,
+                           'bundle_key': compact_key(bundle_id), 'file_name': f'file_{n}',
+                           'file_type': kinds[(b + n) % len(kinds)], 'file_size': 1024 * (n + 1),
+                           'telegram_file_id': f'FILE-{b}-{n}', 'uploaded_by': 1, 'uploaded_at': now}
+        insert_chunked(MediaFile, media_files())
+
+        # Fresh planner statistics, as a long-running database would have
+        db.session.execute(db.text('ANALYZE'))
+        db.session.commit()
+        elapsed = time.perf_counter() - started
+        seeded = {model.__tablename__: db.session.scalar(select(func.count()).select_from(model))
+                  for model in (User, UserToken, FileBundle, MediaFile)}
+    return seeded, elapsed
+
+
+def summarize(samples: list) -> dict:
+    samples = sorted(samples)
+    pick = lambda pct: samples[min(len(samples) - 1, max(0, round(pct / 100 * len(samples)) - 1))]
+    return {
+        'calls': len(samples),
+        'mean_ms': round(statistics.fmean(samples) * 1000, 3),
+        'p50_ms': round(pick(50) * 1000, 3),
+        'p95_ms': round(pick(95) * 1000, 3),
+        'p99_ms': round(pick(99) * 1000, 3),
+        'max_ms': round(samples[-1] * 1000, 3)
+    }
+
+
+def timed_calls(app: Flask, iterations: int, fn, make_args) -> dict:
+    """Call fn(*make_args()) iterations times, each in its own app context, caches cleared"""
+    samples = []
+    for _ in range(iterations):
+        args = make_args()
+        token_cache.clear()
+        user_cache.clear()
+        with app.app_context():
+            started = time.perf_counter()
+            fn(*args)
+            samples.append(time.perf_counter() - started)
+    return summarize(samples)
+
+
+def run_queries(app: Flask, counts: dict, iterations: int, rng: random.Random) -> dict:
+    # An instance without __init__: the query methods only touch the database and the caches
+    from bot_bundle import TelegramBotBundle
+    bot = TelegramBotBundle.__new__(TelegramBotBundle)
+
+    with app.app_context():
+        sample_ids = [rng.randint(1, counts['users']) for _ in range(iterations)]
+        users = {user.id: user for user in db.session.scalars(select(User).where(User.id.in_(set(sample_ids))))}
+    per_bundle = max(1, counts['media_files'] // counts['bundles'])
+    new_users = iter(range(TELEGRAM_ID_BASE + counts['users'], TELEGRAM_ID_BASE + counts['users'] + iterations))
+
+    def existing_tg_user():
+        user = users[rng.choice(sample_ids)]
+        return (SimpleNamespace(id=int(user.telegram_id), username=user.username,
+                                first_name=user.first_name, last_name=None),)
+
+    def new_tg_user():
+        telegram_id = next(new_users)
+        return (SimpleNamespace(id=telegram_id, username=f'new{telegram_id}', first_name='New', last_name=None),)
+
+    def random_bundle():
+        return f"bundle_bench_{rng.randrange(counts['bundles'])}"
+
+    def random_file():
+        return staged_file_id(random_bundle(), rng.randrange(per_bundle))
+
+    def access_rows(count):
+        return lambda: ([{'user_id': rng.choice(sample_ids), 'file_id': None, 'action': 'bundle_access',
+                          'timestamp': datetime.utcnow(), 'ip_address': None, 'user_agent': None}
+                         for _ in range(count)],)
+
+    return {
+        'get_or_create_user (existing)': timed_calls(app, iterations, bot.get_or_create_user, existing_tg_user),
+        'get_or_create_user (new)': timed_calls(app, iterations, bot.get_or_create_user, new_tg_user),
+        'get_valid_user_token': timed_calls(
+            app, iterations, bot.get_valid_user_token, lambda: (users[rng.choice(sample_ids)],)),
+        'refresh_user_token': timed_calls(
+            app, iterations, bot.refresh_user_token, lambda: (users[rng.choice(sample_ids)],)),
+        'get_bundle_manifest (bundle_key)': timed_calls(
+            app, iterations, bot.get_bundle_manifest, lambda: (compact_key(random_bundle()),)),
+        'get_bundle_manifest (legacy bundle_id)': timed_calls(
+            app, iterations, bot.get_bundle_manifest, lambda: (random_bundle(),)),
+        'get_media_file (file_key)': timed_calls(
+            app, iterations, bot.get_media_file, lambda: (compact_key(random_file()),)),
+        'get_media_file (legacy file_id)': timed_calls(
+            app, iterations, bot.get_media_file, lambda: (random_file(),)),
+        'log_access (1 row)': timed_calls(app, iterations, AccessLogWriter._insert_rows, access_rows(1)),
+        'log_access (500-row batch)': timed_calls(
+            app, max(1, iterations // 50), AccessLogWriter._insert_rows, access_rows(500)),
+    }
+
+
+def query_plans(app: Flask) -> dict:
+    with app.app_context():
+        with db.engine.connect() as conn:
+            return {
+                name: [" | ".join(str(col) for col in row) for row in explain(conn, statement)]
+                for name, statement in hot_queries()
+            }
+
+
+def postgres_available(url: str) -> bool:
+    try:
+        engine = create_engine(url)
+        with engine.connect():
+            pass
+        engine.dispose()
+        return True
+    except Exception as e:
+        print(f"Postgres at {url} not available ({e.__class__.__name__}), skipping")
+        return False
+
+
+def benchmark_database(name: str, url: str, args) -> dict:
+    rng = random.Random(args.seed)
+    counts = volumes(args.scale)
+    app = make_app(url)
+    print(f"[{name}] seeding {counts} ...")
+    seeded, seed_seconds = seed(app, counts, rng)
+    print(f"[{name}] seeded in {seed_seconds:.1f}s")
+
+    queries = run_queries(app, counts, args.iterations, rng)
+    for query, stats in queries.items():
+        print(f"[{name}] {query:<40} p50 {stats['p50_ms']:>8}ms  p95 {stats['p95_ms']:>8}ms  "
+              f"p99 {stats['p99_ms']:>8}ms  max {stats['max_ms']:>8}ms")
+    return {'rows': seeded, 'seed_seconds': round(seed_seconds, 1), 'queries': queries, 'plans': query_plans(app)}
+
+
+def main():
+    args = parse_args()
+    results = {
+        'created_at': datetime.utcnow().isoformat(timespec='seconds') + 'Z',
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': {'scale': args.scale, 'iterations': args.iterations, 'seed': args.seed},
+        'volumes': volumes(args.scale),
+        'databases': {}
+    }
+
+    with tempfile.TemporaryDirectory(prefix='db-benchmark-') as workdir:
+        sqlite_path = args.sqlite_path or os.path.join(workdir, 'benchmark.db')
+        results['databases']['sqlite'] = benchmark_database('sqlite', f"sqlite:///{sqlite_path}", args)
+
+    if args.postgres_url:
+        url = args.postgres_url.replace('postgres://', 'postgresql://', 1)
+        if postgres_available(url):
+            results['databases']['postgresql'] = benchmark_database('postgresql', url, args)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
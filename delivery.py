@@ -0,0 +1,202 @@
+import os
+import time
+import asyncio
+import logging
+from collections import deque, namedtuple
+from typing import Any, Awaitable, Callable, Deque, Dict, Hashable, List, Optional
+from telegram import InputMediaPhoto, InputMediaVideo, InputMediaDocument, InputMediaAudio
+from metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+# Immutable snapshot of what a bundle link delivers. Bundles never change after
+# /done, so these can be cached and shared freely between deliveries.
+ManifestFile = namedtuple('ManifestFile', ['telegram_file_id', 'file_type', 'file_name'])
+BundleManifest = namedtuple('BundleManifest', ['bundle_id', 'title', 'created_at', 'files'])
+
+# Seconds from queueing to delivered; large bundles under flood control take minutes
+DELIVERY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+# Telegram accepts 2-10 items per media group
+MEDIA_GROUP_LIMIT = 10
+
+# Which file types may share an album. Photos and videos can be mixed, documents
+# and audio only with their own kind. Anything missing here is sent on its own.
+MEDIA_GROUP_KINDS = {
+    'photo': 'visual',
+    'video': 'visual',
+    'document': 'document',
+    'audio': 'audio',
+}
+
+
+def media_group_kind(file_type: str) -> Optional[str]:
+    """Return the album kind a file type can be grouped under, or None"""
+    return MEDIA_GROUP_KINDS.get(file_type)
+
+
+def plan_delivery_batches(files: list) -> List[list]:
+    """Split files into sendable batches while keeping their order.
+
+    Consecutive files of a compatible kind are packed into albums of up to
+    MEDIA_GROUP_LIMIT items; everything else becomes a batch of one.
+    """
+    batches = []
+    current = []
+    current_kind = None
+
+    for file in files:
+        kind = media_group_kind(file.file_type)
+
+        if current and (kind != current_kind or len(current) >= MEDIA_GROUP_LIMIT):
+            batches.append(current)
+            current = []
+
+        if kind is None:
+            batches.append([file])
+            current_kind = None
+            continue
+
+        current.append(file)
+        current_kind = kind
+
+    if current:
+        batches.append(current)
+
+    return batches
+
+
+def build_input_media(file):
+    """Build the InputMedia item for a groupable file"""
+    caption = f"📁 {file.file_name}"
+    if file.file_type == 'photo':
+        return InputMediaPhoto(media=file.telegram_file_id, caption=caption)
+    if file.file_type == 'video':
+        return InputMediaVideo(media=file.telegram_file_id, caption=caption)
+    if file.file_type == 'audio':
+        return InputMediaAudio(media=file.telegram_file_id, caption=caption)
+    return InputMediaDocument(media=file.telegram_file_id, caption=caption)
+
+
+class DeliveryJob:
+    """A bundle delivery waiting for a worker"""
+
+    def __init__(self, chat_id, payload):
+        self.chat_id = chat_id
+        self.payload = payload
+        self.enqueued_at = time.monotonic()
+
+
+class DeliveryQueue:
+    """Bounded background queue that delivers bundles concurrently.
+
+    Each chat's deliveries run in order on a task of their own, so a chat held up
+    by flood control only delays itself; a semaphore caps how many deliveries run
+    at once across all chats.
+    """
+
+    def __init__(self, handler: Callable[[DeliveryJob], Awaitable], workers: int = None, max_pending: int = None):
+        self.handler = handler
+        self.workers = workers or int(os.getenv('DELIVERY_WORKERS', 8))
+        self.max_pending = max_pending or int(os.getenv('DELIVERY_QUEUE_SIZE', 1000))
+        self.chats: Dict[Hashable, Deque[DeliveryJob]] = {}
+        self.tasks: Dict[Hashable, asyncio.Task] = {}
+        self.slots: Optional[asyncio.Semaphore] = None
+        self.idle: Optional[asyncio.Event] = None
+        self.waiting = 0
+        self.unfinished = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.latency = Histogram(
+            'delivery_job_seconds', 'Time from queueing a bundle delivery until it finished',
+            buckets=DELIVERY_BUCKETS
+        )
+
+    def start(self):
+        """Create the concurrency limit on the running event loop"""
+        self.slots = asyncio.Semaphore(self.workers)
+        self.idle = asyncio.Event()
+        self.idle.set()
+        logger.info(f"Delivery queue started with {self.workers} concurrent deliveries")
+
+    async def join(self):
+        """Wait until every queued delivery has finished"""
+        if self.idle:
+            await self.idle.wait()
+
+    async def stop(self, drain: bool = True):
+        """Stop delivering, optionally letting queued jobs finish first"""
+        if drain:
+            await self.join()
+        tasks = list(self.tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def enqueue(self, chat_id, payload) -> bool:
+        """Queue a delivery; returns False when the queue is full"""
+        if self.waiting >= self.max_pending:
+            self.rejected += 1
+            return False
+        self.chats.setdefault(chat_id, deque()).append(DeliveryJob(chat_id, payload))
+        self.waiting += 1
+        self.unfinished += 1
+        self.idle.clear()
+        if chat_id not in self.tasks:
+            self.tasks[chat_id] = asyncio.create_task(self._deliver_chat(chat_id), name=f"delivery-{chat_id}")
+        return True
+
+    @property
+    def depth(self) -> int:
+        return self.waiting
+
+    async def _deliver_chat(self, chat_id):
+        jobs = self.chats[chat_id]
+        try:
+            while jobs:
+                async with self.slots:
+                    job = jobs.popleft()
+                    self.waiting -= 1
+                    await self._run(job)
+        finally:
+            # Only left non-empty when cancelled by stop()
+            self.waiting -= len(jobs)
+            self._finished(len(jobs))
+            del self.chats[chat_id]
+            del self.tasks[chat_id]
+
+    async def _run(self, job: DeliveryJob):
+        try:
+            await self.handler(job)
+            self.completed += 1
+        except Exception as e:
+            self.failed += 1
+            logger.error(f"Delivery to chat {job.chat_id} failed: {e}")
+        finally:
+            latency = time.monotonic() - job.enqueued_at
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+            self.latency.observe(latency)
+            self._finished(1)
+
+    def _finished(self, count: int):
+        self.unfinished -= count
+        if not self.unfinished:
+            self.idle.set()
+
+    def stats(self) -> Dict[str, Any]:
+        """Queue depth and job latency for monitoring"""
+        finished = self.completed + self.failed
+        return {
+            'workers': self.workers,
+            'depth': self.depth,
+            'active_chats': len(self.tasks),
+            'completed': self.completed,
+            'failed': self.failed,
+            'rejected': self.rejected,
+            'avg_latency': round(self.total_latency / finished, 3) if finished else 0.0,
+            'max_latency': round(self.max_latency, 3)
+        }
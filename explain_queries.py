@@ -0,0 +1,64 @@
+"""
+Print the database query plan for each hot query the bot issues.
+
+Usage: python explain_queries.py   (uses DATABASE_URL like main.py)
+"""
+from datetime import datetime
+from sqlalchemy import select
+from models import db, User, UserToken, FileBundle, MediaFile, AccessLog
+
+
+def hot_queries():
+    """The query shapes issued on every update, with representative parameters"""
+    now = datetime.utcnow()
+    return [
+        ("User by telegram_id", select(User).where(User.telegram_id == '123456789')),
+        ("Active token for user", select(UserToken).where(
+            UserToken.user_id == 1,
+            UserToken.is_active.is_(True),
+            UserToken.expires_at > now
+        ).limit(1)),
+        ("Bundle manifest", select(
+            FileBundle.bundle_id, FileBundle.title, FileBundle.created_at,
+            MediaFile.telegram_file_id, MediaFile.file_type, MediaFile.file_name
+        ).outerjoin(
+            MediaFile, MediaFile.bundle_key == FileBundle.bundle_key
+        ).where(FileBundle.bundle_key == 1234567890).order_by(MediaFile.id)),
+        ("Media file by file_key", select(MediaFile).where(MediaFile.file_key == 1234567890).limit(1)),
+        ("Media file by legacy file_id", select(MediaFile).where(MediaFile.file_id == 'example').limit(1)),
+        ("Active tokens to deactivate", select(UserToken).where(
+            UserToken.user_id == 1,
+            UserToken.is_active.is_(True)
+        )),
+        ("Recent access logs for user", select(AccessLog).where(
+            AccessLog.user_id == 1,
+            AccessLog.timestamp > now
+        ).order_by(AccessLog.timestamp.desc()).limit(50)),
+    ]
+
+
+def explain(conn, statement) -> list:
+    """Return the plan rows for a statement on the connected dialect"""
+    compiled = statement.compile(dialect=conn.dialect)
+    params = compiled.params
+    if compiled.positional:
+        params = tuple(params[name] for name in compiled.positiontup)
+    prefix = "EXPLAIN QUERY PLAN " if conn.dialect.name == 'sqlite' else "EXPLAIN "
+    return conn.exec_driver_sql(prefix + str(compiled), params).fetchall()
+
+
+def main():
+    from main import app
+
+    with app.app_context():
+        with db.engine.connect() as conn:
+            print(f"Dialect: {conn.dialect.name}\n")
+            for name, statement in hot_queries():
+                print(f"== {name}")
+                for row in explain(conn, statement):
+                    print("   " + " | ".join(str(col) for col in row))
+                print()
+
+
+if __name__ == "__main__":
+    main()
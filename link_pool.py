@@ -0,0 +1,125 @@
+import os
+import time
+import asyncio
+import logging
+from collections import deque, namedtuple
+from typing import Any, Dict, Optional
+from utils import generate_link_token, generate_token_link
+from tokens import POOL_USER_ID
+
+logger = logging.getLogger(__name__)
+
+PooledLink = namedtuple('PooledLink', ['token', 'ads_link', 'created_at'])
+
+
+class AdsLinkPool:
+    """Keeps pre-shortened ads verification links ready to hand out.
+
+    A background producer shortens links for unbound tokens ahead of time, so the
+    LinkShortify round-trip is off the user's critical path. A claimed link is
+    bound to the user by the caller; unclaimed links are dropped after max_age.
+    """
+
+    def __init__(self, linkshortify, bot_username: str, size: int = None, low_water: int = None,
+                 max_age: float = None, concurrency: int = None):
+        self.linkshortify = linkshortify
+        self.bot_username = bot_username
+        self.size = size if size is not None else int(os.getenv('LINK_POOL_SIZE', 50))
+        self.low_water = low_water if low_water is not None else int(os.getenv('LINK_POOL_LOW_WATER', 10))
+        self.max_age = max_age or float(os.getenv('LINK_POOL_MAX_AGE', 6 * 3600))
+        self.concurrency = concurrency or int(os.getenv('LINK_POOL_CONCURRENCY', 4))
+        self.links: "deque[PooledLink]" = deque()
+        self.refill_needed = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+        self.hits = 0
+        self.misses = 0
+        self.generated = 0
+        self.failures = 0
+        self.expired = 0
+
+    def start(self):
+        """Start the background producer (no-op when the pool is disabled)"""
+        if self.size <= 0:
+            return
+        self.refill_needed.set()
+        self.task = asyncio.create_task(self._producer(), name="ads-link-pool")
+        logger.info(f"Ads link pool started (size {self.size}, low water {self.low_water})")
+
+    async def stop(self):
+        """Stop the producer"""
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    def claim(self) -> Optional[PooledLink]:
+        """Take a ready link, or None if the pool is empty"""
+        self._drop_stale()
+        link = self.links.popleft() if self.links else None
+        if link:
+            self.hits += 1
+        else:
+            self.misses += 1
+        if len(self.links) <= self.low_water:
+            self.refill_needed.set()
+        return link
+
+    def _drop_stale(self):
+        cutoff = time.time() - self.max_age
+        while self.links and self.links[0].created_at < cutoff:
+            self.links.popleft()
+            self.expired += 1
+
+    async def _generate(self) -> Optional[PooledLink]:
+        """Shorten one verification link for a fresh, not yet bound token"""
+        token = generate_link_token()
+        verification_link = generate_token_link(self.bot_username, token, POOL_USER_ID)
+        # Nobody is waiting on pooled links, so allow the client's full retry deadline
+        ads_link = await self.linkshortify.create_ads_verification_link(
+            verification_link,
+            allow_fallback=False,
+            latency_budget=self.linkshortify.total_timeout * 2
+        )
+        if not ads_link:
+            return None
+        return PooledLink(token, ads_link, time.time())
+
+    async def _producer(self):
+        while True:
+            try:
+                # Wake up on low water, or periodically to replace links about to go stale
+                await asyncio.wait_for(self.refill_needed.wait(), timeout=self.max_age / 10)
+            except asyncio.TimeoutError:
+                pass
+            self.refill_needed.clear()
+            self._drop_stale()
+
+            while len(self.links) < self.size:
+                batch = min(self.concurrency, self.size - len(self.links))
+                results = await asyncio.gather(
+                    *(self._generate() for _ in range(batch)),
+                    return_exceptions=True
+                )
+                made = [link for link in results if isinstance(link, PooledLink)]
+                self.links.extend(made)
+                self.generated += len(made)
+                self.failures += batch - len(made)
+                if not made:
+                    # Provider is failing; don't hammer it, users get on-demand links meanwhile
+                    logger.warning("Ads link pool refill failed, backing off")
+                    await asyncio.sleep(30)
+                    break
+
+    def stats(self) -> Dict[str, Any]:
+        """Pool level and hit rate for monitoring"""
+        claims = self.hits + self.misses
+        return {
+            'size': len(self.links),
+            'target': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / claims, 4) if claims else 0.0,
+            'generated': self.generated,
+            'failures': self.failures,
+            'expired': self.expired
+        }
@@ -1,127 +1,236 @@
-import requests
+import os
+import random
+import asyncio
 import logging
+import urllib.parse
+import httpx
 from typing import Optional, Dict, Any
+from circuit_breaker import CircuitBreaker
+from metrics import HTTP_CLIENT_SECONDS
+from profiling import add_time
 
 logger = logging.getLogger(__name__)
 
+# Pages on our own Flask server that generated links point at (main.py registers
+# these routes and checks at startup that every one of them resolves)
+VERIFY_TOKEN_PATH = '/verify-token'
+ADS_VERIFICATION_PATH = '/ads-verification'
+LINKED_PATHS = (VERIFY_TOKEN_PATH, ADS_VERIFICATION_PATH)
+
 
 class LinkShortifyAPI:
-    def __init__(self, api_key: str):
+    """Async LinkShortify client.
+
+    One pooled keep-alive AsyncClient is shared by every call. Each HTTP attempt
+    has its own timeout, each call a total deadline across its jittered retries,
+    so link creation never blocks the event loop and never runs unbounded. A
+    circuit breaker tracks the provider's error rate and latency; while it is open
+    ads links go straight to the fallback page.
+    """
+
+    def __init__(self, api_key: str, base_url: str = None, attempt_timeout: float = None,
+                 total_timeout: float = None, max_retries: int = None, max_connections: int = None):
         self.api_key = api_key
-        self.base_url = "https://linkshortify.com/api"
+        self.base_url = base_url or os.getenv('LINKSHORTIFY_BASE_URL', 'https://linkshortify.com/api')
         self.headers = {
             "Authorization": f"Bearer {api_key}",
             "Content-Type": "application/json"
         }
-    
-    def create_short_link(self, original_url: str, alias: str = None, ad_type: str = None) -> Optional[Dict[str, Any]]:
+        self.attempt_timeout = attempt_timeout or float(os.getenv('LINKSHORTIFY_ATTEMPT_TIMEOUT', 4))
+        self.total_timeout = total_timeout or float(os.getenv('LINKSHORTIFY_TOTAL_TIMEOUT', 10))
+        self.max_retries = max_retries if max_retries is not None else int(os.getenv('LINKSHORTIFY_MAX_RETRIES', 2))
+        self.max_connections = max_connections or int(os.getenv('LINKSHORTIFY_MAX_CONNECTIONS', 20))
+        self.latency_budget = float(os.getenv('LINKSHORTIFY_LATENCY_BUDGET', 3))
+        self.breaker = CircuitBreaker('linkshortify')
+        self._client: Optional[httpx.AsyncClient] = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """Lazily created pooled client, bound to the running event loop"""
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.attempt_timeout),
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections,
+                    keepalive_expiry=60
+                )
+            )
+        return self._client
+
+    async def aclose(self):
+        """Close the connection pool"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _get_json(self, url: str, params: Dict[str, Any] = None,
+                        headers: Dict[str, str] = None, operation: str = 'request') -> Optional[Dict[str, Any]]:
+        """GET a JSON document with per-attempt timeouts, a total deadline and jittered retries"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.total_timeout
+
+        for attempt in range(self.max_retries + 1):
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            if not self.breaker.allow_request():
+                logger.warning("LinkShortify circuit open, skipping request")
+                return None
+
+            started = loop.time()
+            outcome = 'error'
+            try:
+                response = await asyncio.wait_for(
+                    self.client.get(url, params=params, headers=headers),
+                    timeout=min(self.attempt_timeout, remaining)
+                )
+                outcome = str(response.status_code)
+                if response.status_code == 200:
+                    data = response.json()
+                    self.breaker.record_success(loop.time() - started)
+                    return data
+                if response.status_code != 429 and response.status_code < 500:
+                    # The provider answered; the request itself was bad
+                    self.breaker.record_success(loop.time() - started)
+                    logger.error(f"LinkShortify API error: {response.status_code} - {response.text}")
+                    return None
+                self.breaker.record_failure()
+                logger.warning(f"LinkShortify API returned {response.status_code} (attempt {attempt + 1})")
+            except (httpx.HTTPError, asyncio.TimeoutError, ValueError) as e:
+                self.breaker.record_failure()
+                logger.warning(f"LinkShortify request failed (attempt {attempt + 1}): {e!r}")
+            finally:
+                elapsed = loop.time() - started
+                HTTP_CLIENT_SECONDS.observe(elapsed, service='linkshortify', operation=operation, outcome=outcome)
+                add_time('linkshortify', elapsed)
+
+            if attempt < self.max_retries:
+                backoff = min(2.0, 0.25 * 2 ** attempt) * random.uniform(0.5, 1.5)
+                await asyncio.sleep(max(0.0, min(backoff, deadline - loop.time())))
+
+        logger.error("LinkShortify API unavailable, giving up")
+        return None
+
+    async def create_short_link(self, original_url: str, alias: str = None, ad_type: str = None) -> Optional[Dict[str, Any]]:
         """Create a shortened link using the correct LinkShortify API format"""
         try:
-            # Use the correct API format from the screenshot
-            import urllib.parse
-            encoded_url = urllib.parse.quote(original_url, safe=':/?#[]@!$&\'()*+,;=')
-            api_url = f"https://linkshortify.com/api?api={self.api_key}&url={encoded_url}"
-            
+            params = {'api': self.api_key, 'url': original_url}
+
             if alias:
-                api_url += f"&alias={alias}"
-            
+                params['alias'] = alias
+
             # Add ad type parameter for ads verification
             if ad_type:
-                api_url += f"&type={ad_type}"
-            
-            logger.info(f"Calling LinkShortify API: {api_url}")
-            response = requests.get(api_url, timeout=10)
-            
-            if response.status_code == 200:
-                response_data = response.json()
+                params['type'] = ad_type
+
+            logger.info(f"Calling LinkShortify API for: {original_url}")
+            response_data = await self._get_json(self.base_url, params=params, operation='shorten')
+
+            if response_data is not None:
                 logger.info(f"LinkShortify API response: {response_data}")
-                return response_data
-            else:
-                logger.error(f"LinkShortify API error: {response.status_code} - {response.text}")
-                return None
-                
+            return response_data
+
         except Exception as e:
             logger.error(f"Error creating short link: {e}")
             return None
-    
-    def get_stats(self, short_url_id: str) -> Optional[Dict[str, Any]]:
+
+    async def get_stats(self, short_url_id: str) -> Optional[Dict[str, Any]]:
         """Get statistics for a shortened URL"""
         try:
             endpoint = f"{self.base_url}/url/{short_url_id}/stats"
-            response = requests.get(endpoint, headers=self.headers)
-            
-            if response.status_code == 200:
-                return response.json()
-            else:
-                logger.error(f"LinkShortify stats error: {response.status_code} - {response.text}")
-                return None
-                
+            return await self._get_json(endpoint, headers=self.headers, operation='stats')
+
         except Exception as e:
             logger.error(f"Error getting stats: {e}")
             return None
-    
-    def verify_click(self, user_id: str, short_url_id: str) -> bool:
+
+    async def verify_click(self, user_id: str, short_url_id: str) -> bool:
         """Verify if user has clicked the shortened link"""
         try:
-            stats = self.get_stats(short_url_id)
+            stats = await self.get_stats(short_url_id)
             if stats and stats.get('clicks', 0) > 0:
                 # Simple verification - in production you'd want more sophisticated tracking
                 return True
             return False
-            
+
         except Exception as e:
             logger.error(f"Error verifying click: {e}")
             return False
-    
-    def create_ads_verification_link(self, telegram_deep_link: str) -> Optional[str]:
-        """Create an ads verification link that redirects to web verification endpoint"""
+
+    async def create_ads_verification_link(self, telegram_deep_link: str, allow_fallback: bool = True,
+                                           latency_budget: float = None) -> Optional[str]:
+        """Create an ads verification link within a latency budget.
+
+        Falls back to our own ads page when the breaker is open, the provider fails
+        or the budget (LINKSHORTIFY_LATENCY_BUDGET by default) runs out. With
+        allow_fallback=False, None is returned instead of the fallback page link.
+        """
+        fallback = self.create_fallback_ads_link(telegram_deep_link) if allow_fallback else None
+
+        if self.breaker.is_open:
+            self.breaker.short_circuited += 1
+            logger.warning("LinkShortify circuit open, using fallback ads page")
+            return fallback
+
+        try:
+            ads_link = await asyncio.wait_for(
+                self._create_ads_link(telegram_deep_link),
+                timeout=latency_budget or self.latency_budget
+            )
+        except asyncio.TimeoutError:
+            self.breaker.record_failure()
+            logger.warning("LinkShortify exceeded its latency budget, using fallback ads page")
+            return fallback
+
+        return ads_link or fallback
+
+    async def _create_ads_link(self, telegram_deep_link: str) -> Optional[str]:
+        """Shorten the web verification URL, then the Telegram link; None if both fail"""
         try:
             # Extract token data from telegram link
             if "?start=token_" in telegram_deep_link:
                 token_part = telegram_deep_link.split("?start=token_")[1]
-                
+
                 # Create web verification URL instead of direct telegram link
-                import os
                 # Use Render.com URL or fallback to localhost for development
                 base_url = os.environ.get('RENDER_EXTERNAL_URL', 'https://telegram-file-sharing-bot.onrender.com')
-                web_verify_url = f"{base_url}/verify-token?token={token_part}"
-                
+                web_verify_url = f"{base_url}{VERIFY_TOKEN_PATH}?token={token_part}"
+
                 # Create ads link to web verification URL
-                result = self.create_short_link(web_verify_url, ad_type="ads")
-                
+                result = await self.create_short_link(web_verify_url, ad_type="ads")
+
                 if result and result.get('status') == 'success':
                     shortened_url = result.get('shortenedUrl')
                     if shortened_url:
                         logger.info(f"Successfully created LinkShortify ads link: {shortened_url}")
                         return shortened_url
-            
+
             # Fallback to direct telegram link
-            result = self.create_short_link(telegram_deep_link, ad_type="ads")
-            
+            result = await self.create_short_link(telegram_deep_link, ad_type="ads")
+
             if result and result.get('status') == 'success':
                 shortened_url = result.get('shortenedUrl')
                 if shortened_url:
                     logger.info(f"Successfully created LinkShortify ads link: {shortened_url}")
                     return shortened_url
-            
-            logger.warning("LinkShortify API failed, using fallback ads page")
-            return self.create_fallback_ads_link(telegram_deep_link)
-            
+
+            logger.warning("LinkShortify API failed to shorten the link")
+            return None
+
         except Exception as e:
             logger.error(f"Error creating ads verification link: {e}")
-            return self.create_fallback_ads_link(telegram_deep_link)
-    
+            return None
+
     def create_fallback_ads_link(self, telegram_deep_link: str) -> str:
         """Create a fallback ads verification page using our own Flask server"""
-        import urllib.parse
-        import os
         encoded_link = urllib.parse.quote(telegram_deep_link, safe='')
-        
+
         # Use Render.com URL
         base_url = os.environ.get('RENDER_EXTERNAL_URL', 'https://telegram-file-sharing-bot.onrender.com')
-        
-        # Log the constructed domain for debugging  
+
+        # Log the constructed domain for debugging
         logger.info(f"Creating fallback ads link with domain: {base_url}")
-        
+
         # Use our Flask server to create ads verification page
-        return f"{base_url}/ads-verify?redirect={encoded_link}"
\ No newline at end of file
+        return f"{base_url}{ADS_VERIFICATION_PATH}?redirect={encoded_link}"
@@ -0,0 +1,491 @@
+"""
+End-to-end load benchmark for TelegramBotBundle.
+
+Runs the real bot against a local fake Telegram Bot API (via TELEGRAM_BASE_URL)
+and a stub LinkShortify (via LINKSHORTIFY_BASE_URL), both served by uvicorn in
+a background thread with configurable latency and error injection, then drives
+synthetic traffic through Application.process_update:
+
+    start      /start from new users
+    bundle_N   /start b_<key> deep links for bundles of N photos/videos, sent as
+               albums (waits for delivery)
+    bundle_mixed_N  the same with photos, videos, documents and audio mixed,
+               which split into more sends
+    refresh    "Refresh Token" button presses (LinkShortify on the critical path)
+    upload     admin document uploads in albums of 10, then /done
+
+Per scenario it reports updates/s, p50/p95/p99 handler latency, Bot API calls
+and DB statements per update, and writes everything to a JSON file. Pass
+--compare with an earlier result to flag regressions.
+
+    python load_benchmark.py --output benchmark.json
+    python load_benchmark.py --compare benchmark.json --output current.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import argparse
+import platform
+import tempfile
+import threading
+import statistics
+from collections import Counter
+from datetime import datetime
+from urllib.parse import parse_qs
+
+BOT_TOKEN = '123456:BENCHMARK'
+ADMIN_ID = 777
+STORAGE_CHANNEL_ID = -1001234567890
+# File types cycled through each seeded bundle: the usual photo/video bundle groups into
+# albums of 10, the mixed one only partly (documents and audio can't share an album)
+BUNDLE_MIXES = {
+    'bundle': ('photo', 'video'),
+    'bundle_mixed': ('photo', 'video', 'document', 'photo', 'audio'),
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--updates', type=int, default=200, help='updates per scenario')
+    parser.add_argument('--concurrency', type=int, default=16, help='updates processed at once')
+    parser.add_argument('--bundle-sizes', default='1,10,50', help='comma-separated bundle sizes to open')
+    parser.add_argument('--bot-latency', type=float, default=20, help='fake Bot API latency per call (ms)')
+    parser.add_argument('--bot-error-rate', type=float, default=0.0, help='fraction of Bot API calls answered with 502')
+    parser.add_argument('--shortener-latency', type=float, default=150, help='stub LinkShortify latency (ms)')
+    parser.add_argument('--shortener-error-rate', type=float, default=0.0, help='fraction of LinkShortify calls failing')
+    parser.add_argument('--production-rate-limits', action='store_true',
+                        help="keep the outbound scheduler's Telegram limits (default: effectively unlimited)")
+    parser.add_argument('--database-url', help='database to benchmark against (default: a fresh SQLite file)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default='benchmark.json', help='where to write the JSON results')
+    parser.add_argument('--compare', help='earlier JSON results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='relative slowdown flagged as a regression')
+    return parser.parse_args()
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class FakeServices:
+    """Fake Bot API + stub LinkShortify in one Starlette app on a background thread"""
+
+    def __init__(self, bot_latency: float, bot_error_rate: float, shortener_latency: float,
+                 shortener_error_rate: float, seed: int):
+        self.bot_latency = bot_latency / 1000
+        self.bot_error_rate = bot_error_rate
+        self.shortener_latency = shortener_latency / 1000
+        self.shortener_error_rate = shortener_error_rate
+        self.random = random.Random(seed)
+        self.calls = Counter()
+        self.errors = Counter()
+        self.message_id = 1000
+        self.port = free_port()
+        self.server = None
+        self.thread = None
+
+    def bot_api_calls(self) -> int:
+        return sum(count for method, count in self.calls.items() if method != 'linkshortify')
+
+    @property
+    def bot_base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/bot"
+
+    @property
+    def shortener_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/shortener/api"
+
+    def _message(self, chat_id, **extra) -> dict:
+        self.message_id += 1
+        return {
+            'message_id': self.message_id,
+            'date': int(time.time()),
+            'chat': {'id': int(chat_id), 'type': 'private' if int(chat_id) > 0 else 'channel'},
+            **extra
+        }
+
+    def _result(self, method: str, params: dict):
+        chat_id = params.get('chat_id', 1)
+        if method == 'getMe':
+            return {'id': 123456, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot',
+                    'can_join_groups': False, 'can_read_all_group_messages': False,
+                    'supports_inline_queries': False}
+        if method in ('answerCallbackQuery', 'setWebhook', 'deleteWebhook', 'deleteMessage'):
+            return True
+        if method == 'getUpdates':
+            return []
+        if method == 'sendMediaGroup':
+            media = params.get('media')
+            count = len(json.loads(media) if isinstance(media, str) else media or [])
+            return [self._message(chat_id) for _ in range(count)]
+        if method == 'forwardMessages':
+            ids = params.get('message_ids')
+            count = len(json.loads(ids) if isinstance(ids, str) else ids or [])
+            return [{'message_id': self._message(chat_id)['message_id']} for _ in range(count)]
+        if method == 'copyMessage':
+            return {'message_id': self._message(chat_id)['message_id']}
+        return self._message(chat_id, text=params.get('text', ''))
+
+    def build_app(self):
+        from starlette.applications import Starlette
+        from starlette.responses import JSONResponse
+        from starlette.routing import Route
+
+        async def bot_api(request):
+            method = request.path_params['method']
+            self.calls[method] += 1
+            if self.bot_latency:
+                await asyncio.sleep(self.bot_latency)
+            if method != 'getMe' and self.random.random() < self.bot_error_rate:
+                self.errors[method] += 1
+                return JSONResponse({'ok': False, 'error_code': 502, 'description': 'Bad Gateway'}, status_code=502)
+            body = await request.body()
+            try:
+                params = json.loads(body) if body else {}
+            except ValueError:
+                # PTB sends url-encoded forms; values that are objects arrive JSON-encoded
+                params = {key: values[-1] for key, values in parse_qs(body.decode()).items()}
+            return JSONResponse({'ok': True, 'result': self._result(method, params)})
+
+        async def shortener(request):
+            self.calls['linkshortify'] += 1
+            if self.shortener_latency:
+                await asyncio.sleep(self.shortener_latency)
+            if self.random.random() < self.shortener_error_rate:
+                self.errors['linkshortify'] += 1
+                return JSONResponse({'status': 'error'}, status_code=503)
+            return JSONResponse({'status': 'success', 'shortenedUrl': f"https://short.test/{self.random.getrandbits(40):x}"})
+
+        return Starlette(routes=[
+            Route('/bot{token}/{method}', bot_api, methods=['GET', 'POST']),
+            Route('/shortener/api', shortener, methods=['GET']),
+        ])
+
+    def start(self):
+        import uvicorn
+        config = uvicorn.Config(self.build_app(), host='127.0.0.1', port=self.port, log_level='warning', lifespan='off')
+        self.server = uvicorn.Server(config)
+        self.thread = threading.Thread(target=self.server.run, daemon=True, name='fake-telegram')
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.01)
+
+    def stop(self):
+        self.server.should_exit = True
+        self.thread.join(timeout=5)
+
+
+def configure_environment(args, services: FakeServices, workdir: str):
+    """Point the bot at the fake services; must run before main/bot_bundle are imported"""
+    os.environ['DATABASE_URL'] = args.database_url or f"sqlite:///{os.path.join(workdir, 'benchmark.db')}"
+    os.environ['STAGING_DB_PATH'] = os.path.join(workdir, 'staging.db')
+    os.environ.setdefault('TOKEN_SIGNING_KEY', 'load-benchmark-signing-key-not-for-production')
+    os.environ.setdefault('LINK_TAG_KEY', 'load-benchmark-link-tag-key-not-for-production')
+    os.environ['TELEGRAM_BASE_URL'] = services.bot_base_url
+    os.environ['LINKSHORTIFY_BASE_URL'] = services.shortener_url
+    os.environ['LINK_POOL_SIZE'] = '0'
+    os.environ['UPLOAD_DEBOUNCE_SECONDS'] = '0.05'
+    os.environ['STAGING_MAX_FILES'] = str(max(1000, args.updates))
+    if not args.production_rate_limits:
+        os.environ['OUTBOUND_GLOBAL_RATE'] = '100000'
+        os.environ['OUTBOUND_CHAT_RATE'] = '100000'
+        os.environ['OUTBOUND_GROUP_RATE'] = '6000000'
+
+
+class Driver:
+    """Builds synthetic updates and measures how the bot handles them"""
+
+    def __init__(self, bot, app, concurrency: int, services: FakeServices):
+        self.bot = bot
+        self.app = app
+        self.concurrency = concurrency
+        self.services = services
+        self.update_id = 0
+        self.statements = 0
+
+    def next_update_id(self) -> int:
+        self.update_id += 1
+        return self.update_id
+
+    def _user(self, user_id: int) -> dict:
+        return {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}', 'username': f'user{user_id}'}
+
+    def command(self, user_id: int, text: str) -> dict:
+        command = text.split()[0]
+        return {
+            'update_id': self.next_update_id(),
+            'message': {
+                'message_id': self.next_update_id(),
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'from': self._user(user_id),
+                'text': text,
+                'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+            }
+        }
+
+    def callback(self, user_id: int, data: str) -> dict:
+        return {
+            'update_id': self.next_update_id(),
+            'callback_query': {
+                'id': str(self.next_update_id()),
+                'from': self._user(user_id),
+                'chat_instance': str(user_id),
+                'data': data,
+                'message': {
+                    'message_id': self.next_update_id(),
+                    'date': int(time.time()),
+                    'chat': {'id': user_id, 'type': 'private'},
+                    'text': 'menu'
+                }
+            }
+        }
+
+    def document(self, user_id: int, index: int, media_group_id: str = None) -> dict:
+        message = {
+            'message_id': self.next_update_id(),
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': self._user(user_id),
+            'document': {
+                'file_id': f'BQAC-bench-{index}',
+                'file_unique_id': f'bench-{index}',
+                'file_name': f'file_{index}.pdf',
+                'file_size': 1024 * (index % 100 + 1)
+            }
+        }
+        if media_group_id:
+            message['media_group_id'] = media_group_id
+        return {'update_id': self.next_update_id(), 'message': message}
+
+    async def run(self, name: str, payloads: list, settle=None) -> dict:
+        """Process payloads concurrently and collect latency and per-update costs"""
+        from telegram import Update
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+        latencies = []
+        errors = 0
+        calls_before = self.services.bot_api_calls()
+        shortener_before = self.services.calls['linkshortify']
+        statements_before = self.statements
+
+        async def handle(payload):
+            nonlocal errors
+            update = Update.de_json(payload, self.app.bot)
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    await self.app.process_update(update)
+                except Exception:
+                    errors += 1
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(handle(payload) for payload in payloads))
+        if settle:
+            await settle()
+        duration = time.perf_counter() - started
+
+        count = len(payloads)
+        calls = self.services.bot_api_calls() - calls_before
+        shortener_calls = self.services.calls['linkshortify'] - shortener_before
+        statements = self.statements - statements_before
+        latencies.sort()
+        result = {
+            'updates': count,
+            'duration_s': round(duration, 3),
+            'updates_per_s': round(count / duration, 1) if duration else 0.0,
+            'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+            'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+            'mean_ms': round(statistics.fmean(latencies) * 1000, 2) if latencies else 0.0,
+            'bot_api_calls': calls,
+            'bot_api_calls_per_update': round(calls / count, 2) if count else 0.0,
+            'linkshortify_calls_per_update': round(shortener_calls / count, 2) if count else 0.0,
+            'db_statements_per_update': round(statements / count, 2) if count else 0.0,
+            'errors': errors
+        }
+        print(f"{name:<12} {result['updates_per_s']:>8} upd/s  p50 {result['p50_ms']:>8}ms  "
+              f"p95 {result['p95_ms']:>8}ms  p99 {result['p99_ms']:>8}ms  "
+              f"api/upd {result['bot_api_calls_per_update']:>6}  sql/upd {result['db_statements_per_update']:>6}")
+        return result
+
+
+def percentile(sorted_values: list, pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def seed_bundles(flask_app, sizes: list, users: list) -> dict:
+    """Create one bundle per mix and size and give every user an active token; returns {scenario: bundle_key}"""
+    from sqlalchemy import insert
+    from models import db, User, MediaFile, FileBundle
+    from tokens import activate_user_token
+    from bundle_finalizer import staged_file_id
+    from utils import compact_key
+
+    bundles = {}
+    with flask_app.app_context():
+        admin = User(telegram_id=str(ADMIN_ID), first_name='Admin')
+        db.session.add(admin)
+        db.session.commit()
+        for (mix, kinds), size in ((mix, size) for mix in BUNDLE_MIXES.items() for size in sizes):
+            bundle_id = f"{mix}_bench_{size}"
+            bundle_key = compact_key(bundle_id)
+            db.session.add(FileBundle(
+                bundle_id=bundle_id, bundle_key=bundle_key, created_by=admin.id, title=f"Bundle {size} files"
+            ))
+            db.session.flush()
+            db.session.execute(insert(MediaFile), [
+                {
+                    'file_id': staged_file_id(bundle_id, i),
+                    'file_key': compact_key(staged_file_id(bundle_id, i)),
+                    'bundle_id': bundle_id,
+                    'bundle_key': bundle_key,
+                    'file_name': f'file_{i}',
+                    'file_type': kinds[i % len(kinds)],
+                    'file_size': 1024,
+                    'telegram_file_id': f'FILE-{mix}-{size}-{i}',
+                    'uploaded_by': admin.id
+                }
+                for i in range(size)
+            ])
+            bundles[f'{mix}_{size}'] = bundle_key
+        for user_id in users:
+            user = User(telegram_id=str(user_id), first_name=f'User{user_id}')
+            db.session.add(user)
+            db.session.flush()
+            activate_user_token(user)
+        db.session.commit()
+    return bundles
+
+
+async def benchmark(args, services: FakeServices) -> dict:
+    from sqlalchemy import event
+    import main
+    from models import db
+    from utils import encode_compact_id
+    from bot_bundle import TelegramBotBundle
+
+    bot = TelegramBotBundle(
+        token=BOT_TOKEN,
+        bot_username='bench_bot',
+        linkshortify_api_key='bench',
+        storage_channel_id=str(STORAGE_CHANNEL_ID),
+        admin_id=str(ADMIN_ID),
+        flask_app=main.app
+    )
+    app = bot.application
+    driver = Driver(bot, app, args.concurrency, services)
+
+    with main.app.app_context():
+        engine = db.engine
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def count_statement(*_):
+        driver.statements += 1
+
+    sizes = [int(size) for size in args.bundle_sizes.split(',') if size]
+    bundle_users = list(range(2_000_000, 2_000_000 + args.updates))
+    bundles = seed_bundles(main.app, sizes, bundle_users)
+
+    await app.initialize()
+    await bot.post_init(app)
+    results = {}
+    try:
+        async def deliveries_done():
+            await bot.delivery_queue.join()
+
+        results['start'] = await driver.run('start', [
+            driver.command(1_000_000 + i, '/start') for i in range(args.updates)
+        ])
+
+        for name, bundle_key in bundles.items():
+            link = f"/start b_{encode_compact_id('b', bundle_key)}"
+            results[name] = await driver.run(name, [
+                driver.command(user_id, link) for user_id in bundle_users
+            ], settle=deliveries_done)
+
+        results['refresh'] = await driver.run('refresh', [
+            driver.callback(3_000_000 + i, 'refresh_token') for i in range(args.updates)
+        ])
+
+        async def uploads_done():
+            await bot.upload_batcher.drain(ADMIN_ID)
+
+        results['upload'] = await driver.run('upload', [
+            driver.document(ADMIN_ID, i, media_group_id=f"album-{i // 10}") for i in range(args.updates)
+        ], settle=uploads_done)
+        results['finalize'] = await driver.run('finalize', [driver.command(ADMIN_ID, '/done')])
+    finally:
+        await bot.post_shutdown(app)
+        await app.shutdown()
+        bot.db.shutdown(wait=True)
+
+    return {
+        'created_at': datetime.utcnow().isoformat(timespec='seconds') + 'Z',
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+        'bot_api_calls_by_method': dict(services.calls),
+        'injected_errors': dict(services.errors),
+        'scenarios': results
+    }
+
+
+def compare(current: dict, baseline: dict, tolerance: float) -> list:
+    """Return human-readable regressions of current vs baseline"""
+    regressions = []
+    for name, result in current['scenarios'].items():
+        before = baseline.get('scenarios', {}).get(name)
+        if not before:
+            continue
+        for metric, higher_is_worse in (('p95_ms', True), ('updates_per_s', False),
+                                        ('bot_api_calls_per_update', True), ('db_statements_per_update', True)):
+            old, new = before.get(metric), result.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old if higher_is_worse else (old - new) / old
+            if change > tolerance:
+                regressions.append(f"{name}.{metric}: {old} -> {new} ({change:+.0%})")
+    return regressions
+
+
+def main_cli():
+    args = parse_args()
+    services = FakeServices(args.bot_latency, args.bot_error_rate, args.shortener_latency,
+                            args.shortener_error_rate, args.seed)
+    random.seed(args.seed)
+    with tempfile.TemporaryDirectory(prefix='bot-benchmark-') as workdir:
+        configure_environment(args, services, workdir)
+        services.start()
+        try:
+            results = asyncio.run(benchmark(args, services))
+        finally:
+            services.stop()
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print("Regressions against baseline:")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print("No regressions against baseline")
+
+
+if __name__ == '__main__':
+    main_cli()
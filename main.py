@@ -1,11 +1,16 @@
 import os
 import time
 import threading
-from datetime import datetime, timedelta
-from flask import Flask, request
-from flask_sqlalchemy import SQLAlchemy
-from models import db, User, UserToken, MediaFile, FileBundle, AccessLog
+from flask import Flask, Response, g, request
+from models import db, User
 from bot_bundle import TelegramBotBundle
+from cache import token_cache, user_cache, manifest_cache, missing_bundle_cache, used_link_cache
+from tokens import POOL_USER_ID, activate_user_token, activate_pending_token, link_already_used, mark_link_used
+from utils import decode_token_data, signing_key, link_tag_key
+from migrations import run_migrations
+from database import engine_options, configure_sqlite
+from metrics import REGISTRY, HTTP_REQUEST_SECONDS, instrument_engine, cache_metrics
+from linkshortify import VERIFY_TOKEN_PATH, ADS_VERIFICATION_PATH, LINKED_PATHS
 import keep_alive
 
 # Flask app setup
@@ -18,9 +23,11 @@ if database_url and database_url.startswith('postgres://'):
 
 app.config['SQLALCHEMY_DATABASE_URI'] = database_url or 'sqlite:///telegram_bot.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
 app.config['SECRET_KEY'] = os.getenv('FLASK_SECRET_KEY', 'telegram-media-bot-secret-key-2024')
 
-# Initialize database with app
+# Initialize database with app. Web requests get a session per request (removed when
+# the request's app context ends); the bot gets one per update via AsyncDatabase.
 db.init_app(app)
 
 # Environment variables with fallbacks
@@ -31,13 +38,44 @@ STORAGE_CHANNEL_ID = os.getenv('STORAGE_CHANNEL_ID') or '-1002666294417'
 ADMIN_ID = os.getenv('ADMIN_ID') or '6226404256'
 port = int(os.getenv('PORT', 5000))
 
+# Refuse to start without secrets to sign verification links and tag bundle/file links with
+signing_key()
+link_tag_key()
+
 # Check if bot can start
 BOT_CAN_START = all([BOT_TOKEN, BOT_USERNAME, LINKSHORTIFY_API_KEY, STORAGE_CHANNEL_ID, ADMIN_ID])
 
-# Create tables
+# Create tables and apply pending schema migrations
 with app.app_context():
+    configure_sqlite(db.engine)
     db.create_all()
     print("Database tables created successfully!")
+    applied = run_migrations(db.engine)
+    if applied:
+        print(f"Applied {applied} database migration(s)")
+    instrument_engine(db.engine)
+
+cache_metrics([token_cache, user_cache, manifest_cache, missing_bundle_cache, used_link_cache])
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def observe_request(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        HTTP_REQUEST_SECONDS.observe(
+            time.perf_counter() - started,
+            route=request.url_rule.rule if request.url_rule else 'unmatched',
+            status=response.status_code
+        )
+    return response
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus text exposition of bot and web metrics"""
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
 
 @app.route('/')
 def status_page():
@@ -49,6 +87,8 @@ def status_page():
     config_status.append(f"Storage Channel: {'✅ Configured' if STORAGE_CHANNEL_ID else '❌ Missing'}")
     config_status.append(f"Bot Admin ID: {'✅ Configured' if ADMIN_ID else '❌ Missing'}")
     
+    cache_stats = token_cache.stats()
+    
     return f"""
     <html>
     <head>
@@ -80,6 +120,12 @@ def status_page():
             <li><strong>Health Check:</strong> ✅ Available</li>
         </ul>
         
+        <h3>Token Cache:</h3>
+        <ul>
+            <li><strong>Entries:</strong> {cache_stats['size']} / {cache_stats['maxsize']}</li>
+            <li><strong>Hits / Misses:</strong> {cache_stats['hits']} / {cache_stats['misses']} ({cache_stats['hit_rate']:.1%})</li>
+        </ul>
+        
         {f'<p>Bot available at: <a href="https://t.me/{BOT_USERNAME}" target="_blank">@{BOT_USERNAME}</a></p>' if BOT_USERNAME else ''}
         
         {'' if BOT_CAN_START else '<div class="status error"><strong>Note:</strong> Bot cannot start due to missing environment variables.</div>'}
@@ -88,46 +134,36 @@ def status_page():
     """
 
 @app.route('/verify')
-@app.route('/verify-token')
+@app.route(VERIFY_TOKEN_PATH)
 def verify_token():
     """Token verification endpoint"""
-    def decode_token_data(encoded_data):
-        try:
-            import base64
-            import json
-            decoded_bytes = base64.b64decode(encoded_data + '==')
-            decoded_str = decoded_bytes.decode('utf-8')
-            return json.loads(decoded_str)
-        except Exception as e:
-            print(f"Token decode error: {e}")
-            return None
-    
     token_data_encoded = request.args.get('token')
     if not token_data_encoded:
         return "Invalid verification link", 400
     
     try:
+        # Signature, expiry and replay are checked before any database work
         token_data = decode_token_data(token_data_encoded)
         if not token_data:
-            return "Invalid token data", 400
+            return "Invalid or expired verification link", 400
+        if link_already_used(token_data):
+            return "Verification link already used", 409
         
         user_id = token_data.get('user_id')
         token_value = token_data.get('token')
         
-        with app.app_context():
+        if str(user_id) == POOL_USER_ID:
+            # Pre-generated link: activate the token for whoever claimed it
+            if not activate_pending_token(token_value):
+                return "Verification link expired", 400
+        else:
             user = User.query.filter_by(telegram_id=str(user_id)).first()
             if not user:
                 return "User not found", 404
             
-            # Create new token
-            new_token = UserToken()
-            new_token.user_id = user.id
-            new_token.token = token_value
-            new_token.expires_at = datetime.utcnow() + timedelta(hours=24)
-            new_token.is_active = True
-            
-            db.session.add(new_token)
-            db.session.commit()
+            # Activate the token, deactivating the user's previous ones
+            activate_user_token(user, token_value)
+        mark_link_used(token_data)
         
         # Return success page
         return f"""
@@ -163,7 +199,9 @@ def verify_token():
         print(f"Verification error: {e}")
         return f"Verification failed: {str(e)}", 500
 
-@app.route('/ads-verification')
+@app.route(ADS_VERIFICATION_PATH)
+# Fallback links handed out by earlier versions pointed here
+@app.route('/ads-verify')
 def ads_verification():
     """Ads verification page"""
     import urllib.parse
@@ -210,10 +248,32 @@ def ads_verification():
     </html>
     """
 
+def check_linked_routes():
+    """Fail fast if a page that bot-generated links point at has no route"""
+    adapter = app.url_map.bind('localhost')
+    for path in LINKED_PATHS:
+        try:
+            adapter.match(path)
+        except Exception as e:
+            raise RuntimeError(f"Generated links point at {path}, which has no Flask route ({e})")
+
+check_linked_routes()
+
 def run_flask():
     """Run Flask server"""
     app.run(host='0.0.0.0', port=port, debug=False)
 
+def create_bot() -> TelegramBotBundle:
+    """Build the bot from the environment configuration"""
+    return TelegramBotBundle(
+        token=BOT_TOKEN,
+        bot_username=BOT_USERNAME,
+        linkshortify_api_key=LINKSHORTIFY_API_KEY,
+        storage_channel_id=STORAGE_CHANNEL_ID,
+        admin_id=ADMIN_ID,
+        flask_app=app
+    )
+
 def run_telegram_bot():
     """Start Telegram bot"""
     if not BOT_CAN_START:
@@ -221,13 +281,7 @@ def run_telegram_bot():
         return
     
     try:
-        bot = TelegramBotBundle(
-            token=BOT_TOKEN,
-            bot_username=BOT_USERNAME,
-            linkshortify_api_key=LINKSHORTIFY_API_KEY,
-            storage_channel_id=STORAGE_CHANNEL_ID,
-            admin_id=ADMIN_ID
-        )
+        bot = create_bot()
         bot.run()
     except Exception as e:
         print(f"Bot error: {e}")
@@ -247,8 +301,8 @@ if __name__ == "__main__":
         print("Database: Connected")
         print("Running on Replit - Stable Hosting")
         
-        # Start Telegram bot after conflict resolution
-        print("Starting Telegram bot after conflict resolution...")
+        # Replicas wait as standby until they hold the polling lease
+        print("Starting Telegram bot (polling once this replica holds the leader lease)...")
         run_telegram_bot()
         
     except Exception as e:
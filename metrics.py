@@ -0,0 +1,247 @@
+"""
+In-process metrics in the Prometheus text exposition format.
+
+Histograms and counters are updated from the event loop and from the database
+threads, so every metric has its own lock. Values that other components already
+track (cache hit counts, queue depths, breaker state) are read at scrape time
+through callback metrics instead of being duplicated here. Served at /metrics.
+"""
+import re
+import time
+import bisect
+import functools
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Tuple
+
+# Seconds; covers cache-hit handlers up to slow Bot API uploads
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """Base class: a named family of samples with fixed label names"""
+
+    type = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    """Monotonically increasing count per label set"""
+
+    type = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in items]
+
+
+class Histogram(Metric):
+    """Cumulative bucket counts, sum and count per label set"""
+
+    type = 'histogram'
+
+    def __init__(self, *args, buckets: Iterable[float] = DEFAULT_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets))
+        # label key -> [per-bucket counts..., +Inf count, sum]
+        self._values: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * (len(self.buckets) + 2)
+            state[index] += 1
+            state[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the with-block"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = [(key, list(state)) for key, state in self._values.items()]
+        lines = []
+        for key, state in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), state[:-1]):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, f'le="{_format_value(bound)}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(state[-1])}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class CallbackMetric(Metric):
+    """Samples computed at scrape time by a callback returning {label values: value}"""
+
+    def __init__(self, name: str, documentation: str, callback: Callable[[], Dict[Tuple[str, ...], float]],
+                 labelnames: Iterable[str] = (), type: str = 'gauge'):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+        self.type = type
+
+    def samples(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in self.callback().items()
+        ]
+
+
+class Registry:
+    """Holds every metric and renders the exposition text"""
+
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        """Add a metric; registering the same name again replaces it (e.g. a rebuilt bot)"""
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        blocks = []
+        for metric in metrics:
+            try:
+                blocks.append(metric.render())
+            except Exception as e:
+                blocks.append(f"# {metric.name} unavailable: {_escape(e)}")
+        return '\n'.join(blocks) + '\n'
+
+
+REGISTRY = Registry()
+
+HANDLER_SECONDS = REGISTRY.register(Histogram(
+    'bot_handler_seconds', 'Time spent in bot update handlers', ['handler']))
+HANDLER_ERRORS = REGISTRY.register(Counter(
+    'bot_handler_errors_total', 'Exceptions raised by bot update handlers', ['handler']))
+TELEGRAM_API_SECONDS = REGISTRY.register(Histogram(
+    'telegram_api_seconds', 'Latency of outbound Bot API calls (per attempt)', ['method']))
+TELEGRAM_ERRORS = REGISTRY.register(Counter(
+    'telegram_api_errors_total', 'Bot API calls that raised, by error type', ['method', 'error']))
+SQL_SECONDS = REGISTRY.register(Histogram(
+    'db_statement_seconds', 'Database statement execution time by statement class', ['statement']))
+HTTP_CLIENT_SECONDS = REGISTRY.register(Histogram(
+    'http_client_seconds', 'Latency of outbound HTTP calls (per attempt)', ['service', 'operation', 'outcome']))
+HTTP_REQUEST_SECONDS = REGISTRY.register(Histogram(
+    'http_request_seconds', 'Latency of web routes', ['route', 'status']))
+
+
+def observe_handler(fn):
+    """Decorator timing an async bot handler under its function name"""
+    name = fn.__name__
+
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await fn(*args, **kwargs)
+        except Exception:
+            HANDLER_ERRORS.inc(handler=name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, handler=name)
+
+    return wrapper
+
+
+_TABLE_PATTERN = re.compile(r'\b(?:FROM|INTO|UPDATE)\s+"?(\w+)', re.IGNORECASE)
+
+
+def statement_class(statement: str) -> str:
+    """Bounded label for a SQL statement: verb plus first table, e.g. 'SELECT user_tokens'"""
+    stripped = statement.lstrip()
+    verb = stripped.split(None, 1)[0].upper() if stripped else 'EMPTY'
+    match = _TABLE_PATTERN.search(stripped)
+    return f"{verb} {match.group(1)}" if match else verb
+
+
+def instrument_engine(engine):
+    """Time every statement executed on a SQLAlchemy engine"""
+    from sqlalchemy import event
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('metrics_started', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info['metrics_started'].pop()
+        SQL_SECONDS.observe(time.perf_counter() - started, statement=statement_class(statement))
+
+    @event.listens_for(engine, 'handle_error')
+    def _error(exception_context):
+        conn = exception_context.connection
+        if conn is not None and conn.info.get('metrics_started'):
+            conn.info['metrics_started'].pop()
+
+
+def cache_metrics(caches: Iterable) -> None:
+    """Expose hit/miss counters and sizes of TTLCache instances"""
+    caches = list(caches)
+
+    def collect(field):
+        return lambda: {(cache.name,): cache.stats()[field] for cache in caches}
+
+    REGISTRY.register(CallbackMetric(
+        'cache_hits_total', 'Cache lookups that found a live entry', collect('hits'), ['cache'], type='counter'))
+    REGISTRY.register(CallbackMetric(
+        'cache_misses_total', 'Cache lookups that found nothing', collect('misses'), ['cache'], type='counter'))
+    REGISTRY.register(CallbackMetric(
+        'cache_entries', 'Entries currently held', collect('size'), ['cache']))
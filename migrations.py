@@ -0,0 +1,166 @@
+"""
+Versioned schema migrations.
+
+db.create_all() only creates missing tables, it never changes existing ones. Each
+migration below runs once per database and is recorded in schema_migrations.
+Statements must work on both SQLite and Postgres and be safe to re-run. Several
+processes may start at the same time: on Postgres each migration runs under a
+transaction-scoped advisory lock and re-checks schema_migrations once it holds
+it; SQLite serializes writers itself. A step is either a SQL string or a callable
+taking the connection, for changes plain SQL can't express portably.
+"""
+import logging
+from datetime import datetime
+from sqlalchemy import MetaData, Table, Column, Integer, String, DateTime, inspect, select, text
+from sqlalchemy.exc import IntegrityError, OperationalError
+from utils import compact_key
+
+logger = logging.getLogger(__name__)
+
+metadata = MetaData()
+
+schema_migrations = Table(
+    'schema_migrations', metadata,
+    Column('version', Integer, primary_key=True),
+    Column('description', String(255), nullable=False),
+    Column('applied_at', DateTime, nullable=False, default=datetime.utcnow)
+)
+
+BACKFILL_BATCH_SIZE = 1000
+
+# Arbitrary key for pg_advisory_xact_lock, shared by every process running migrations
+MIGRATION_LOCK_ID = 7305481
+
+
+def _add_column(table: str, column: str, ddl_type: str):
+    """Step adding a column unless create_all (or another process) already made it"""
+    def step(conn):
+        if conn.dialect.name == 'postgresql':
+            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column} {ddl_type}"))
+            return
+        # SQLite has no ADD COLUMN IF NOT EXISTS
+        if column in {col['name'] for col in inspect(conn).get_columns(table)}:
+            return
+        try:
+            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl_type}"))
+        except OperationalError as e:
+            if 'duplicate column' not in str(e).lower():
+                raise
+    return step
+
+
+def _backfill_compact_keys(conn):
+    """Derive bundle_key/file_key for rows written before the integer keys existed"""
+    bundles = files = 0
+    while True:
+        rows = conn.execute(text(
+            "SELECT id, bundle_id FROM file_bundles WHERE bundle_key IS NULL ORDER BY id LIMIT :limit"
+        ), {'limit': BACKFILL_BATCH_SIZE}).fetchall()
+        if not rows:
+            break
+        conn.execute(
+            text("UPDATE file_bundles SET bundle_key = :key WHERE id = :id"),
+            [{'id': row.id, 'key': compact_key(row.bundle_id)} for row in rows]
+        )
+        bundles += len(rows)
+    while True:
+        rows = conn.execute(text(
+            "SELECT id, file_id, bundle_id FROM media_files WHERE file_key IS NULL ORDER BY id LIMIT :limit"
+        ), {'limit': BACKFILL_BATCH_SIZE}).fetchall()
+        if not rows:
+            break
+        conn.execute(
+            text("UPDATE media_files SET file_key = :file_key, bundle_key = :bundle_key WHERE id = :id"),
+            [
+                {
+                    'id': row.id,
+                    'file_key': compact_key(row.file_id),
+                    'bundle_key': compact_key(row.bundle_id) if row.bundle_id else None
+                }
+                for row in rows
+            ]
+        )
+        files += len(rows)
+    if bundles or files:
+        logger.info(f"Backfilled compact keys for {bundles} bundles and {files} files")
+
+
+# (version, description, statements)
+MIGRATIONS = [
+    (1, "Composite index for active-token lookups", [
+        "CREATE INDEX IF NOT EXISTS ix_user_tokens_user_active_expires "
+        "ON user_tokens (user_id, is_active, expires_at)",
+    ]),
+    (2, "Index media files by bundle in insertion order", [
+        "CREATE INDEX IF NOT EXISTS ix_media_files_bundle_id "
+        "ON media_files (bundle_id, id)",
+    ]),
+    (3, "Index access logs by user and time", [
+        "CREATE INDEX IF NOT EXISTS ix_access_logs_user_timestamp "
+        "ON access_logs (user_id, timestamp)",
+    ]),
+    (4, "Index tokens by expiry for the background sweeper", [
+        "CREATE INDEX IF NOT EXISTS ix_user_tokens_expires_at "
+        "ON user_tokens (expires_at)",
+    ]),
+    (5, "Integer keys for bundles and media files", [
+        _add_column('file_bundles', 'bundle_key', 'BIGINT'),
+        _add_column('media_files', 'file_key', 'BIGINT'),
+        _add_column('media_files', 'bundle_key', 'BIGINT'),
+        _backfill_compact_keys,
+        "CREATE UNIQUE INDEX IF NOT EXISTS ux_file_bundles_bundle_key "
+        "ON file_bundles (bundle_key)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS ux_media_files_file_key "
+        "ON media_files (file_key)",
+        "CREATE INDEX IF NOT EXISTS ix_media_files_bundle_key "
+        "ON media_files (bundle_key, id)",
+    ]),
+    (6, "Drop the media files bundle_id index superseded by bundle_key", [
+        "DROP INDEX IF EXISTS ix_media_files_bundle_id",
+    ]),
+]
+
+
+def applied_versions(engine) -> set:
+    """Return the set of migration versions already applied"""
+    metadata.create_all(engine, tables=[schema_migrations], checkfirst=True)
+    with engine.connect() as conn:
+        return set(conn.execute(select(schema_migrations.c.version)).scalars())
+
+
+def run_migrations(engine) -> int:
+    """Apply pending migrations in order and return how many were applied"""
+    done = applied_versions(engine)
+    applied = 0
+
+    for version, description, statements in MIGRATIONS:
+        if version in done:
+            continue
+
+        try:
+            with engine.begin() as conn:
+                if conn.dialect.name == 'postgresql':
+                    # Wait for any other process migrating, then see whether it already did this one
+                    conn.execute(text("SELECT pg_advisory_xact_lock(:id)"), {'id': MIGRATION_LOCK_ID})
+                    if conn.execute(select(schema_migrations.c.version).where(
+                        schema_migrations.c.version == version
+                    )).first():
+                        logger.info(f"Migration {version} already applied by another process")
+                        continue
+                for statement in statements:
+                    if callable(statement):
+                        statement(conn)
+                    else:
+                        conn.execute(text(statement))
+                conn.execute(schema_migrations.insert().values(
+                    version=version,
+                    description=description,
+                    applied_at=datetime.utcnow()
+                ))
+            applied += 1
+            logger.info(f"Applied migration {version}: {description}")
+        except IntegrityError:
+            # Another process recorded this version first
+            logger.info(f"Migration {version} already applied by another process")
+
+    return applied
@@ -1,15 +1,17 @@
 import os
-from datetime import datetime, timedelta
+from datetime import datetime
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.orm import DeclarativeBase
-from sqlalchemy import Column, Integer, String, DateTime, Text, Boolean
+from sqlalchemy import Column, Integer, BigInteger, String, DateTime, Text, Boolean, Index
 
 
 class Base(DeclarativeBase):
     pass
 
 
-db = SQLAlchemy(model_class=Base)
+# Objects are handed back to the event loop after their session closes, so keep
+# loaded attributes usable instead of expiring them on commit
+db = SQLAlchemy(model_class=Base, session_options={'expire_on_commit': False})
 
 
 class User(db.Model):
@@ -28,6 +30,10 @@ class User(db.Model):
 
 class UserToken(db.Model):
     __tablename__ = 'user_tokens'
+    __table_args__ = (
+        Index('ix_user_tokens_user_active_expires', 'user_id', 'is_active', 'expires_at'),
+        Index('ix_user_tokens_expires_at', 'expires_at'),
+    )
     
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, db.ForeignKey('users.id'), nullable=False)
@@ -47,9 +53,14 @@ class UserToken(db.Model):
 
 class FileBundle(db.Model):
     __tablename__ = 'file_bundles'
+    __table_args__ = (
+        Index('ux_file_bundles_bundle_key', 'bundle_key', unique=True),
+    )
     
     id = Column(Integer, primary_key=True)
     bundle_id = Column(String(255), unique=True, nullable=False)
+    # compact_key(bundle_id): what deep links carry and what media files join on
+    bundle_key = Column(BigInteger, nullable=True)
     created_by = Column(Integer, db.ForeignKey('users.id'), nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
     title = Column(String(255), nullable=True)
@@ -63,10 +74,17 @@ class FileBundle(db.Model):
 
 class MediaFile(db.Model):
     __tablename__ = 'media_files'
+    __table_args__ = (
+        Index('ix_media_files_bundle_key', 'bundle_key', 'id'),
+        Index('ux_media_files_file_key', 'file_key', unique=True),
+    )
     
     id = Column(Integer, primary_key=True)
     file_id = Column(String(255), unique=True, nullable=False)
     bundle_id = Column(String(255), db.ForeignKey('file_bundles.bundle_id'), nullable=True)
+    # Integer counterparts of file_id and bundle_id (see utils.compact_key)
+    file_key = Column(BigInteger, nullable=True)
+    bundle_key = Column(BigInteger, nullable=True)
     file_name = Column(String(255), nullable=True)
     file_type = Column(String(50), nullable=False)
     file_size = Column(Integer, nullable=True)
@@ -84,11 +102,14 @@ class MediaFile(db.Model):
 
 class AccessLog(db.Model):
     __tablename__ = 'access_logs'
+    __table_args__ = (
+        Index('ix_access_logs_user_timestamp', 'user_id', 'timestamp'),
+    )
     
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, db.ForeignKey('users.id'), nullable=False)
     file_id = Column(Integer, db.ForeignKey('media_files.id'), nullable=True)
-    action = Column(String(50), nullable=False)  # 'token_refresh', 'file_access', 'ads_verification'
+    action = Column(String(50), nullable=False)  # 'token_refresh', 'file_access', 'bundle_access', 'ads_verification'
     timestamp = Column(DateTime, default=datetime.utcnow)
     ip_address = Column(String(45), nullable=True)
     user_agent = Column(Text, nullable=True)
@@ -98,3 +119,27 @@ class AccessLog(db.Model):
     
     def __repr__(self):
         return f'<AccessLog {self.action} by {self.user_id}>'
+
+
+class BotLease(db.Model):
+    __tablename__ = 'bot_leases'
+    
+    name = Column(String(100), primary_key=True)
+    holder = Column(String(255), nullable=False)
+    expires_at = Column(DateTime, nullable=False)
+    
+    def __repr__(self):
+        return f'<BotLease {self.name} held by {self.holder}>'
+
+
+class ProcessedUpdate(db.Model):
+    __tablename__ = 'processed_updates'
+    __table_args__ = (
+        Index('ix_processed_updates_processed_at', 'processed_at'),
+    )
+    
+    update_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    processed_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<ProcessedUpdate {self.update_id}>'
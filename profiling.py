@@ -0,0 +1,148 @@
+"""
+Per-update profiling for bot handlers.
+
+UpdateProfiler.wrap() is applied to every registered handler. While a handler
+runs, a context variable collects how long it waited on the database, on Bot
+API calls (including rate-limit waits) and on LinkShortify; updates slower than
+SLOW_UPDATE_SECONDS are logged with that breakdown. An admin can also arm a
+cProfile + tracemalloc capture for the next N updates, which is written to
+PROFILE_DIR when done. cProfile sees the whole event loop thread, so the
+capture includes whatever else ran concurrently.
+"""
+import os
+import io
+import time
+import pstats
+import cProfile
+import logging
+import tracemalloc
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from functools import wraps
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+CATEGORIES = ('db', 'telegram', 'rate_limit', 'linkshortify')
+
+_breakdown: ContextVar[Optional[Dict[str, float]]] = ContextVar('update_breakdown', default=None)
+
+
+def add_time(category: str, seconds: float):
+    """Charge seconds to a category of the update being handled (no-op outside a handler)"""
+    breakdown = _breakdown.get()
+    if breakdown is not None:
+        breakdown[category] = breakdown.get(category, 0.0) + seconds
+
+
+@contextmanager
+def timed(category: str):
+    """Charge the duration of the with-block to category"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time(category, time.perf_counter() - started)
+
+
+class UpdateProfiler:
+    """Wraps handlers with timing breakdowns, slow-update logging and on-demand profiling"""
+
+    def __init__(self, slow_threshold: float = None, output_dir: str = None):
+        self.slow_threshold = slow_threshold or float(os.getenv('SLOW_UPDATE_SECONDS', 1.0))
+        self.output_dir = output_dir or os.getenv('PROFILE_DIR', 'profiles')
+        self.slow_updates = 0
+        self.capture_remaining = 0
+        self.capture_total = 0
+        self.profile: Optional[cProfile.Profile] = None
+        self.profiled_in_flight = 0
+        self.on_capture_done = None
+
+    def start_capture(self, updates: int, on_done=None):
+        """Profile the next `updates` handler runs; on_done(path) is awaited with the report path"""
+        if self.profile is not None:
+            raise RuntimeError("A profiling capture is already running")
+        self.profile = cProfile.Profile()
+        self.capture_remaining = self.capture_total = updates
+        self.on_capture_done = on_done
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(10)
+        logger.info(f"Profiling capture armed for the next {updates} updates")
+
+    def wrap(self, handler):
+        """Return handler wrapped with breakdown timing and optional profiling"""
+        name = getattr(handler, '__name__', repr(handler))
+
+        @wraps(handler)
+        async def wrapper(update, context):
+            breakdown: Dict[str, float] = {}
+            token = _breakdown.set(breakdown)
+            profiling = self.capture_remaining > 0
+            started = time.perf_counter()
+            if profiling:
+                # Concurrent updates share one profiler; it runs while any of them is in flight
+                if self.profiled_in_flight == 0:
+                    self.profile.enable()
+                self.profiled_in_flight += 1
+            try:
+                return await handler(update, context)
+            finally:
+                if profiling:
+                    self.profiled_in_flight -= 1
+                    if self.profiled_in_flight == 0:
+                        self.profile.disable()
+                elapsed = time.perf_counter() - started
+                _breakdown.reset(token)
+                if elapsed >= self.slow_threshold:
+                    self._log_slow(name, update, elapsed, breakdown)
+                if profiling:
+                    await self._count_captured()
+
+        return wrapper
+
+    def _log_slow(self, name: str, update, elapsed: float, breakdown: Dict[str, float]):
+        self.slow_updates += 1
+        accounted = sum(breakdown.get(category, 0.0) for category in CATEGORIES)
+        parts = ', '.join(f"{category} {breakdown.get(category, 0.0):.3f}s" for category in CATEGORIES)
+        update_id = getattr(update, 'update_id', None)
+        logger.warning(
+            f"Slow update {update_id} in {name}: {elapsed:.3f}s "
+            f"({parts}, other {max(elapsed - accounted, 0.0):.3f}s)"
+        )
+
+    async def _count_captured(self):
+        self.capture_remaining -= 1
+        if self.capture_remaining > 0 or self.profiled_in_flight or self.profile is None:
+            return
+        self.capture_remaining = 0
+        path = self._write_report()
+        callback, self.on_capture_done = self.on_capture_done, None
+        if callback:
+            try:
+                await callback(path)
+            except Exception as e:
+                logger.error(f"Error reporting profile capture: {e}")
+
+    def _write_report(self) -> str:
+        os.makedirs(self.output_dir, exist_ok=True)
+        stamp = datetime.utcnow().strftime('%Y%m%d-%H%M%S')
+        base = os.path.join(self.output_dir, f"profile-{stamp}")
+
+        profile, self.profile = self.profile, None
+        profile.dump_stats(f"{base}.prof")
+        report = io.StringIO()
+        report.write(f"Profile of {self.capture_total} updates, captured {stamp} UTC\n\n")
+        pstats.Stats(profile, stream=report).sort_stats('cumulative').print_stats(40)
+
+        if tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            report.write("\nTop memory allocations (tracemalloc)\n")
+            for stat in snapshot.statistics('lineno')[:25]:
+                report.write(f"{stat}\n")
+
+        with open(f"{base}.txt", 'w') as f:
+            f.write(report.getvalue())
+        logger.info(f"Profiling capture written to {base}.txt")
+        return f"{base}.txt"
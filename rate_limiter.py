@@ -0,0 +1,157 @@
+import os
+import time
+import random
+import asyncio
+import logging
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Any, Awaitable, Callable, Dict, Optional
+import httpx
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError
+from metrics import TELEGRAM_API_SECONDS, TELEGRAM_ERRORS
+from profiling import add_time
+
+logger = logging.getLogger(__name__)
+
+# Bot API methods that create a message; repeating one after Telegram accepted it duplicates it
+NON_IDEMPOTENT_PREFIXES = ('send_', 'forward_', 'copy_')
+
+# httpx errors raised before the request reached Telegram (PTB chains them as __cause__)
+_NOT_SENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+def failed_before_sending(error: NetworkError) -> bool:
+    """True if the request certainly never reached Telegram, so repeating it is always safe"""
+    return isinstance(error.__cause__, _NOT_SENT_ERRORS)
+
+
+class TokenBucket:
+    """Token bucket that hands out reservations instead of busy-waiting.
+
+    reserve() always succeeds and returns how long the caller has to wait for its
+    slot, so concurrent senders queue up in arrival order without polling.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def reserve(self, cost: float = 1) -> float:
+        """Take cost tokens and return the delay in seconds before they are usable"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= cost
+        delay = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        return max(delay, self.blocked_until - now)
+
+    def block(self, seconds: float):
+        """Hold every new reservation back for a while (after a flood-control error)"""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class OutboundScheduler:
+    """Single gate for every outbound Bot API send.
+
+    A global bucket keeps the bot under Telegram's ~30 messages/second limit and a
+    per-chat bucket under the per-chat limits (about 1/s in private chats, 20/min
+    in groups and channels). RetryAfter is honoured automatically and transient
+    network errors are retried with jittered exponential backoff; for sends that
+    create messages only when the request provably never reached Telegram, since a
+    timed-out send may still have been delivered.
+    """
+
+    def __init__(self, global_rate: float = None, private_chat_rate: float = None,
+                 group_chat_rate: float = None, max_retries: int = 5, max_chats: int = 10000):
+        global_rate = global_rate or float(os.getenv('OUTBOUND_GLOBAL_RATE', 30))
+        self.global_bucket = TokenBucket(rate=global_rate, capacity=global_rate)
+        self.private_chat_rate = private_chat_rate or float(os.getenv('OUTBOUND_CHAT_RATE', 1))
+        self.group_chat_rate = group_chat_rate or float(os.getenv('OUTBOUND_GROUP_RATE', 20)) / 60
+        self.max_retries = max_retries
+        self.max_chats = max_chats
+        self.chat_buckets: "OrderedDict[Any, TokenBucket]" = OrderedDict()
+        self.stats: Dict[str, int] = {'calls': 0, 'retry_after': 0, 'retries': 0, 'failures': 0}
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        """Get (or create) the bucket for a chat, evicting the least recently used"""
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            # Private chats have positive ids; groups, supergroups and channels negative
+            # ones, and channels may also be addressed by @username
+            is_private = str(chat_id).lstrip('-').isdigit() and int(chat_id) > 0
+            rate = self.private_chat_rate if is_private else self.group_chat_rate
+            bucket = TokenBucket(rate=rate, capacity=3 if is_private else 1)
+            self.chat_buckets[chat_id] = bucket
+            while len(self.chat_buckets) > self.max_chats:
+                self.chat_buckets.popitem(last=False)
+        else:
+            self.chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    async def _acquire(self, chat_id, cost: int):
+        """Wait until both the chat and the global bucket allow the send"""
+        delay = self._chat_bucket(chat_id).reserve(1) if chat_id is not None else 0.0
+        delay = max(delay, self.global_bucket.reserve(cost))
+        if delay > 0:
+            await asyncio.sleep(delay)
+            add_time('rate_limit', delay)
+
+    @staticmethod
+    async def _invoke(method: Callable[..., Awaitable], chat_id, kwargs: Dict[str, Any]):
+        """One Bot API attempt, timed and error-counted for /metrics"""
+        method_name = getattr(method, '__name__', 'unknown')
+        started = time.perf_counter()
+        if chat_id is not None:
+            kwargs = dict(kwargs, chat_id=chat_id)
+        try:
+            return await method(**kwargs)
+        except TelegramError as e:
+            TELEGRAM_ERRORS.inc(method=method_name, error=type(e).__name__)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            TELEGRAM_API_SECONDS.observe(elapsed, method=method_name)
+            add_time('telegram', elapsed)
+
+    async def call(self, method: Callable[..., Awaitable], *, chat_id=None, cost: int = 1,
+                   idempotent: Optional[bool] = None, **kwargs):
+        """Invoke a Bot API method under rate limits, retrying on flood control.
+
+        cost is the number of messages the call produces (e.g. album size) and is
+        charged against the global bucket; each call counts once per chat. Calls
+        that don't post to a chat (answer_callback_query) pass no chat_id and only
+        count against the global bucket.
+        idempotent defaults to False for send_*/forward_*/copy_* methods.
+        """
+        if idempotent is None:
+            idempotent = not getattr(method, '__name__', '').startswith(NON_IDEMPOTENT_PREFIXES)
+        for attempt in range(self.max_retries + 1):
+            await self._acquire(chat_id, cost)
+            self.stats['calls'] += 1
+            try:
+                return await self._invoke(method, chat_id, kwargs)
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                if isinstance(retry_after, timedelta):
+                    retry_after = retry_after.total_seconds()
+                self.stats['retry_after'] += 1
+                logger.warning(f"Flood control on chat {chat_id}, retrying in {retry_after}s")
+                self._chat_bucket(chat_id).block(retry_after)
+                if attempt == self.max_retries:
+                    self.stats['failures'] += 1
+                    raise
+            except BadRequest:
+                # Permanent request errors (BadRequest subclasses NetworkError)
+                self.stats['failures'] += 1
+                raise
+            except NetworkError as e:
+                if attempt == self.max_retries or not (idempotent or failed_before_sending(e)):
+                    self.stats['failures'] += 1
+                    raise
+                backoff = min(30.0, 0.5 * 2 ** attempt) * random.uniform(0.5, 1.5)
+                self.stats['retries'] += 1
+                logger.warning(f"Network error sending to {chat_id} ({e}), retrying in {backoff:.1f}s")
+                await asyncio.sleep(backoff)
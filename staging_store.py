@@ -0,0 +1,273 @@
+"""
+Staging stores for in-progress upload collections.
+
+An admin's uploads are staged here until /done turns them into a bundle. Only a
+compact record of each file is kept (ids, type, name, size, caption), so
+collections survive restarts and can be shared between processes. Abandoned
+collections are evicted after a TTL and each admin's collection is size-capped.
+"""
+import os
+import json
+import time
+import asyncio
+import sqlite3
+import logging
+import threading
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Fields kept per staged file
+RECORD_FIELDS = ('telegram_file_id', 'file_type', 'file_name', 'file_size', 'caption', 'storage_message_id')
+
+
+class CollectionFullError(Exception):
+    """Raised when an admin's collection already holds max_files files"""
+
+    def __init__(self, max_files: int):
+        super().__init__(f"Collection is limited to {max_files} files")
+        self.max_files = max_files
+
+
+def compact_record(file_info: Dict[str, Any]) -> Dict[str, Any]:
+    """Keep only the fields worth staging"""
+    return {field: file_info.get(field) for field in RECORD_FIELDS}
+
+
+class StagingStore:
+    """Interface every staging backend implements"""
+
+    def __init__(self, ttl: float = None, max_files: int = None):
+        self.ttl = ttl or float(os.getenv('STAGING_TTL', 24 * 3600))
+        self.max_files = max_files or int(os.getenv('STAGING_MAX_FILES', 1000))
+        self.eviction_task: Optional[asyncio.Task] = None
+
+    async def add_file(self, admin_id, record: Dict[str, Any]) -> int:
+        """Append a record and return the new collection size (CollectionFullError if full)"""
+        raise NotImplementedError
+
+    async def add_files(self, admin_id, records: List[Dict[str, Any]]) -> int:
+        """Append several records at once; all or nothing with respect to the size cap"""
+        raise NotImplementedError
+
+    async def get_files(self, admin_id) -> List[Dict[str, Any]]:
+        """Return the admin's staged records in upload order"""
+        raise NotImplementedError
+
+    async def count(self, admin_id) -> int:
+        """Return how many files the admin has staged"""
+        raise NotImplementedError
+
+    async def clear(self, admin_id) -> int:
+        """Drop the admin's collection (and its reserved bundle id) and return how many files it held"""
+        raise NotImplementedError
+
+    async def reserve_bundle_id(self, admin_id, candidate: str) -> str:
+        """Return the bundle id reserved for the admin's collection, reserving candidate if there is none"""
+        raise NotImplementedError
+
+    async def evict_expired(self) -> int:
+        """Drop collections untouched for longer than the TTL; returns files removed"""
+        return 0
+
+    def start(self, interval: float = 600):
+        """Start periodic eviction of abandoned collections"""
+        self.eviction_task = asyncio.create_task(self._evict_periodically(interval), name="staging-eviction")
+
+    async def close(self):
+        """Stop background work and release resources"""
+        if self.eviction_task:
+            self.eviction_task.cancel()
+            await asyncio.gather(self.eviction_task, return_exceptions=True)
+            self.eviction_task = None
+
+    async def _evict_periodically(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                removed = await self.evict_expired()
+                if removed:
+                    logger.info(f"Evicted {removed} files from abandoned collections")
+            except Exception as e:
+                logger.error(f"Error evicting staged collections: {e}")
+
+
+class SQLiteStagingStore(StagingStore):
+    """Default backend: a local SQLite database in WAL mode"""
+
+    def __init__(self, path: str = None, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path or os.getenv('STAGING_DB_PATH', 'staging.db')
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS staged_files ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " admin_id TEXT NOT NULL,"
+            " record TEXT NOT NULL,"
+            " created_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS ix_staged_files_admin ON staged_files (admin_id, id)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS staged_bundles ("
+            " admin_id TEXT PRIMARY KEY,"
+            " bundle_id TEXT NOT NULL)"
+        )
+
+    def _add_files(self, admin_id, records: List[Dict[str, Any]]) -> int:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                (count,) = self._conn.execute(
+                    "SELECT COUNT(*) FROM staged_files WHERE admin_id = ?", (str(admin_id),)
+                ).fetchone()
+                if count + len(records) > self.max_files:
+                    raise CollectionFullError(self.max_files)
+                now = time.time()
+                self._conn.executemany(
+                    "INSERT INTO staged_files (admin_id, record, created_at) VALUES (?, ?, ?)",
+                    [(str(admin_id), json.dumps(compact_record(record)), now) for record in records]
+                )
+                self._conn.execute("COMMIT")
+                return count + len(records)
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _query(self, sql: str, params: tuple) -> list:
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def _execute(self, sql: str, params: tuple) -> int:
+        with self._lock:
+            return self._conn.execute(sql, params).rowcount
+
+    def _clear(self, admin_id) -> int:
+        with self._lock:
+            self._conn.execute("DELETE FROM staged_bundles WHERE admin_id = ?", (str(admin_id),))
+            return self._conn.execute("DELETE FROM staged_files WHERE admin_id = ?", (str(admin_id),)).rowcount
+
+    def _reserve_bundle_id(self, admin_id, candidate: str) -> str:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO staged_bundles (admin_id, bundle_id) VALUES (?, ?)", (str(admin_id), candidate)
+            )
+            return self._conn.execute(
+                "SELECT bundle_id FROM staged_bundles WHERE admin_id = ?", (str(admin_id),)
+            ).fetchone()[0]
+
+    async def add_file(self, admin_id, record: Dict[str, Any]) -> int:
+        return await asyncio.to_thread(self._add_files, admin_id, [record])
+
+    async def add_files(self, admin_id, records: List[Dict[str, Any]]) -> int:
+        return await asyncio.to_thread(self._add_files, admin_id, records)
+
+    async def get_files(self, admin_id) -> List[Dict[str, Any]]:
+        rows = await asyncio.to_thread(
+            self._query, "SELECT record FROM staged_files WHERE admin_id = ? ORDER BY id", (str(admin_id),)
+        )
+        return [json.loads(row[0]) for row in rows]
+
+    async def count(self, admin_id) -> int:
+        rows = await asyncio.to_thread(
+            self._query, "SELECT COUNT(*) FROM staged_files WHERE admin_id = ?", (str(admin_id),)
+        )
+        return rows[0][0]
+
+    async def clear(self, admin_id) -> int:
+        return await asyncio.to_thread(self._clear, admin_id)
+
+    async def reserve_bundle_id(self, admin_id, candidate: str) -> str:
+        return await asyncio.to_thread(self._reserve_bundle_id, admin_id, candidate)
+
+    async def evict_expired(self) -> int:
+        removed = await asyncio.to_thread(
+            self._execute,
+            "DELETE FROM staged_files WHERE admin_id IN ("
+            " SELECT admin_id FROM staged_files GROUP BY admin_id HAVING MAX(created_at) < ?)",
+            (time.time() - self.ttl,)
+        )
+        await asyncio.to_thread(
+            self._execute,
+            "DELETE FROM staged_bundles WHERE admin_id NOT IN (SELECT admin_id FROM staged_files)", ()
+        )
+        return removed
+
+    async def close(self):
+        await super().close()
+        with self._lock:
+            self._conn.close()
+
+
+class RedisStagingStore(StagingStore):
+    """Backend for any Redis-compatible server; one list per admin with a sliding TTL"""
+
+    # Atomic size check + append + TTL refresh
+    ADD_SCRIPT = """
+    local count = redis.call('LLEN', KEYS[1])
+    if count + #ARGV - 2 > tonumber(ARGV[1]) then
+        return -1
+    end
+    for i = 3, #ARGV do
+        redis.call('RPUSH', KEYS[1], ARGV[i])
+    end
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+    return count + #ARGV - 2
+    """
+
+    def __init__(self, url: str = None, prefix: str = 'staging', **kwargs):
+        super().__init__(**kwargs)
+        try:
+            import redis.asyncio as redis_asyncio
+        except ImportError:
+            raise RuntimeError("RedisStagingStore requires the 'redis' package (pip install redis)")
+        self.redis = redis_asyncio.from_url(url or os.getenv('STAGING_REDIS_URL'))
+        self.prefix = prefix
+        self._add = self.redis.register_script(self.ADD_SCRIPT)
+
+    def _key(self, admin_id) -> str:
+        return f"{self.prefix}:{admin_id}"
+
+    async def add_file(self, admin_id, record: Dict[str, Any]) -> int:
+        return await self.add_files(admin_id, [record])
+
+    async def add_files(self, admin_id, records: List[Dict[str, Any]]) -> int:
+        count = await self._add(
+            keys=[self._key(admin_id)],
+            args=[self.max_files, int(self.ttl)] + [json.dumps(compact_record(record)) for record in records]
+        )
+        if count < 0:
+            raise CollectionFullError(self.max_files)
+        return count
+
+    async def get_files(self, admin_id) -> List[Dict[str, Any]]:
+        return [json.loads(item) for item in await self.redis.lrange(self._key(admin_id), 0, -1)]
+
+    async def count(self, admin_id) -> int:
+        return await self.redis.llen(self._key(admin_id))
+
+    async def clear(self, admin_id) -> int:
+        key = self._key(admin_id)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            count, _ = await pipe.llen(key).delete(key, f"{key}:bundle").execute()
+        return count
+
+    async def reserve_bundle_id(self, admin_id, candidate: str) -> str:
+        key = f"{self._key(admin_id)}:bundle"
+        await self.redis.set(key, candidate, nx=True, ex=int(self.ttl))
+        bundle_id = await self.redis.get(key)
+        return bundle_id.decode() if isinstance(bundle_id, bytes) else bundle_id
+
+    async def close(self):
+        await super().close()
+        await self.redis.aclose()
+
+
+def create_staging_store() -> StagingStore:
+    """Redis when STAGING_REDIS_URL is set, otherwise the local SQLite store"""
+    if os.getenv('STAGING_REDIS_URL'):
+        return RedisStagingStore()
+    return SQLiteStagingStore()
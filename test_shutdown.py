@@ -0,0 +1,62 @@
+"""
+Stopping a polling bot must deliver what is still queued.
+
+Runs Application.run_polling against the fake Bot API from load_benchmark.py,
+queues bundle deliveries that are still waiting when the application is told
+to stop, and checks every one of them reached Telegram.
+
+    python -m pytest -q test_shutdown.py
+"""
+import tempfile
+from datetime import datetime
+from types import SimpleNamespace
+
+from load_benchmark import FakeServices, configure_environment, BOT_TOKEN, ADMIN_ID, STORAGE_CHANNEL_ID
+
+DELIVERIES = 20
+
+
+def test_polling_stop_drains_delivery_queue():
+    services = FakeServices(bot_latency=20, bot_error_rate=0.0, shortener_latency=0,
+                            shortener_error_rate=0.0, seed=1)
+    services.start()
+    try:
+        with tempfile.TemporaryDirectory(prefix='shutdown-test-') as workdir:
+            configure_environment(SimpleNamespace(database_url=None, updates=0, production_rate_limits=False),
+                                  services, workdir)
+            import main
+            from delivery import BundleManifest, ManifestFile
+            from bot_bundle import TelegramBotBundle
+
+            bot = TelegramBotBundle(
+                token=BOT_TOKEN,
+                bot_username='bench_bot',
+                linkshortify_api_key='test',
+                storage_channel_id=str(STORAGE_CHANNEL_ID),
+                admin_id=str(ADMIN_ID),
+                flask_app=main.app
+            )
+            app = bot.application
+            bundle = BundleManifest('bundle_shutdown', 'Shutdown', datetime.utcnow(),
+                                    (ManifestFile('FILE-shutdown', 'document', 'file.pdf'),))
+
+            async def queue_and_stop(context):
+                for chat_id in range(1, DELIVERIES + 1):
+                    assert bot.delivery_queue.enqueue(chat_id, (SimpleNamespace(bot=app.bot), bundle))
+                assert bot.delivery_queue.depth > 0
+                app.stop_running()
+
+            app.job_queue.run_once(queue_and_stop, 0)
+            try:
+                app.run_polling(stop_signals=None, close_loop=False)
+            finally:
+                bot.db.shutdown(wait=False)
+
+            stats = bot.delivery_queue.stats()
+            assert stats['completed'] == DELIVERIES
+            assert stats['depth'] == 0
+            # Bundle header, the file and the closing note, for every chat
+            assert services.calls['sendMessage'] == 2 * DELIVERIES
+            assert services.calls['sendDocument'] == DELIVERIES
+    finally:
+        services.stop()
@@ -0,0 +1,70 @@
+import os
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Any, Dict
+from telegram.ext import ContextTypes, JobQueue
+from tokens import deactivate_expired_tokens, purge_old_tokens
+
+logger = logging.getLogger(__name__)
+
+
+class TokenSweeper:
+    """Periodic JobQueue job that keeps the user_tokens table small.
+
+    Active tokens past their expiry are deactivated, and inactive tokens that
+    expired more than retention_days ago are deleted. Both passes work in
+    batches of batch_size rows, each its own short transaction, and stop after
+    max_batches so one run never holds the table for long; leftovers are
+    picked up by the next run.
+    """
+
+    def __init__(self, database, interval: float = None, batch_size: int = None,
+                 retention_days: float = None, max_batches: int = None):
+        self.database = database
+        self.interval = interval or float(os.getenv('TOKEN_SWEEP_INTERVAL', 15 * 60))
+        self.batch_size = batch_size or int(os.getenv('TOKEN_SWEEP_BATCH_SIZE', 1000))
+        self.retention_days = retention_days or float(os.getenv('TOKEN_RETENTION_DAYS', 30))
+        self.max_batches = max_batches or int(os.getenv('TOKEN_SWEEP_MAX_BATCHES', 50))
+        self.runs = 0
+        self.deactivated = 0
+        self.purged = 0
+
+    def schedule(self, job_queue: JobQueue):
+        """Register the sweep on the application's job queue"""
+        job_queue.run_repeating(self.sweep, interval=self.interval, first=60, name='token-sweeper')
+        logger.info(f"Token sweeper scheduled every {self.interval:.0f}s")
+
+    async def sweep(self, context: ContextTypes.DEFAULT_TYPE = None):
+        """Run one deactivate + purge pass"""
+        try:
+            now = datetime.utcnow()
+            deactivated = await self._in_batches(deactivate_expired_tokens, now)
+            purged = await self._in_batches(purge_old_tokens, now - timedelta(days=self.retention_days))
+        except Exception as e:
+            logger.error(f"Error sweeping tokens: {e}")
+            return
+        self.runs += 1
+        self.deactivated += deactivated
+        self.purged += purged
+        if deactivated or purged:
+            logger.info(f"Token sweep: deactivated {deactivated} expired, purged {purged} old tokens")
+
+    async def _in_batches(self, fn, cutoff: datetime) -> int:
+        total = 0
+        for _ in range(self.max_batches):
+            changed = await self.database.run(fn, cutoff, self.batch_size)
+            total += changed
+            if changed < self.batch_size:
+                break
+            # Give other database work a turn between batches
+            await asyncio.sleep(0.05)
+        return total
+
+    def stats(self) -> Dict[str, Any]:
+        """Sweep counters for monitoring"""
+        return {
+            'runs': self.runs,
+            'deactivated': self.deactivated,
+            'purged': self.purged
+        }
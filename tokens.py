@@ -0,0 +1,130 @@
+"""
+Token activation shared by the bot and the Flask verification routes.
+
+Database functions expect to run inside an application context (a request, or a
+call on the bot's database pool) and commit their own transaction. The replay
+checks for signed verification links are in-memory and need neither.
+"""
+from datetime import datetime, timedelta
+from typing import Optional
+from models import db, User, UserToken
+from cache import token_cache, used_link_cache, MISSING
+from utils import generate_secure_token, create_token_expiry
+
+# user_id carried by pre-generated (pooled) verification links, which are only
+# bound to a real user when the link is handed out
+POOL_USER_ID = '0'
+
+
+def link_already_used(token_data: dict) -> bool:
+    """True if this verification link was already redeemed (in-memory, no database access)"""
+    return used_link_cache.get(token_data['token']) is not MISSING
+
+
+def mark_link_used(token_data: dict):
+    """Remember a redeemed verification link until it expires"""
+    used_link_cache.set_until(token_data['token'], True, token_data['expires_at'])
+
+
+def activate_user_token(user: User, token_value: str = None) -> UserToken:
+    """Deactivate the user's old tokens and activate a fresh 24-hour one.
+
+    If token_value is a pending token already bound to this user it is activated
+    in place; re-activating an active token is a no-op, and a value that belongs
+    to somebody else is replaced by a new random token.
+    """
+    existing = UserToken.query.filter_by(token=token_value).first() if token_value else None
+    if existing and existing.user_id == user.id and existing.is_active and not existing.is_expired():
+        return existing
+    if existing and existing.user_id != user.id:
+        existing = None
+        token_value = None
+
+    # Deactivate old tokens
+    old_tokens = UserToken.query.filter_by(user_id=user.id, is_active=True).all()
+    for token in old_tokens:
+        token.is_active = False
+
+    if existing:
+        new_token = existing
+        new_token.is_active = True
+        new_token.expires_at = create_token_expiry()
+    else:
+        new_token = UserToken(
+            user_id=user.id,
+            token=token_value or generate_secure_token(),
+            expires_at=create_token_expiry()
+        )
+        db.session.add(new_token)
+
+    db.session.commit()
+    token_cache.invalidate(user.id)
+
+    return new_token
+
+
+def bind_pending_token(user: User, token_value: str, ttl_seconds: float) -> UserToken:
+    """Reserve a pooled token for a user until the ads link is completed"""
+    pending = UserToken(
+        user_id=user.id,
+        token=token_value,
+        expires_at=datetime.utcnow() + timedelta(seconds=ttl_seconds),
+        is_active=False
+    )
+    db.session.add(pending)
+    db.session.commit()
+    return pending
+
+
+def _claimed_token(token_value: str) -> Optional[UserToken]:
+    """The pending row binding a pooled token to the user who claimed it, if still valid"""
+    pending = UserToken.query.filter_by(token=token_value).first()
+    if not pending or pending.is_expired():
+        return None
+    return pending
+
+
+def activate_pending_token(token_value: str) -> Optional[UserToken]:
+    """Activate a pooled token for whoever claimed it; None if unknown or expired"""
+    pending = _claimed_token(token_value)
+    if not pending:
+        return None
+    return activate_user_token(pending.user, token_value)
+
+
+def redeem_pooled_token(user: User, token_value: str) -> Optional[UserToken]:
+    """Activate a pooled token for user only if they are the one it was bound to"""
+    pending = _claimed_token(token_value)
+    if not pending or pending.user_id != user.id:
+        return None
+    return activate_user_token(user, token_value)
+
+
+def deactivate_expired_tokens(now: datetime, batch_size: int) -> int:
+    """Deactivate one batch of active tokens that expired before now; returns rows changed"""
+    ids = db.session.execute(
+        db.select(UserToken.id)
+        .where(UserToken.is_active.is_(True), UserToken.expires_at < now)
+        .limit(batch_size)
+    ).scalars().all()
+    if not ids:
+        return 0
+    db.session.execute(
+        db.update(UserToken).where(UserToken.id.in_(ids)).values(is_active=False)
+    )
+    db.session.commit()
+    return len(ids)
+
+
+def purge_old_tokens(cutoff: datetime, batch_size: int) -> int:
+    """Delete one batch of inactive tokens that expired before cutoff; returns rows deleted"""
+    ids = db.session.execute(
+        db.select(UserToken.id)
+        .where(UserToken.is_active.is_(False), UserToken.expires_at < cutoff)
+        .limit(batch_size)
+    ).scalars().all()
+    if not ids:
+        return 0
+    db.session.execute(db.delete(UserToken).where(UserToken.id.in_(ids)))
+    db.session.commit()
+    return len(ids)
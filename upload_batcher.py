@@ -0,0 +1,75 @@
+import os
+import asyncio
+import logging
+from collections import namedtuple
+from typing import Awaitable, Callable, Dict, Hashable, List
+
+logger = logging.getLogger(__name__)
+
+# One admin upload waiting to be forwarded and staged
+PendingUpload = namedtuple('PendingUpload', ['chat_id', 'message_id', 'media_group_id', 'file_info'])
+
+
+class UploadBatcher:
+    """Coalesces an admin's uploads into batches.
+
+    Every upload restarts the key's debounce timer; once no new upload arrived
+    for `debounce` seconds the collected batch is handed to `flush`. An album's
+    items arrive within milliseconds of each other, so an album always ends up in
+    a single batch. Batches for the same key are flushed one after another.
+    """
+
+    def __init__(self, flush: Callable[[Hashable, List[PendingUpload]], Awaitable], debounce: float = None):
+        self.flush = flush
+        self.debounce = debounce or float(os.getenv('UPLOAD_DEBOUNCE_SECONDS', 1.5))
+        self.pending: Dict[Hashable, List[PendingUpload]] = {}
+        self.timers: Dict[Hashable, asyncio.TimerHandle] = {}
+        self.tails: Dict[Hashable, asyncio.Task] = {}
+
+    def add(self, key: Hashable, upload: PendingUpload):
+        """Queue an upload and (re)start the key's debounce timer"""
+        self.pending.setdefault(key, []).append(upload)
+        timer = self.timers.pop(key, None)
+        if timer:
+            timer.cancel()
+        loop = asyncio.get_running_loop()
+        self.timers[key] = loop.call_later(self.debounce, self._start_flush, key)
+
+    def pending_count(self, key: Hashable) -> int:
+        """Uploads collected for key but not flushed yet"""
+        return len(self.pending.get(key, ()))
+
+    def _start_flush(self, key: Hashable):
+        self.timers.pop(key, None)
+        uploads = self.pending.pop(key, None)
+        if not uploads:
+            return
+        previous = self.tails.get(key)
+        task = asyncio.create_task(self._run_flush(key, uploads, previous))
+        self.tails[key] = task
+        task.add_done_callback(lambda t: self.tails.pop(key, None) if self.tails.get(key) is t else None)
+
+    async def _run_flush(self, key: Hashable, uploads: List[PendingUpload], previous: asyncio.Task = None):
+        if previous:
+            await asyncio.gather(previous, return_exceptions=True)
+        try:
+            await self.flush(key, uploads)
+        except Exception as e:
+            logger.error(f"Error flushing {len(uploads)} uploads for {key}: {e}")
+
+    async def drain(self, key: Hashable):
+        """Flush key's waiting uploads now and wait until all its batches are done"""
+        timer = self.timers.pop(key, None)
+        if timer:
+            timer.cancel()
+            self._start_flush(key)
+        tail = self.tails.get(key)
+        if tail:
+            await asyncio.gather(tail, return_exceptions=True)
+
+    async def stop(self):
+        """Flush everything still waiting, then wait for in-flight batches"""
+        for key in list(self.timers):
+            self.timers.pop(key).cancel()
+            self._start_flush(key)
+        await asyncio.gather(*self.tails.values(), return_exceptions=True)
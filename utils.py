@@ -1,13 +1,70 @@
+import os
+import hmac
 import base64
+import struct
 import hashlib
 import secrets
 import uuid
 import time
 import random
 import string
+import logging
 from datetime import datetime, timedelta
+from functools import lru_cache
 from typing import Optional, Tuple
-import json
+
+logger = logging.getLogger(__name__)
+
+TOKEN_LINK_TTL = int(os.getenv('TOKEN_LINK_TTL', 12 * 3600))
+_TOKEN_VERSION = 1
+_LINK_TOKEN_BYTES = 12
+_TOKEN_TAG_BYTES = 10
+# version, user id, issued-at, expires-at, token
+_TOKEN_LAYOUT = struct.Struct(f'>BqII{_LINK_TOKEN_BYTES}s')
+_TOKEN_ENCODED_LENGTH = len(base64.urlsafe_b64encode(bytes(_TOKEN_LAYOUT.size + _TOKEN_TAG_BYTES)).rstrip(b'='))
+
+# Bundle and file links carry a 63-bit integer key in base62, optionally followed by a
+# truncated HMAC tag so guessed links are rejected without a database lookup.
+# Changing LINK_TAG_CHARS invalidates every compact link already shared.
+LINK_TAG_CHARS = int(os.getenv('LINK_TAG_CHARS', 4))
+_BASE62 = string.digits + string.ascii_uppercase + string.ascii_lowercase
+_KEY_CHARS = 11  # 62**11 > 2**63
+
+# Example values (.env.example, docs) that must never end up signing real links
+PLACEHOLDER_SECRETS = {'change-me', 'changeme', 'your_secret_key', 'your-secret-key', 'secret'}
+MIN_SECRET_BYTES = 32
+
+
+def _secret_from_env(name: str) -> Optional[bytes]:
+    """Secret from the environment; None if unset, RuntimeError if it is a placeholder or too short"""
+    value = os.getenv(name)
+    if not value:
+        return None
+    if value.strip().lower() in PLACEHOLDER_SECRETS or len(value.encode('utf-8')) < MIN_SECRET_BYTES:
+        raise RuntimeError(
+            f"{name} must be a random secret of at least {MIN_SECRET_BYTES} bytes, e.g. "
+            f"python -c 'import secrets; print(secrets.token_hex(32))'"
+        )
+    return value.encode('utf-8')
+
+
+@lru_cache(maxsize=None)
+def signing_key() -> bytes:
+    """HMAC key for verification links.
+
+    Verification links are signed so forged or expired ones are rejected without
+    touching the database, which only works if the key is secret: it comes from
+    TOKEN_SIGNING_KEY or FLASK_SECRET_KEY, else is derived from the bot token, and
+    there is no built-in default. Placeholders and short keys are refused.
+    """
+    key = _secret_from_env('TOKEN_SIGNING_KEY') or _secret_from_env('FLASK_SECRET_KEY')
+    if key:
+        return key
+    bot_token = os.getenv('TELEGRAM_BOT_TOKEN')
+    if bot_token:
+        logger.warning("TOKEN_SIGNING_KEY is not set, deriving the link signing key from TELEGRAM_BOT_TOKEN")
+        return hmac.new(bot_token.encode('utf-8'), b'verification-link-signing-key', hashlib.sha256).digest()
+    raise RuntimeError("Set TOKEN_SIGNING_KEY (or FLASK_SECRET_KEY) to sign verification links")
 
 
 def generate_secure_token() -> str:
@@ -38,55 +95,127 @@ def decode_file_id(encoded_id: str) -> Optional[str]:
         return None
 
 
-def encode_token_data(token: str, user_id: str, timestamp: str = None) -> str:
-    """Encode token data for ads verification deep links"""
+def base62_encode(value: int, width: int = 0) -> str:
+    """Encode a non-negative integer in base62, left-padded to width"""
+    digits = []
+    while value:
+        value, remainder = divmod(value, 62)
+        digits.append(_BASE62[remainder])
+    return ''.join(reversed(digits)).rjust(max(width, 1), '0')
+
+
+def base62_decode(text: str) -> Optional[int]:
+    """Decode a base62 string; None if it contains other characters"""
+    value = 0
+    for char in text:
+        index = _BASE62.find(char)
+        if index < 0:
+            return None
+        value = value * 62 + index
+    return value
+
+
+def compact_key(value: str) -> int:
+    """Stable 63-bit key (fits a signed BIGINT) derived from a string id"""
+    return int.from_bytes(hashlib.sha256(value.encode('utf-8')).digest()[:8], 'big') >> 1
+
+
+@lru_cache(maxsize=None)
+def link_tag_key() -> Optional[bytes]:
+    """HMAC key for the tags on b_/f_ links, None when tags are disabled.
+
+    Bundle and file links are permanent, so this key is its own setting
+    (LINK_TAG_KEY) that is set once and never derived from secrets that may be
+    rotated: changing it breaks every compact link already shared.
+    """
+    if not LINK_TAG_CHARS:
+        return None
+    key = _secret_from_env('LINK_TAG_KEY')
+    if not key:
+        raise RuntimeError("Set LINK_TAG_KEY (or LINK_TAG_CHARS=0) to tag bundle and file links")
+    return key
+
+
+def _link_tag(kind: str, key: int) -> str:
+    digest = hmac.new(link_tag_key(), f"{kind}:{key}".encode('utf-8'), hashlib.sha256).digest()
+    return base62_encode(int.from_bytes(digest[:8], 'big') % 62 ** LINK_TAG_CHARS, LINK_TAG_CHARS)
+
+
+def encode_compact_id(kind: str, key: int) -> str:
+    """Fixed-width base62 key plus its tag; kind ('b' or 'f') keeps bundle and file tags apart"""
+    encoded = base62_encode(key, _KEY_CHARS)
+    return encoded + _link_tag(kind, key) if LINK_TAG_CHARS else encoded
+
+
+def decode_compact_id(kind: str, encoded: str) -> Optional[int]:
+    """Key from a compact link parameter; None if malformed or the tag doesn't match"""
+    if len(encoded) != _KEY_CHARS + LINK_TAG_CHARS:
+        return None
+    key = base62_decode(encoded[:_KEY_CHARS])
+    if key is None or key >= 2 ** 63:
+        return None
+    if LINK_TAG_CHARS and not hmac.compare_digest(encoded[_KEY_CHARS:], _link_tag(kind, key)):
+        return None
+    return key
+
+
+def generate_link_token() -> str:
+    """Generate the random token carried by a signed verification link"""
+    return base64.urlsafe_b64encode(secrets.token_bytes(_LINK_TOKEN_BYTES)).decode('utf-8')
+
+
+def _token_tag(payload: bytes) -> bytes:
+    return hmac.new(signing_key(), payload, hashlib.sha256).digest()[:_TOKEN_TAG_BYTES]
+
+
+def encode_token_data(token: str, user_id: str, ttl_seconds: int = None) -> str:
+    """Encode and sign token data for ads verification deep links.
+
+    Binary layout: version, user id, issued-at, expires-at, token, then a
+    truncated HMAC-SHA256 tag; 52 base64url characters, so "token_" + data
+    fits Telegram's 64-character start parameter.
+    """
     try:
-        if timestamp is None:
-            timestamp = str(int(datetime.utcnow().timestamp()))
-        
-        # Create compact format: token:user_id:timestamp
-        compact_data = f"{token}:{user_id}:{timestamp}"
-        encoded = base64.urlsafe_b64encode(compact_data.encode('utf-8')).decode('utf-8')
+        issued_at = int(time.time())
+        expires_at = issued_at + (ttl_seconds or TOKEN_LINK_TTL)
+        payload = _TOKEN_LAYOUT.pack(
+            _TOKEN_VERSION, int(user_id), issued_at, expires_at, base64.urlsafe_b64decode(token)
+        )
+        encoded = base64.urlsafe_b64encode(payload + _token_tag(payload)).decode('utf-8')
         return encoded.rstrip('=')
     except Exception:
         return ""
 
 
 def decode_token_data(encoded_data: str) -> Optional[dict]:
-    """Decode token data from deep link parameter"""
+    """Verify and decode token data from a deep link; None if malformed, forged or expired"""
     try:
-        # Add back padding if needed
-        missing_padding = len(encoded_data) % 4
-        if missing_padding:
-            encoded_data += '=' * (4 - missing_padding)
-        
-        decoded = base64.urlsafe_b64decode(encoded_data.encode('utf-8')).decode('utf-8')
-        # Parse compact format: token:user_id:timestamp
-        parts = decoded.split(':')
-        if len(parts) == 3:
-            token_data = {
-                'token': parts[0],
-                'user_id': parts[1],
-                'timestamp': parts[2]
-            }
-        else:
-            # Fallback to old JSON format
-            token_data = json.loads(decoded)
-        
-        return token_data
+        if len(encoded_data) != _TOKEN_ENCODED_LENGTH:
+            return None
+        raw = base64.urlsafe_b64decode(encoded_data + '=' * (-len(encoded_data) % 4))
+        payload, tag = raw[:_TOKEN_LAYOUT.size], raw[_TOKEN_LAYOUT.size:]
+        if not hmac.compare_digest(tag, _token_tag(payload)):
+            return None
+        version, user_id, issued_at, expires_at, token = _TOKEN_LAYOUT.unpack(payload)
+        if version != _TOKEN_VERSION or time.time() > expires_at:
+            return None
+        return {
+            'token': base64.urlsafe_b64encode(token).decode('utf-8'),
+            'user_id': str(user_id),
+            'issued_at': issued_at,
+            'expires_at': datetime.utcfromtimestamp(expires_at)
+        }
     except Exception:
         return None
 
 
-def generate_media_link(bot_username: str, file_id: str) -> str:
+def generate_media_link(bot_username: str, file_key: int) -> str:
     """Generate deep link for media access"""
-    encoded_id = encode_file_id(file_id)
-    return f"https://t.me/{bot_username}?start={encoded_id}"
+    return f"https://t.me/{bot_username}?start=f_{encode_compact_id('f', file_key)}"
 
-def generate_bundle_link(bot_username: str, bundle_id: str) -> str:
+def generate_bundle_link(bot_username: str, bundle_key: int) -> str:
     """Generate deep link for bundle access"""
-    encoded_id = encode_file_id(bundle_id)
-    return f"https://t.me/{bot_username}?start=bundle_{encoded_id}"
+    return f"https://t.me/{bot_username}?start=b_{encode_compact_id('b', bundle_key)}"
 
 def generate_unique_bundle_id() -> str:
     """Generate unique bundle ID"""
@@ -105,7 +234,12 @@ def parse_deep_link_parameter(param: str) -> Tuple[str, str]:
     """Parse deep link parameter to determine type and extract data"""
     if param.startswith('token_'):
         return 'token', param[6:]  # Remove 'token_' prefix
+    elif param.startswith('b_'):
+        return 'bundle_key', param[2:]
+    elif param.startswith('f_'):
+        return 'media_key', param[2:]
     elif param.startswith('bundle_'):
+        # Links shared before compact ids: base64 of the bundle_id string
         return 'bundle', param[7:]  # Remove 'bundle_' prefix
     else:
         return 'media', param